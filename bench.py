@@ -0,0 +1,475 @@
+import os
+import resource
+import sys
+import time
+from foamy.context import Context
+from foamy.shortcuts import open_soap
+from lxml import etree
+
+BASIC_NAMES = ("string", "int", "double", "boolean", "dateTime", "decimal")
+
+
+def generate_wsdl(n_types=2000, n_fields=12):
+	"""
+	Generate a large synthetic document/literal WSDL: `n_types` request/response element pairs
+	with `n_fields` children each, some of which refer to the previous complex type.
+	"""
+	tns = "http://example.com/bench/"
+	out = [
+		'<?xml version="1.0" encoding="utf-8"?>',
+		'<wsdl:definitions xmlns:wsdl="http://schemas.xmlsoap.org/wsdl/" xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/" '
+		'xmlns:s="http://www.w3.org/2001/XMLSchema" xmlns:tns="%s" targetNamespace="%s">' % (tns, tns),
+		'<wsdl:types><s:schema elementFormDefault="qualified" targetNamespace="%s">' % tns,
+	]
+	for i in xrange(n_types):
+		out.append('<s:complexType name="Record%d"><s:sequence>' % i)
+		for j in xrange(n_fields):
+			if j == 0 and i > 0:
+				field_type = "tns:Record%d" % (i - 1)
+			else:
+				field_type = "s:%s" % BASIC_NAMES[j % len(BASIC_NAMES)]
+			out.append('<s:element minOccurs="0" maxOccurs="unbounded" name="field%d" type="%s"/>' % (j, field_type))
+		out.append('</s:sequence><s:attribute name="id" type="s:string"/></s:complexType>')
+		for suffix in ("", "Response"):
+			out.append(
+				'<s:element name="Op%d%s"><s:complexType><s:sequence>'
+				'<s:element name="record" type="tns:Record%d"/><s:element name="note" type="s:string"/>'
+				'</s:sequence></s:complexType></s:element>' % (i, suffix, i)
+			)
+	out.append('</s:schema></wsdl:types>')
+	for i in xrange(n_types):
+		for direction, suffix in (("In", ""), ("Out", "Response")):
+			out.append('<wsdl:message name="Op%d%s"><wsdl:part name="parameters" element="tns:Op%d%s"/></wsdl:message>' % (i, direction, i, suffix))
+	out.append('<wsdl:portType name="BenchSoap">')
+	for i in xrange(n_types):
+		out.append('<wsdl:operation name="Op%d"><wsdl:input message="tns:Op%dIn"/><wsdl:output message="tns:Op%dOut"/></wsdl:operation>' % (i, i, i))
+	out.append('</wsdl:portType><wsdl:binding name="BenchSoap" type="tns:BenchSoap"><soap:binding transport="http://schemas.xmlsoap.org/soap/http"/>')
+	for i in xrange(n_types):
+		out.append(
+			'<wsdl:operation name="Op%d"><soap:operation soapAction="%sOp%d" style="document"/>'
+			'<wsdl:input><soap:body use="literal"/></wsdl:input><wsdl:output><soap:body use="literal"/></wsdl:output>'
+			'</wsdl:operation>' % (i, tns, i)
+		)
+	out.append('</wsdl:binding><wsdl:service name="Bench"><wsdl:port name="BenchSoap" binding="tns:BenchSoap">')
+	out.append('<soap:address location="http://localhost/bench"/></wsdl:port></wsdl:service></wsdl:definitions>')
+	return "\n".join(out)
+
+
+def best_of(n, fn):
+	times = []
+	for x in xrange(n):
+		start = time.time()
+		fn()
+		times.append(time.time() - start)
+	return min(times)
+
+
+def bench_cold_start(n=5):
+	"""
+	Wall time of fresh interpreters doing increasingly more, so the import cost shows
+	apart from the interpreter's own startup. (Python 2 has no `-X importtime`.)
+	"""
+	import subprocess
+	steps = [
+		("interpreter", "pass"),
+		("import foamy.shortcuts", "import foamy.shortcuts"),
+		("open_soap, custom transport", "from foamy.shortcuts import open_soap; open_soap('ex/ndfdXML.wsdl', transport=object())"),
+		("open_soap, default transport", "from foamy.shortcuts import open_soap; open_soap('ex/ndfdXML.wsdl')"),
+	]
+	for label, script in steps:
+		def run():
+			subprocess.check_call([sys.executable, "-c", script])
+		print "Cold start, %s: %.1f ms (best of %d)" % (label, best_of(n, run) * 1000, n)
+
+
+def bench_replay(n=100):
+	"""
+	Per-call cost of `Context.dispatch` with a recorded response replayed from memory,
+	against the same call to a local server.
+	"""
+	import tempfile
+	from foamy.recording import RecordingTransport, ReplayTransport
+	from foamy.testing import StandInServer
+	from foamy.transport import RequestsTransport
+	from test import CC_RESPONSE
+
+	def handler(request):
+		return (200, {"Content-Type": "text/xml; charset=utf-8"}, CC_RESPONSE % "1.25")
+
+	def make_calls(transport, url):
+		op = open_soap("ex/currencyconvertor.wsdl", transport=transport).service.ConversionRate
+		op.port.location = url
+
+		def calls():
+			for x in xrange(n):
+				op(FromCurrency="EUR", ToCurrency="USD")
+		return calls
+
+	with tempfile.NamedTemporaryFile(suffix=".rec") as fp:
+		with StandInServer(handler) as server:
+			url = server.url
+			live = best_of(3, make_calls(RequestsTransport(), url))
+			recorder = RecordingTransport(RequestsTransport(), fp.name)
+			make_calls(recorder, url)()
+			recorder.close()
+		replayed = best_of(3, make_calls(ReplayTransport(fp.name), url))
+	print "Dispatch: %.1f us per call against a local server, %.1f us replayed" % (live * 1e6 / n, replayed * 1e6 / n)
+
+
+def bench_transports(n=500):
+	""" Calls per second to a local server through `RequestsTransport` and `RawHTTPTransport`. """
+	from foamy.rawhttp import RawHTTPTransport
+	from foamy.testing import StandInServer
+	from foamy.transport import RequestsTransport
+	from test import CC_RESPONSE
+
+	def handler(request):
+		return (200, {"Content-Type": "text/xml; charset=utf-8"}, CC_RESPONSE % "1.25")
+
+	with StandInServer(handler) as server:
+		for transport in (RequestsTransport(), RawHTTPTransport()):
+			op = open_soap("ex/currencyconvertor.wsdl", transport=transport).service.ConversionRate
+			op.port.location = server.url
+			request = op.port.envelope_message({"FromCurrency": "EUR", "ToCurrency": "USD"}, op.operation)
+
+			def calls():
+				for x in xrange(n):
+					op(FromCurrency="EUR", ToCurrency="USD")
+
+			def dispatches():
+				for x in xrange(n):
+					transport.dispatch(request)
+
+			print "%s: %.0f calls/s, %.0f bare dispatches/s" % (
+				transport.__class__.__name__, n / best_of(3, calls), n / best_of(3, dispatches)
+			)
+
+
+def bench_parsing(n_items=20000):
+	"""
+	Parse a pretty-printed response with `etree.fromstring`'s default parser, and with
+	`XMLParsers` (also without collecting IDs); and the generated WSDL likewise.
+	"""
+	from foamy.xmlutils import XMLParsers
+	item = "  <Item>\n    <Sku>SKU-%06d</Sku>\n    <Quantity>%d</Quantity>\n  </Item>\n"
+	response = "<Items>\n%s</Items>" % "".join(item % (i, i % 7) for i in xrange(n_items))
+	wsdl = generate_wsdl(n_types=500)
+	tuned = XMLParsers()
+	no_ids = XMLParsers(collect_ids=False)
+	for name, data in (("response", response), ("WSDL", wsdl)):
+		for label, parse in (
+			("default", etree.fromstring),
+			("XMLParsers()", tuned.fromstring),
+			("XMLParsers(collect_ids=False)", no_ids.fromstring),
+		):
+			root = parse(data)
+			blank = sum(1 for el in root.iter() if el.tail and not el.tail.strip())
+			print "Parse %s (%d KB), %s: %.2f ms, %d blank text nodes" % (
+				name, len(data) / 1024, label, best_of(5, lambda: parse(data)) * 1000, blank
+			)
+
+
+def bench_wsdl_load():
+	data = generate_wsdl()
+	tree = etree.fromstring(data).getroottree()
+
+	def load():
+		Context(transport=object()).read_wsdl_tree(tree)
+
+	duration = best_of(5, load)
+	print "WSDL load: %d bytes, %.3f s (best of 5, excluding XML parse)" % (len(data), duration)
+
+
+def in_child(fn):
+	"""
+	Run `fn` in a forked child and return (its result, how far it raised the peak RSS in KB).
+	"""
+	read_fd, write_fd = os.pipe()
+	pid = os.fork()
+	if not pid:
+		os.close(read_fd)
+		start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		result = fn()
+		peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		os.write(write_fd, "%r %d" % (result, peak_rss - start_rss))
+		os._exit(0)
+	os.close(write_fd)
+	output = os.read(read_fd, 4096)
+	os.close(read_fd)
+	os.waitpid(pid, 0)
+	result, rss = output.rsplit(" ", 1)
+	return result, int(rss)
+
+
+def bench_stream_request(n_items=20000):
+	ctx = open_soap("ex/orders.wsdl")
+	op = ctx.service.SubmitOrder
+
+	def items():
+		for i in xrange(n_items):
+			yield {"Sku": "SKU-%06d" % i, "Quantity": i % 7 + 1}
+
+	for stream_request in (False, True):
+		def envelope():
+			request = op.port.envelope_message({"OrderId": "A-1", "Item": items()}, op.operation, stream_request)
+			if stream_request:
+				return sum(len(chunk) for chunk in request.data)
+			return len(request.data)
+
+		start = time.time()
+		size, rss = in_child(envelope)
+		print "Request envelope (%d items, stream_request=%s): %s bytes, %.2f s, peak RSS +%d KB" % (
+			n_items, stream_request, size, time.time() - start, rss
+		)
+
+
+def bench_codegen():
+	import imp
+	from foamy.codegen import generate_module
+	for wsdl in ("ex/ndfdXML.wsdl", "ex/orders.wsdl"):
+		code = compile(generate_module(open_soap(wsdl)), "generated", "exec")  # As if imported from a .pyc
+
+		def load_generated():
+			exec code in imp.new_module("generated").__dict__
+
+		print "Startup (%s): dynamic %.2f ms, generated %.2f ms" % (
+			wsdl, best_of(20, lambda: open_soap(wsdl)) * 1000, best_of(20, load_generated) * 1000
+		)
+
+	ctx = open_soap("ex/orders.wsdl")
+	module = imp.new_module("generated")
+	exec compile(generate_module(ctx), "generated", "exec") in module.__dict__
+	op = ctx.service.SubmitOrder
+	client = module.Client(transport=object())
+	message = {"OrderId": "A-1", "Item": [{"Sku": "SKU-%d" % i, "Quantity": i} for i in xrange(100)]}
+	n = 200
+
+	def dynamic():
+		for x in xrange(n):
+			op.port.envelope_message(message, op.operation)
+
+	def generated():
+		for x in xrange(n):
+			client.envelope_message("SubmitOrder", message)
+
+	print "Request envelope (100 items): dynamic %.3f ms, generated %.3f ms" % (
+		best_of(5, dynamic) * 1000 / n, best_of(5, generated) * 1000 / n
+	)
+
+
+def bench_records(n=20000):
+	"""
+	Unmarshalling time and per-record size (not counting the field values, which are
+	shared) for dicts, generated slotted records and namedtuples. Neither of the
+	latter has a per-instance `__dict__`.
+	"""
+	ns = "http://example.com/attachments/"
+	ctx = open_soap("ex/attachments.wsdl")
+	store = ctx.types["{%s}Store" % ns]
+	node = etree.fromstring('<Store xmlns="%s"><Name>test</Name><Content>AAEC</Content></Store>' % ns)
+	for mode in ("dict", "slots", "namedtuple"):
+		ctx.record_mode = mode
+		records = [store.unmarshal(node) for x in xrange(n)]
+		duration = best_of(3, lambda: [store.unmarshal(node) for x in xrange(n)])
+		print "Records (%s): %.2f us each, %d bytes each" % (
+			mode, duration * 1000000 / n, sys.getsizeof(records[0])
+		)
+
+
+def bench_bulk(n=5000):
+	""" Envelopes per second from a `Port.envelope_message` loop vs. `write_envelopes` in one and several processes. """
+	import io
+	from foamy.bulk import StreamSink, write_envelopes
+	ctx = open_soap("ex/orders.wsdl")
+	op = ctx.service.SubmitOrder
+	records = [{"OrderId": "A-%d" % i, "Item": [{"Sku": "SKU-%d" % j, "Quantity": j} for j in xrange(5)]} for i in xrange(n)]
+
+	def loop():
+		out = io.BytesIO()
+		for record in records:
+			out.write(op.port.envelope_message(record, op.operation).data)
+
+	print "Bulk (%d envelopes): envelope_message loop %.0f/s" % (n, n / best_of(3, loop))
+	for processes in (None, 2, 4):
+		stats = write_envelopes(op, records, StreamSink(io.BytesIO()), processes=processes)
+		print "Bulk (%d envelopes): write_envelopes, processes=%s: %s" % (n, processes, stats.describe())
+
+
+def bench_validation(n=2000):
+	""" Request envelope time with `Context.strict` off and on, for enumeration- and pattern-checked operations. """
+	import datetime
+	cc = open_soap("ex/currencyconvertor.wsdl")
+	ndfd = open_soap("ex/ndfdXML.wsdl")
+	cases = (
+		("ConversionRate", cc, {"FromCurrency": "EUR", "ToCurrency": "USD"}),
+		("NDFDgenLatLonList", ndfd, {
+			"listLatLon": "39.0,-77.0 38.99,-77.01 39.1,-76.9", "product": "time-series",
+			"startTime": datetime.datetime(2012, 1, 1), "endTime": datetime.datetime(2016, 9, 9),
+			"Unit": "m", "weatherParameters": {"maxt": True, "mint": True},
+		}),
+	)
+	for name, ctx, message in cases:
+		op = getattr(ctx.service, name)
+		timings = []
+		for strict in (False, True):
+			ctx.strict = strict
+
+			def envelopes():
+				for x in xrange(n):
+					op.port.envelope_message(message, op.operation)
+
+			timings.append(best_of(5, envelopes) * 1000000 / n)
+		print "Validation (%s): strict off %.1f us, on %.1f us per envelope (%+.1f%%)" % (
+			name, timings[0], timings[1], (timings[1] / timings[0] - 1) * 100
+		)
+
+
+def bench_fleet(n=40, latency=0.05):
+	"""
+	Boot time for `n` WSDLs served with `latency` seconds of delay each, loaded one by one
+	as `open_soap` would and with `FleetLoader`; a quarter of them are mirrors with the same content.
+	"""
+	from foamy.fleet import FleetLoader
+	from foamy.loader import NullCache
+	from foamy.testing import StandInServer
+	from foamy.transport import RequestsTransport
+	documents = [generate_wsdl(n_types=50 + i) for i in xrange(n * 3 / 4)]
+
+	def handler(request):
+		time.sleep(latency)
+		return (200, {"Content-Type": "text/xml"}, documents[int(request.path.rsplit("/", 1)[-1]) % len(documents)])
+
+	with StandInServer(handler) as server:
+		urls = ["%s/%d" % (server.url, i) for i in xrange(n)]
+		for threads in (1, 8, 32):
+			fleet = FleetLoader(threads=threads, transport=RequestsTransport(), cache=NullCache()).load(urls)
+			slowest = max(fleet.members, key=lambda member: member.total_time)
+			print "Fleet (%d WSDLs, threads=%d): %s; slowest %s in %.0f ms" % (
+				n, threads, fleet.describe(), slowest.url.rsplit("/", 1)[-1], slowest.total_time * 1000
+			)
+
+
+REPORT_WSDL = """<?xml version="1.0" encoding="utf-8"?>
+<wsdl:definitions xmlns:wsdl="http://schemas.xmlsoap.org/wsdl/" xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/"
+	xmlns:s="http://www.w3.org/2001/XMLSchema" xmlns:tns="http://example.com/report/" targetNamespace="http://example.com/report/">
+<wsdl:types><s:schema elementFormDefault="qualified" targetNamespace="http://example.com/report/">
+	<s:element name="Report"><s:complexType><s:sequence><s:element name="Id" type="s:string"/></s:sequence></s:complexType></s:element>
+	<s:element name="ReportResponse"><s:complexType><s:sequence>
+		<s:element name="Total" type="s:int"/>
+		<s:element name="Row" maxOccurs="unbounded"><s:complexType><s:sequence>
+			<s:element name="Name" type="s:string"/><s:element name="Value" type="s:double"/><s:element name="When" type="s:dateTime"/>
+		</s:sequence></s:complexType></s:element>
+	</s:sequence></s:complexType></s:element>
+</s:schema></wsdl:types>
+<wsdl:message name="ReportIn"><wsdl:part name="parameters" element="tns:Report"/></wsdl:message>
+<wsdl:message name="ReportOut"><wsdl:part name="parameters" element="tns:ReportResponse"/></wsdl:message>
+<wsdl:portType name="ReportSoap"><wsdl:operation name="Report"><wsdl:input message="tns:ReportIn"/><wsdl:output message="tns:ReportOut"/></wsdl:operation></wsdl:portType>
+<wsdl:binding name="ReportSoap" type="tns:ReportSoap"><soap:binding transport="http://schemas.xmlsoap.org/soap/http"/>
+	<wsdl:operation name="Report"><soap:operation soapAction="http://example.com/report/Report" style="document"/>
+	<wsdl:input><soap:body use="literal"/></wsdl:input><wsdl:output><soap:body use="literal"/></wsdl:output></wsdl:operation>
+</wsdl:binding>
+<wsdl:service name="Report"><wsdl:port name="ReportSoap" binding="tns:ReportSoap"><soap:address location="http://localhost/report"/></wsdl:port></wsdl:service>
+</wsdl:definitions>"""
+
+
+def bench_projection(n_rows=20000):
+	"""
+	A response with `n_rows` rows and a total, fetched whole and with `_fields="Total"`,
+	streamed and not; and how many elements the parsed tree keeps with and without pruning.
+	"""
+	from foamy.context import Context
+	from foamy.testing import StandInServer
+	from foamy.transport import RequestsTransport
+	from foamy.xmlutils import feed_parse
+	rows = "".join(
+		"<Row><Name>row-%d</Name><Value>%d.5</Value><When>2016-09-09T12:00:00</When></Row>" % (i, i) for i in xrange(n_rows)
+	)
+	body = (
+		'<?xml version="1.0" encoding="utf-8"?><soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"><soap:Body>'
+		'<ReportResponse xmlns="http://example.com/report/"><Total>%d</Total>%s</ReportResponse></soap:Body></soap:Envelope>'
+	) % (n_rows, rows)
+
+	def handler(request):
+		return (200, {"Content-Type": "text/xml; charset=utf-8"}, body)
+
+	ctx = Context()
+	ctx.read_wsdl_tree(etree.ElementTree(etree.fromstring(REPORT_WSDL)))
+	op = ctx.service.Report
+	with StandInServer(handler) as server:
+		op.port.location = server.url
+		for stream in (False, True):
+			ctx.transport = RequestsTransport(stream=stream)
+			print "Projection (%d rows, stream=%s): whole %.1f ms, _fields=Total %.1f ms" % (
+				n_rows, stream, best_of(5, lambda: op(Id="x")) * 1000, best_of(5, lambda: op(Id="x", _fields="Total")) * 1000
+			)
+	keep = op.port.binding.get_projection(op.operation, "Total").document_keep
+	chunks = [body[i:i + 65536] for i in xrange(0, len(body), 65536)]
+	for label, keep_trie in (("whole", None), ("pruned", keep)):
+		duration = best_of(5, lambda: feed_parse(chunks, keep=keep_trie))
+		tree, _ = feed_parse(chunks, keep=keep_trie)
+		print "Projection (%d rows): %s tree of %d elements, parsed in %.1f ms" % (
+			n_rows, label, sum(1 for el in tree.iter()), duration * 1000
+		)
+
+
+def bench_interning(n_types=2000):
+	"""
+	Type objects and their approximate memory (instances, their `__dict__`s and attribute dicts)
+	for a generated WSDL loaded with and without interning identical element declarations.
+	"""
+	import gc
+	from foamy.types import Type
+	wsdl = generate_wsdl(n_types=n_types)
+	for intern_types in (False, True):
+		ctx = Context(transport=object(), intern_types=intern_types)
+		start = time.time()
+		ctx.read_wsdl_tree(etree.ElementTree(etree.fromstring(wsdl)))
+		duration = time.time() - start
+		gc.collect()
+		types = [obj for obj in gc.get_objects() if isinstance(obj, Type) and obj.context is ctx]
+		size = sum(sys.getsizeof(type) + sys.getsizeof(type.__dict__) + sys.getsizeof(type.attributes) for type in types)
+		print "Interning %s: %d types, %.1f MB, loaded in %.2f s" % (
+			("on" if intern_types else "off"), len(types), size / 1048576.0, duration
+		)
+		del ctx, types
+
+
+def bench_reload(n_types=2000, n=3):
+	"""
+	Reloading a generated WSDL after changes of different reach, against loading it afresh.
+	Each RecordN refers to the one before it, so a change to Record0 reaches everything.
+	"""
+	wsdl = generate_wsdl(n_types=n_types)
+
+	def load(reloadable):
+		ctx = Context(transport=object(), reloadable=reloadable)
+		ctx.read_wsdl_tree(etree.ElementTree(etree.fromstring(wsdl)))
+		return ctx
+
+	for reloadable in (False, True):
+		print "Reload: full load (reloadable=%s) in %.3f s" % (reloadable, best_of(n, lambda: load(reloadable)))
+	ctx = load(True)
+	original = etree.ElementTree(etree.fromstring(wsdl))
+	extra = '<s:element name="extra" type="s:int"/>'
+	for description, start_tag in [
+		("nothing", None),
+		("one operation's element", '<s:element name="Op%d"><s:complexType><s:sequence>' % (n_types - 1)),
+		("the last record", '<s:complexType name="Record%d"><s:sequence>' % (n_types - 1)),
+		("the middle record", '<s:complexType name="Record%d"><s:sequence>' % (n_types // 2)),
+		("the first record", '<s:complexType name="Record0"><s:sequence>'),
+	]:
+		changed = (etree.ElementTree(etree.fromstring(wsdl.replace(start_tag, start_tag + extra, 1))) if start_tag else original)
+		times = []
+		for x in xrange(n):
+			start = time.time()
+			dirty = ctx.reload_trees([changed])
+			times.append(time.time() - start)
+			ctx.reload_trees([original])  # Back to the original for the next round
+		print "Reload: changing %s parses %d definitions again in %.3f s" % (description, len(dirty), min(times))
+
+
+BENCHMARKS = dict((name[6:], fn) for (name, fn) in globals().items() if name.startswith("bench_"))
+
+if __name__ == '__main__':
+	for name in (sys.argv[1:] or sorted(BENCHMARKS)):
+		BENCHMARKS[name]()
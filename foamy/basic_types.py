@@ -1,7 +1,8 @@
+from foamy.mtom import current_attachments
 from foamy.ns import COMMON_NAMESPACES as NS
 from foamy.types import BaseType
+import base64
 import datetime
-import decimal
 import foamy.iso8601 as iso8601
 
 
@@ -101,12 +102,38 @@ class DecimalType(BaseType):
         return unicode(obj)
 
     def unmarshal(self, obj):
+        import decimal  # Deferred; slow to import and rarely needed
         return decimal.Decimal(unicode(unwrap(obj)))
 
     def craft(self):
+        import decimal
         return decimal.Decimal(0)
 
 
+class Base64BinaryType(BaseType):
+    def marshal(self, obj):
+        attachments = current_attachments()
+        if attachments is not None:  # MTOM: send the value as a MIME part if it's big enough
+            content_id = attachments.add(obj)
+            if content_id:
+                return "cid:%s" % content_id
+        if hasattr(obj, "read"):
+            obj = obj.read()
+        return base64.b64encode(obj)
+
+    def unmarshal(self, obj):
+        text = unwrap(obj) or ""
+        if text.startswith("cid:"):  # XOP reference; ':' can never appear in base64 data
+            attachments = current_attachments()
+            if attachments is None:
+                raise ValueError("XOP reference %r outside of a multipart message" % text)
+            return attachments.resolve(text)
+        return base64.b64decode(text)
+
+    def craft(self):
+        return ""
+
+
 BASIC_TYPES = {
     NS.tag("schema", "string"): UnicodeType(),
     NS.tag("schema", "int"): IntegerType(),
@@ -119,4 +146,5 @@ BASIC_TYPES = {
     NS.tag("schema", "date"): DateType(),
     NS.tag("schema", "dateTime"): DateTimeType(),
     NS.tag("schema", "time"): TimeType(),
+    NS.tag("schema", "base64Binary"): Base64BinaryType(),
 }
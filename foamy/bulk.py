@@ -0,0 +1,227 @@
+"""
+Offline generation of many request envelopes at once, for partners that take SOAP
+requests as batch files rather than over HTTP.
+
+The envelope around the body is serialized once per operation, and the body is marshalled
+by a function compiled for the operation's input message with `foamy.codegen`; each record
+only costs running that and serializing its body elements. The output is the same as
+streamed requests' (`SOAPBinding.iter_envelope`).
+"""
+from foamy.ns import COMMON_NAMESPACES as NS
+from foamy.objs import BODY_TAG, ENVELOPE_TAG, HEADER_TAG, SOAPBinding
+from lxml.etree import Element, tostring, xmlfile
+import io
+import itertools
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+_pool_writer = None  # The `EnvelopeWriter` a pool worker uses; set by `_set_pool_writer`
+
+
+def _envelope_frame():
+    """ :return: The bytes before and after the body content of an envelope. """
+    buf = io.BytesIO()
+    with xmlfile(buf, encoding="UTF-8") as xf:
+        xf.write_declaration()
+        with xf.element(ENVELOPE_TAG, nsmap={"soapenv": NS.soapenv}):
+            with xf.element(HEADER_TAG):
+                pass
+            with xf.element(BODY_TAG):
+                pass
+    data = buf.getvalue()
+    split = data.rindex(b"</soapenv:Body>")
+    return data[:split], data[split:]
+
+
+class EnvelopeWriter(object):
+    def __init__(self, port, operation, compiled=True):
+        """
+        :param compiled: Whether to marshal with a generated function rather than through the types.
+        """
+        binding = port.binding
+        if not isinstance(binding, SOAPBinding):
+            raise ValueError("Bulk envelopes need a SOAP binding; %s has none" % port)
+        if binding.mtom:
+            raise ValueError("Bulk envelopes can't carry MTOM attachments (%s)" % port)
+        opbind = binding.operation_bindings[operation]
+        self.operation = operation
+        self.message = operation.input.message
+        self.style = opbind["style"]
+        self.headers = {
+            "Content-type": "text/xml; charset=utf-8",
+            "SOAPAction": '"%s"' % opbind.get("soapAction")
+        }
+        self.prefix, self.suffix = _envelope_frame()
+        self.marshal = None
+        if compiled:
+            from foamy.codegen import compile_message_marshal
+            self.marshal = compile_message_marshal(binding.context, self.message, self.style)
+
+    def envelope(self, record):
+        parts = [self.prefix]
+        if self.marshal is not None:
+            body = Element("body")  # No namespace, so it isn't declared on the body elements
+            self.marshal(body, record)
+            elements = body
+        else:
+            elements = self.message.marshal(record, style=self.style)
+        for el in elements:
+            parts.append(tostring(el, encoding="UTF-8"))
+        parts.append(self.suffix)
+        return b"".join(parts)
+
+    def iter_envelopes(self, records):
+        for record in records:
+            yield self.envelope(record)
+
+
+def _set_pool_writer(writer):
+    global _pool_writer
+    _pool_writer = writer
+
+
+def _envelope_chunk(records):
+    return [_pool_writer.envelope(record) for record in records]
+
+
+class StreamSink(object):
+    """ Writes envelopes one after another to a binary file object, each followed by `separator`. """
+
+    def __init__(self, fp, separator=b"\n"):
+        self.fp = fp
+        self.separator = separator
+
+    def write(self, data):
+        self.fp.write(data)
+        if self.separator:
+            self.fp.write(self.separator)
+
+    def close(self):
+        self.fp.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class FileSink(StreamSink):
+    """ Writes envelopes into the file at `path`, like `StreamSink`. """
+
+    def __init__(self, path, separator=b"\n"):
+        StreamSink.__init__(self, open(path, "wb"), separator)
+
+    def close(self):
+        self.fp.close()
+
+
+class DirectorySink(object):
+    """ Writes each envelope into a file of its own in `path`, named after its index by `name_pattern`. """
+
+    def __init__(self, path, name_pattern="%08d.xml"):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.name_pattern = name_pattern
+        self.count = 0
+
+    def write(self, data):
+        with open(os.path.join(self.path, self.name_pattern % self.count), "wb") as fp:
+            fp.write(data)
+        self.count += 1
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class BulkStats(object):
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.start = time.time()
+        self.duration = 0.0
+
+    def add(self, count, size):
+        self.count += count
+        self.bytes += size
+        self.duration = time.time() - self.start
+
+    def _get_per_second(self):
+        return (self.count / self.duration if self.duration else 0.0)
+
+    per_second = property(_get_per_second)
+
+    def _get_bytes_per_second(self):
+        return (self.bytes / self.duration if self.duration else 0.0)
+
+    bytes_per_second = property(_get_bytes_per_second)
+
+    def as_dict(self):
+        return {
+            "count": self.count, "bytes": self.bytes, "duration": self.duration,
+            "per_second": self.per_second, "bytes_per_second": self.bytes_per_second,
+        }
+
+    def describe(self):
+        return "%d envelopes, %d bytes in %.2f s (%.0f/s, %.1f MB/s)" % (
+            self.count, self.bytes, self.duration, self.per_second, self.bytes_per_second / 1048576
+        )
+
+    def __str__(self):
+        return "<BulkStats %s>" % self.describe()
+
+
+def _chunks(records, size):
+    records = iter(records)
+    while True:
+        chunk = list(itertools.islice(records, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def write_envelopes(operation, records, sink, processes=None, chunk_size=500, progress=None, compiled=True):
+    """
+    Write a request envelope for each of `records` to `sink`, in order.
+
+    :param operation: A `WrappedOperation`, e.g. `ctx.service.SubmitOrder`.
+    :param sink: A `StreamSink`, `FileSink`, `DirectorySink` or anything else with `write(data)`.
+    :param processes: Number of worker processes to marshal in, or None to do it in this one.
+                      Workers are forked, so they share the parsed WSDL instead of receiving it
+                      pickled; records are sent to them pickled, `chunk_size` at a time.
+    :param progress: Called with the `BulkStats` after each chunk.
+    :param compiled: See `EnvelopeWriter`.
+    :return: `BulkStats`
+    """
+    writer = EnvelopeWriter(operation.port, operation.operation, compiled)
+    stats = BulkStats()
+    chunks = _chunks(records, chunk_size)
+    pool = None
+    if processes:
+        import multiprocessing  # Deferred; rarely needed
+        pool = multiprocessing.Pool(processes, initializer=_set_pool_writer, initargs=(writer,))
+        envelope_chunks = pool.imap(_envelope_chunk, chunks)
+    else:
+        envelope_chunks = ([writer.envelope(record) for record in chunk] for chunk in chunks)
+    try:
+        for envelopes in envelope_chunks:
+            for data in envelopes:
+                sink.write(data)
+            stats.add(len(envelopes), sum(len(data) for data in envelopes))
+            if progress:
+                progress(stats)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    logger.debug("Bulk %s: %s", operation.operation.name, stats.describe())
+    return stats
@@ -0,0 +1,458 @@
+"""
+Ahead-of-time generation of client modules from WSDLs.
+
+A generated module has a slotted record class per complex type, straight-line marshal and
+unmarshal functions per message and a `Client` class with a method per operation. Importing
+it doesn't involve any WSDL parsing, and it writes the same request XML as the dynamic path.
+
+Usage: python -m foamy.codegen [-o client.py] service.wsdl
+"""
+from foamy.basic_types import BASIC_TYPES, BooleanType, DateTimeType, DoubleType, FloatType, IntegerType, LongType, UnicodeType
+from foamy.records import identifier, slot_names
+from foamy.types import ComplexAllType, ComplexSequenceType, SimpleType, Type
+import argparse
+import contextlib
+import os
+import sys
+
+# Inline conversions for the most common basic types; others call the basic type objects
+MARSHAL_EXPRESSIONS = {
+    UnicodeType: "unicode(%s)",
+    IntegerType: "unicode(int(%s))",
+    LongType: "unicode(int(%s))",
+    BooleanType: '("true" if bool(%s) else "false")',
+    FloatType: "unicode(float(%s))",
+    DoubleType: "unicode(float(%s))",
+    DateTimeType: '%s.isoformat("T")',
+}
+
+UNMARSHAL_EXPRESSIONS = {
+    UnicodeType: "unicode(%s)",
+    IntegerType: "int(%s)",
+    LongType: "int(%s)",
+    BooleanType: '(unicode(%s).lower() == "true")',
+    FloatType: "float(%s)",
+    DoubleType: "float(%s)",
+}
+
+# Module-level names of generated modules that generated classes and functions mustn't shadow
+MODULE_NAMES = frozenset((
+    "BASIC_TYPES", "Client", "GeneratedClient", "GeneratedOperation", "MarshalValueError", "OPERATIONS", "Record",
+    "SubElement", "check_keys", "occurrences", "read_values", "set_attributes",
+))
+
+# Names `GeneratedClient` uses itself; operations can't be methods by these names
+CLIENT_ATTRIBUTES = frozenset(("call", "compression", "envelope_message", "location", "operations", "pretty_print", "transport", "unenvelope_message"))
+
+
+class _Writer(object):
+    def __init__(self):
+        self.lines = []
+        self.level = 0
+
+    def __call__(self, line=""):
+        self.lines.append(("    " * self.level + line) if line else "")
+
+    @contextlib.contextmanager
+    def block(self, line):
+        self(line)
+        self.level += 1
+        yield
+        self.level -= 1
+
+
+class ModuleGenerator(object):
+    def __init__(self, context, source=None):
+        self.context = context
+        self.source = source
+        self.names = set(MODULE_NAMES)
+        self.classes = []  # Lists of lines
+        self.functions = []
+        self.basic_names = {}  # id(basic type) -> module-level name
+        self.basic_qnames = dict((id(type), qname) for (qname, type) in BASIC_TYPES.iteritems())
+        self.record_classes = {}  # id(type) -> (class name, {key: slot})
+        self.element_functions = {}  # id(type) -> name
+        self.content_functions = {}
+        self.unmarshal_functions = {}
+        self.message_functions = {}  # (id(message), style, direction) -> name
+
+    def unique(self, name):
+        name = identifier(name)
+        candidate = name
+        n = 1
+        while candidate in self.names:
+            n += 1
+            candidate = "%s_%d" % (name, n)
+        self.names.add(candidate)
+        return candidate
+
+    # Type classification
+
+    def is_text_base(self, base):
+        """ Whether a base type marshals to text (instead of an element whose content is adopted). """
+        return (base is None or not isinstance(base, Type) or isinstance(base, SimpleType))
+
+    def is_leaf(self, type):
+        """ Whether an element type is just text, with no attributes or children. """
+        if isinstance(type, SimpleType):
+            return True
+        return (type.__class__ is Type and not type.attributes and self.is_text_base(type.base))
+
+    def resolve_basic(self, type):
+        while isinstance(type, SimpleType):
+            type = type.base
+        return type
+
+    def basic_name(self, type):
+        name = self.basic_names.get(id(type))
+        if name is None:
+            name = self.basic_names[id(type)] = self.unique("_%s" % type.__class__.__name__)
+        return name
+
+    def marshal_text(self, base, var):
+        """ :return: An expression for the text `base` marshals `var` into, or None for no text. """
+        basic = self.resolve_basic(base)
+        if basic is None:
+            return None
+        template = MARSHAL_EXPRESSIONS.get(basic.__class__)
+        if template:
+            return template % var
+        return "%s.marshal(%s)" % (self.basic_name(basic), var)
+
+    def unmarshal_text(self, base, var):
+        basic = self.resolve_basic(base)
+        if basic is None:
+            return "None"
+        template = UNMARSHAL_EXPRESSIONS.get(basic.__class__)
+        if template:
+            return template % var
+        return "%s.unmarshal(%s)" % (self.basic_name(basic), var)
+
+    # Record classes
+
+    def record_class(self, type):
+        entry = self.record_classes.get(id(type))
+        if entry:
+            return entry
+        keys = ["_%s" % attr_name for attr_name in type.attributes]
+        if type.base is not None:
+            keys.append("$")
+        for child in self.children(type):
+            if child.name not in keys:
+                keys.append(child.name)
+        fields = zip(keys, slot_names(keys))
+
+        class_name = self.unique(type.name)
+        entry = self.record_classes[id(type)] = (class_name, dict(fields))
+        w = _Writer()
+        with w.block("class %s(Record):" % class_name):
+            w("__slots__ = (%s)" % "".join("%r, " % slot for (key, slot) in fields))
+            w("_keys = (%s)" % "".join("(%r, %r), " % field for field in fields))
+            w("_slot_by_key = dict(_keys)")
+        self.classes.append(w.lines)
+        for child in self.children(type):
+            self.visit(child)
+        return entry
+
+    def children(self, type):
+        if isinstance(type, ComplexSequenceType):
+            return list(type.sequence)
+        elif isinstance(type, ComplexAllType):
+            return list(type.all)
+        return []
+
+    def visit(self, type):
+        """ Make sure record classes exist for `type` and the types nested within it. """
+        if not isinstance(type, Type) or isinstance(type, SimpleType):
+            return
+        if type.base is not None and not self.is_text_base(type.base):
+            self.visit(type.base)
+        elif not self.is_leaf(type):
+            self.record_class(type)
+
+    # Marshalling
+
+    def emit_element(self, w, type, parent, value):
+        if self.is_leaf(type):
+            expr = self.marshal_text(type if isinstance(type, SimpleType) else type.base, value)
+            if expr is None:
+                w("SubElement(%s, %r)" % (parent, type.qname))
+            else:
+                w("SubElement(%s, %r).text = %s" % (parent, type.qname, expr))
+        else:
+            w("%s(%s, %s)" % (self.element_function(type), parent, value))
+
+    def emit_content(self, w, type, el, obj):
+        if type.base is not None:
+            if self.is_text_base(type.base):
+                expr = self.marshal_text(type.base, obj)
+                if expr:
+                    w("%s.text = %s" % (el, expr))
+            else:  # A named complex type; adopt its content
+                w("%s(%s, %s)" % (self.content_function(type.base), el, obj))
+        if type.attributes:
+            w("set_attributes(%s, %s, %r)" % (el, obj, tuple(type.attributes)))
+        if isinstance(type, ComplexSequenceType):
+            self.emit_type_list(w, type, type.sequence, el, obj, True)
+        elif isinstance(type, ComplexAllType):
+            w("check_keys(%s, %r)" % (obj, frozenset(type.all.keys)))
+            self.emit_type_list(w, type, type.all, el, obj, False)
+
+    def emit_type_list(self, w, parent, type_list, el, obj, check_max):
+        w("vals = read_values(%s, %r)" % (obj, tuple(type_list.keys)))
+        for type in type_list:
+            with w.block("if %r in vals:" % type.name):
+                if type.max_occurs == 1 and type.min_occurs <= 1:
+                    with w.block("if isinstance(vals[%r], (list, tuple)) or hasattr(vals[%r], \"next\"):" % (type.name, type.name)):
+                        self.emit_repeated(w, parent, type, el, check_max)
+                    with w.block("else:"):
+                        self.emit_element(w, type, el, "vals[%r]" % type.name)
+                else:
+                    self.emit_repeated(w, parent, type, el, check_max)
+            if type.nillable:
+                with w.block("else:"):
+                    self.emit_element(w, type, el, "None")
+            elif type.min_occurs > 0:
+                with w.block("else:"):
+                    w("raise MarshalValueError(%r)" % (
+                        "Value %s:%s is required (min_occurs %d), but no value could be found." % (parent.name, type.name, type.min_occurs)
+                    ))
+
+    def emit_repeated(self, w, parent, type, el, check_max):
+        with w.block("for value in occurrences(vals[%r], %d, %d, %r, %r):" % (
+            type.name, type.min_occurs, type.max_occurs, check_max, "%s:%s" % (parent.name, type.name)
+        )):
+            self.emit_element(w, type, el, "value")
+
+    def element_function(self, type):
+        name = self.element_functions.get(id(type))
+        if name:
+            return name
+        name = self.element_functions[id(type)] = self.unique("_m_%s" % type.name)
+        w = _Writer()
+        with w.block("def %s(parent, obj):" % name):
+            w("el = SubElement(parent, %r)" % type.qname)
+            self.emit_content(w, type, "el", "obj")
+        self.functions.append(w.lines)
+        return name
+
+    def content_function(self, type):
+        name = self.content_functions.get(id(type))
+        if name:
+            return name
+        name = self.content_functions[id(type)] = self.unique("_c_%s" % type.name)
+        w = _Writer()
+        with w.block("def %s(el, obj):" % name):
+            self.emit_content(w, type, "el", "obj")
+            if len(w.lines) == 1:
+                w("pass")
+        self.functions.append(w.lines)
+        return name
+
+    def message_marshal_function(self, message, style):
+        key = (id(message), style, "in")
+        name = self.message_functions.get(key)
+        if name:
+            return name
+        name = self.message_functions[key] = self.unique("_marshal_%s" % message.name)
+        w = _Writer()
+        with w.block("def %s(body, message):" % name):
+            if style == "rpc":
+                w("wrapper = SubElement(body, %r)" % message.qname)
+            else:
+                w("wrapper = body")
+            if len(message.parts) > 1:
+                with w.block("if not isinstance(message, dict):"):
+                    w("raise TypeError(\"Input must be dict when marshalling multipart messages (got %r)\" % message)")
+                for part_name, type in message.parts:
+                    with w.block("if %r not in message:" % part_name):
+                        w("raise ValueError(%r)" % ("While marshalling multipart message: Missing part %r" % part_name))
+                    w("part = SubElement(wrapper, %r)" % ("{%s}%s" % (message.ns, part_name)))
+                    value = "message[%r]" % part_name
+                    if not isinstance(type, Type) or isinstance(type, SimpleType):
+                        expr = self.marshal_text(type, value)
+                    elif self.is_leaf(type):
+                        expr = self.marshal_text(type.base, value)
+                    else:
+                        expr = None
+                        w("%s(part, %s)" % (self.content_function(type), value))
+                    if expr:
+                        w("part.text = %s" % expr)
+            else:
+                part_name, type = message.parts[0]
+                self.emit_element(w, type, "wrapper", "message")
+        self.functions.append(w.lines)
+        return name
+
+    # Unmarshalling
+
+    def unmarshal_expr(self, type, node):
+        if not isinstance(type, Type):
+            return self.unmarshal_text(type, "(%s.text or \"\")" % node)  # Basic types unwrap elements like this
+        if self.is_leaf(type):
+            if isinstance(type, SimpleType):
+                return self.unmarshal_text(type, "%s.text" % node)
+            if type.base is None:
+                return "{}"
+            return self.unmarshal_text(type.base, "%s.text" % node)
+        return "%s(%s)" % (self.unmarshal_function(type), node)
+
+    def unmarshal_function(self, type):
+        if type.base is not None and not self.is_text_base(type.base):
+            return self.unmarshal_function(type.base)
+        name = self.unmarshal_functions.get(id(type))
+        if name:
+            return name
+        name = self.unmarshal_functions[id(type)] = self.unique("_u_%s" % type.name)
+        class_name, slot_by_key = self.record_class(type)
+        w = _Writer()
+        with w.block("def %s(node):" % name):
+            w("rec = %s()" % class_name)
+            for attr_name in type.attributes:
+                w("rec.%s = node.attrib.get(%r)" % (slot_by_key["_%s" % attr_name], attr_name))
+            if type.base is not None:
+                w("rec.%s = %s" % (slot_by_key["$"], self.unmarshal_text(type.base, "node.text")))
+            seen = set()
+            for child in self.children(type):
+                if child.name in seen:
+                    continue
+                seen.add(child.name)
+                w("child = node.find(%r)" % child.qname)
+                with w.block("if child is not None:"):
+                    w("rec.%s = %s" % (slot_by_key[child.name], self.unmarshal_expr(child, "child")))
+            w("return rec")
+        self.functions.append(w.lines)
+        return name
+
+    def message_unmarshal_function(self, message, style):
+        key = (id(message), style, "out")
+        name = self.message_functions.get(key)
+        if name:
+            return name
+        name = self.message_functions[key] = self.unique("_unmarshal_%s" % message.name)
+        w = _Writer()
+        with w.block("def %s(payload):" % name):
+            if style == "rpc":
+                w("payload = payload.getchildren()[0]")
+            if len(message.parts) > 1:
+                w("out = {}")
+                for part_name, type in message.parts:
+                    w("part = payload.find(%r)" % ("{%s}%s" % (message.ns, part_name)))
+                    w("out[%r] = (%s if part is not None else None)" % (part_name, self.unmarshal_expr(type, "part")))
+                w("return out")
+            else:
+                part_name, type = message.parts[0]
+                w("return %s" % self.unmarshal_expr(type, "payload"))
+        self.functions.append(w.lines)
+        return name
+
+    # Module
+
+    def find_operations(self):
+        """ :return: OrderedDict-like list of (name, port, operation); of the SOAP ports, later ones win. """
+        found = {}
+        order = []
+        for service in self.context.services.in_order():
+            for port in service.ports.in_order():
+                if port.binding.protocol == "soap":  # Generated clients only speak SOAP
+                    for operation in port.binding.port_type.operations.in_order():
+                        if operation.name not in found:
+                            order.append(operation.name)
+                        found[operation.name] = (port, operation)
+        return [(name,) + found[name] for name in order]
+
+    def write_definitions(self, w):
+        """ Write the imports, record classes and functions generated so far. """
+        w("from foamy.generated import GeneratedClient, GeneratedOperation, MarshalValueError, Record")
+        w("from foamy.generated import check_keys, occurrences, read_values, set_attributes")
+        w("from lxml.etree import SubElement")
+        if self.basic_names:
+            w("from foamy.basic_types import BASIC_TYPES")
+            w()
+            for type_id, name in sorted(self.basic_names.iteritems(), key=lambda item: item[1]):
+                w("%s = BASIC_TYPES[%r]" % (name, self.basic_qnames[type_id]))
+        for chunk in self.classes + self.functions:
+            w()
+            w()
+            for line in chunk:
+                w(line)
+
+    def generate(self):
+        for qname, type in sorted(self.context.types.iteritems()):
+            self.visit(type)
+
+        operations = []
+        for name, port, operation in self.find_operations():
+            opbind = port.binding.operation_bindings[operation]
+            style = opbind["style"]
+            marshal = (self.message_marshal_function(operation.input.message, style) if operation.input else "None")
+            unmarshal = (self.message_unmarshal_function(operation.output.message, style) if operation.output else "None")
+            operations.append((name, port, operation, opbind.get("soapAction"), marshal, unmarshal))
+
+        w = _Writer()
+        w("# -- encoding: UTF-8 --")
+        w("# Generated by foamy.codegen%s; don't edit." % (" from %s" % self.source if self.source else ""))
+        self.write_definitions(w)
+        w()
+        w()
+        with w.block("OPERATIONS = {"):
+            for name, port, operation, soap_action, marshal, unmarshal in operations:
+                w("%r: GeneratedOperation(%r, %r, %r, %s, %s)," % (name, name, soap_action, port.location, marshal, unmarshal))
+        w("}")
+        w()
+        w()
+        with w.block("class Client(GeneratedClient):"):
+            w("operations = OPERATIONS")
+            pretty_print = all(port.binding.pretty_print for (name, port, operation) in self.find_operations())
+            if not pretty_print:
+                w("pretty_print = False")
+            for name, port, operation, soap_action, marshal, unmarshal in operations:
+                method_name = identifier(name)
+                if method_name in CLIENT_ATTRIBUTES:
+                    continue  # Still available through `call`
+                w()
+                with w.block("def %s(self, *args, **kwargs):" % method_name):
+                    w('""" %s%s """' % (name, operation.signature))
+                    w("return self.call(%r, args, kwargs)" % name)
+        return "\n".join(w.lines) + "\n"
+
+
+def generate_module(context, source=None):
+    """ :return: Python source of a client module for the WSDL(s) read into `context`. """
+    return ModuleGenerator(context, source).generate()
+
+
+def compile_message_marshal(context, message, style):
+    """
+    Generate and compile just the marshal function for `message`, for callers that marshal
+    the same message many times (e.g. `foamy.bulk`) without writing out a module.
+
+    :return: A function (body element, message object) that appends the message's elements.
+    """
+    generator = ModuleGenerator(context)
+    name = generator.message_marshal_function(message, style)
+    w = _Writer()
+    generator.write_definitions(w)
+    scope = {}
+    exec compile("\n".join(w.lines) + "\n", "<foamy.codegen %s>" % name, "exec") in scope
+    return scope[name]
+
+
+def main(argv=None):
+    from foamy.context import Context
+    parser = argparse.ArgumentParser(description="Generate a client module from a WSDL.")
+    parser.add_argument("wsdl", help="WSDL file path or URL")
+    parser.add_argument("-o", "--output", help="Output file (default: standard output)")
+    args = parser.parse_args(argv)
+    context = Context()
+    context.read_wsdl_from_url(args.wsdl)
+    source = generate_module(context, os.path.basename(args.wsdl))
+    if args.output:
+        with open(args.output, "wb") as out_fp:
+            out_fp.write(source)
+    else:
+        sys.stdout.write(source)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import zlib
+
+ENCODINGS = ("gzip", "deflate")
+
+
+def _compressobj(encoding, level):
+    if encoding == "gzip":
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif encoding == "deflate":
+        return zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS)
+    raise ValueError("Unsupported content encoding %r" % encoding)
+
+
+def compress(data, encoding, level=6):
+    compressor = _compressobj(encoding, level)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_chunks(chunks, encoding, level=6):
+    compressor = _compressobj(encoding, level)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class Decoder(object):
+    """ Incremental decoder for a `Content-Encoding`. """
+
+    def __init__(self, encoding):
+        self.encoding = (encoding or "identity").strip().lower()
+        if self.encoding == "gzip":
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == "deflate":
+            self.decompressor = zlib.decompressobj(zlib.MAX_WBITS)
+            self.first_chunk = True
+        elif self.encoding == "identity":
+            self.decompressor = None
+        else:
+            raise ValueError("Unsupported content encoding %r" % encoding)
+
+    def decode(self, chunk):
+        if not self.decompressor:
+            return chunk
+        if self.encoding == "deflate" and self.first_chunk:
+            # Some servers send raw deflate streams without the zlib header; retry as such.
+            self.first_chunk = False
+            try:
+                return self.decompressor.decompress(chunk)
+            except zlib.error:
+                self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self.decompressor.decompress(chunk)
+
+    def flush(self):
+        return (self.decompressor.flush() if self.decompressor else "")
+
+
+def decode_chunks(chunks, encoding):
+    decoder = Decoder(encoding)
+    for chunk in chunks:
+        data = decoder.decode(chunk)
+        if data:
+            yield data
+    tail = decoder.flush()
+    if tail:
+        yield tail
+
+
+class Compression(object):
+    def __init__(self, encoding=None, threshold=1024, level=6, accept_encoding=ENCODINGS):
+        """
+        :param encoding: Content encoding ("gzip" or "deflate") for request bodies, or None to send them as-is.
+        :param threshold: Request bodies smaller than this many bytes are never compressed.
+                          Streamed request bodies are always compressed.
+        :param level: zlib compression level.
+        :param accept_encoding: Encodings to advertise for responses. Empty to ask for identity only.
+        """
+        if encoding and encoding not in ENCODINGS:
+            raise ValueError("Unsupported content encoding %r" % encoding)
+        self.encoding = encoding
+        self.threshold = threshold
+        self.level = level
+        self.accept_encoding = tuple(accept_encoding or ())
+
+    def apply(self, request):
+        request.headers["Accept-Encoding"] = (", ".join(self.accept_encoding) or "identity")
+        data = request.data
+        if self.encoding and isinstance(data, bytes) and len(data) >= self.threshold:
+            request.data = compress(data, self.encoding, self.level)
+            request.headers["Content-Encoding"] = self.encoding
+        elif self.encoding and data is not None and not isinstance(data, bytes):
+            request.data = compress_chunks(data, self.encoding, self.level)
+            request.headers["Content-Encoding"] = self.encoding
+        return request
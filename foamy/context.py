@@ -1,42 +1,107 @@
 from foamy.basic_types import BASIC_TYPES
+from foamy.deadline import Deadline
 from foamy.debugging import Dumper
+from foamy.excs import ConcurrencyLimitExceeded
 from foamy.loader import ResourceLoader
 from foamy.ns import COMMON_NAMESPACES as NS
-from foamy.objs import Response
-from foamy.registry import QNameRegistry
-from foamy.transport import RequestsTransport
-from foamy.wsdl import WSDLReader
+from foamy.objs import Response, RESULT_BYTES, RESULT_EAGER, RESULT_MODES
+from foamy.records import RECORD_DICT, RECORD_MODES
+from foamy.registry import Model
+from foamy.retry import is_replayable, send_hedged, send_with_retries
+from foamy.stats import OperationStats
+from foamy.wsdl import WSDLReader, find_dirty
+from foamy.xmlutils import XMLParsers
 from lxml.etree import tostring
+import collections
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
 
 
 class WrappedOperation(object):
+    # Keyword arguments that are call options instead of message parts, mapped to `dispatch` arguments
+    CALL_OPTIONS = {
+        "_result_mode": "result_mode",
+        "_stream_request": "stream_request",
+        "_timeout": "timeout",
+        "_deadline": "deadline",
+        "_fields": "fields",
+    }
+
     def __init__(self, context, port, operation):
         self.context = context
         self.port = port
         self.operation = operation
+        self.result_mode = None  # None: use the context's default
+        self.timeout = None  # Seconds per call; None: use the context's default
 
     def __call__(self, *args, **kwargs):
+        options = {}
+        for kwarg, option in self.CALL_OPTIONS.iteritems():
+            if kwarg in kwargs:
+                options[option] = kwargs.pop(kwarg)
+        options.setdefault("result_mode", self.result_mode)
+        options.setdefault("timeout", self.timeout)
+
         if kwargs:
             message = kwargs
         elif args:
             message = args[0]
         else:
             message = None
-        return self.context.dispatch(self.port, self.operation, message)
+        return self.context.dispatch(self.port, self.operation, message, **options)
+
+    def _get_idempotent(self):
+        return self.operation.idempotent
+
+    def _set_idempotent(self, value):
+        self.operation.idempotent = bool(value)
+
+    idempotent = property(_get_idempotent, _set_idempotent)
+
+    def _get_stats(self):
+        return self.context.get_stats(self.operation)
+
+    stats = property(_get_stats)
 
 
 class ServiceSelector(object):
-    def __init__(self, context):
+    def __init__(self, context, model=None):
         self.context = context
+        self.model = (model if model is not None else context.model)
         self.operation_cache = {}
         self.fill_operation_cache()
 
+    def get_binding_rank(self, binding):
+        """ Lower is better; bindings not named in `Context.binding_preference` come last. """
+        preference = self.context.binding_preference
+        ranks = [preference.index(name) for name in binding.preference_names if name in preference]
+        return (min(ranks) if ranks else len(preference))
+
     def fill_operation_cache(self):
-        for service in self.context.services.in_order():
+        ranks = {}
+        for service in self.model.services.in_order():
             for port in service.ports.in_order():
                 if port.binding.usable:
+                    rank = self.get_binding_rank(port.binding)
                     for operation in port.binding.port_type.operations.in_order():
-                        self.operation_cache[operation.name] = WrappedOperation(self.context, port, operation)
+                        if rank <= ranks.get(operation.name, rank):  # Among equals, later ports win
+                            ranks[operation.name] = rank
+                            self.operation_cache[operation.name] = WrappedOperation(self.context, port, operation)
+
+    def adopt(self, previous):
+        """ Take over the `WrappedOperation`s (and so their settings) of the selector of a reloaded model. """
+        for op_name, wop in self.operation_cache.items():
+            old = previous.operation_cache.get(op_name)
+            if old is None:
+                continue
+            if old.port is wop.port and old.operation is wop.operation:
+                self.operation_cache[op_name] = old
+            else:
+                wop.result_mode = old.result_mode
+                wop.timeout = old.timeout
 
     def __getattr__(self, op_name):
         res = self.operation_cache.get(op_name)
@@ -55,29 +120,223 @@ class ServiceSelector(object):
 
 
 class Context(object):
-    def __init__(self, transport=None, loader=None):
-        self.transport = transport or RequestsTransport()
-        self.loader = loader or ResourceLoader(self.transport)
-        self.types = QNameRegistry()
-        self.messages = QNameRegistry()
-        self.port_types = QNameRegistry()
-        self.bindings = QNameRegistry()
-        self.services = QNameRegistry()
+    def __init__(
+        self, transport=None, loader=None, compression=None, result_mode=RESULT_EAGER,
+        retry_policy=None, hedge_policy=None, limiter_factory=None, binding_preference=("soap", "http"),
+        timeout=None, record_mode=RECORD_DICT, parsers=None, strict=False, intern_types=True, reloadable=False
+    ):
+        if transport is None:
+            from foamy.transport import RequestsTransport  # Deferred; importing requests is slow
+            transport = RequestsTransport()
+        self.transport = transport
+        self.parsers = parsers or XMLParsers()  # For WSDLs and responses
+        self.loader = loader or ResourceLoader(self.transport, parsers=self.parsers)
+        self.compression = compression
+        self.result_mode = result_mode
+        self.retry_policy = retry_policy  # Only applied to idempotent operations
+        self.hedge_policy = hedge_policy  # Only applied to idempotent operations
+        self.limiter_factory = limiter_factory  # e.g. `AIMDLimiter`; called once per port
+        # Which binding `service` uses for operations offered by several: "soap", "http", "http-get" or "http-post"
+        self.binding_preference = tuple(binding_preference)
+        self.timeout = timeout  # Default budget in seconds for each call, retries included; None: no limit
+        if record_mode not in RECORD_MODES:
+            raise ValueError("Unknown record mode %r (expected one of %r)" % (record_mode, RECORD_MODES))
+        self.record_mode = record_mode  # What unmarshalled elements become for types without a registered class
+        self.record_classes = {}  # Element qname -> class to unmarshal into
+        self.record_classes_version = 0
+        # Check values against their types' enumerations and other facets when marshalling (`MarshalValueError`)
+        self.strict = strict
+        # Share one type between structurally identical element declarations (see `types.local_element_type`)
+        self.intern_types = intern_types
+        # Keep digests of the definitions read from the start, so even the first `reload` is incremental
+        self.reloadable = reloadable
+        self.urls = []  # Of the WSDLs read with `read_wsdl_from_url`, for `reload`
+        self.stats = {}
+        self.limiters = {}
+        self._stats_lock = threading.Lock()
+        self._model_lock = threading.Lock()
+        self.model = Model()
+        self._building = None  # The `Model` a reload is reading into
+
+    types = property(lambda self: self.model.types)
+    messages = property(lambda self: self.model.messages)
+    port_types = property(lambda self: self.model.port_types)
+    bindings = property(lambda self: self.model.bindings)
+    services = property(lambda self: self.model.services)
+
+    def _get_interned_types(self):
+        return (self._building or self.model).interned_types
+
+    interned_types = property(_get_interned_types)
+
+    def _get_sources(self):
+        """ What each WSDL document read is known as (its URL, or a name given to a tree), in the order read. """
+        return list(self.model.documents)
+
+    sources = property(_get_sources)
 
     def read_wsdl_from_url(self, url):
-        return self.read_wsdl_tree(self.loader.load_xml(url))
+        self.read_wsdl_tree(self.loader.load_xml(url), source=url)
+        self.urls.append(url)
+
+    def read_wsdl_tree(self, wsdl_tree, source=None):
+        """
+        :param source: What to call the document in `sources`; defaults to "<tree N>".
+        :return: The source name.
+        """
+        with self._model_lock:
+            if source is None:
+                source = "<tree %d>" % (len(self.model.documents) + 1)
+            if source in self.model.documents:
+                raise ValueError("%s has been read already; reload it instead" % source)
+            reader = WSDLReader(self, wsdl_tree, source=source)
+            reader.parse()
+            self.model.service = None
+        return source
+
+    def reload(self, urls=None):
+        """
+        Fetch the WSDLs at `urls` (by default, all the ones read with `read_wsdl_from_url`) again,
+        and swap what they define in for what they defined before.
+
+        Only definitions that changed, and those referring to them, are parsed again; the rest
+        are carried over as they are, with what was set on them (`idempotent`, settings of
+        `service` operations). Documents whose digest hasn't changed aren't gone through any
+        further. Telling what changed takes digests of the definitions last read, which a context
+        only keeps from the start if it's `reloadable`; otherwise the first reload parses everything.
+
+        Documents not reloaded keep their definitions, unless they refer to ones that changed;
+        those are fetched again too.
 
-    def read_wsdl_tree(self, wsdl_tree):
-        reader = WSDLReader(self, wsdl_tree)
-        reader.parse()
+        The new model is swapped in whole once it's built, so calls under way finish with the
+        objects they started with. Ports of services that were parsed again start afresh.
+
+        :return: The (kind, qname)s of the definitions parsed again, added or removed (see `wsdl.find_dirty`).
+        """
+        urls = list(self.urls if urls is None else urls)
+        if not urls:
+            raise ValueError("Nothing to reload: no WSDLs were read from URLs")
+        unknown = [url for url in urls if url not in self.urls]
+        if unknown:
+            raise ValueError("Not read with read_wsdl_from_url, so can't be reloaded: %s" % ", ".join(unknown))
+
+        def fetch(url):
+            return self.loader.load_xml(url, refresh=True)
+
+        return self._reload(collections.OrderedDict((url, fetch(url)) for url in urls), fetch)
+
+    def reload_trees(self, wsdl_trees, sources=None):
+        """
+        Like `reload`, with WSDL documents already parsed.
+
+        :param sources: The `sources` the documents replace, one each; by default all of them, in order.
+        """
+        sources = (self.sources if sources is None else list(sources))
+        if len(sources) != len(wsdl_trees):
+            raise ValueError("Expected a document for each of %s" % ", ".join(sources))
+        return self._reload(collections.OrderedDict(zip(sources, wsdl_trees)), None)
+
+    def _find_stale(self, previous, changed, dirty):
+        """ :return: The sources of documents carried over whose definitions may refer to `dirty` ones. """
+        stale = []
+        if not dirty:
+            return stale
+        reloaded = False
+        for source, document in previous.documents.iteritems():
+            if source in changed:
+                reloaded = True
+            elif reloaded:  # Documents can only refer to ones read before them
+                for key in document.keys:
+                    references = previous.definitions[key][2]
+                    if references is None or not references.isdisjoint(dirty):
+                        stale.append(source)
+                        break
+                else:
+                    if document.objects and not document.keys:  # Nothing recorded to tell by
+                        stale.append(source)
+        return stale
+
+    def _reload(self, trees, fetch):
+        """
+        :param trees: Source -> new document, for the documents to reload.
+        :param fetch: Called with the source of a document to get it afresh, or None if that can't be done.
+        """
+        with self._model_lock:
+            start = time.time()
+            previous = self.model
+            unknown = [source for source in trees if source not in previous.documents]
+            if unknown:
+                raise ValueError("Not read before, so can't be reloaded: %s" % ", ".join(unknown))
+            model = Model()
+            readers = {}
+            while True:
+                for source, wsdl_tree in trees.iteritems():
+                    if source not in readers:
+                        readers[source] = WSDLReader(self, wsdl_tree, model, previous, source)
+                        readers[source].scan()
+                changed = dict((source, reader) for (source, reader) in readers.iteritems() if not reader.unchanged)
+                dirty = find_dirty(changed.values(), previous)
+                stale = self._find_stale(previous, changed, dirty)
+                if not stale:
+                    break
+                for source in stale:
+                    if source in readers:  # Unchanged itself, so not gone through yet
+                        readers[source].scan(full=True)
+                    elif fetch is None:
+                        raise ValueError("%s may refer to definitions that changed; reload it too" % source)
+                    else:
+                        trees[source] = fetch(source)
+            dirty_types = set(qname for (kind, qname) in dirty if kind == "types")
+            # Interned types are only ever of the (type, ref) they were declared with; see `types.structural_key`
+            model.interned_types = dict(
+                (key, type) for (key, type) in previous.interned_types.iteritems()
+                if key[2] not in dirty_types and key[3] not in dirty_types
+            )
+            scan_time = time.time() - start
+            self._building = model
+            try:
+                for source, document in previous.documents.iteritems():
+                    reader = changed.get(source)
+                    if reader is not None:
+                        reader.dirty = dirty
+                        reader.parse()
+                    else:
+                        model.documents[source] = document
+                        for kind, obj in document.objects:
+                            getattr(model, kind).register(obj)
+                        for key in document.keys:
+                            model.definitions.setdefault(key, previous.definitions[key])
+            finally:
+                self._building = None
+            model.service = ServiceSelector(self, model)
+            if previous.service is not None:
+                model.service.adopt(previous.service)
+            self.model = model
+        logger.info(
+            "Reload: %s changed, %d definitions parsed again in %.1f ms (%.1f ms scanning)",
+            (", ".join(changed) or "nothing"), len(dirty), (time.time() - start) * 1000, scan_time * 1000
+        )
+        return dirty
 
     def resolve_type(self, qname):
-        type = self.types.get(qname) or BASIC_TYPES.get(qname)
+        type = (self._building or self.model).types.get(qname) or BASIC_TYPES.get(qname)
         if type:
             return type
         else:
             raise KeyError("Type '%s' is not known to this context." % qname)
 
+    def register_record_class(self, qname, cls):
+        """
+        Unmarshal `qname` elements into instances of `cls` instead of dicts.
+
+        `cls` is called with the field values positionally: a `foamy.records.Record` subclass gets
+        them in its `_keys` order, other classes (such as namedtuples) in the order of their `_fields`
+        or `__slots__`, matched to result keys by name ("value" for "$", "attr_name" for "_name").
+        None goes back to the context's `record_mode` for `qname`.
+        """
+        self.record_classes[qname] = cls
+        self.record_classes_version += 1  # Invalidates the types' cached record plans
+
     def _dump(self, dumper, with_service=False):
         for kind, source in (
             ("types", self.types),
@@ -103,15 +362,129 @@ class Context(object):
         return self._dump(Dumper(stream), with_service=with_service)
 
     def _get_service(self):
-        return ServiceSelector(self)
+        # Cached so per-operation settings on the `WrappedOperation`s stick
+        model = self.model
+        if model.service is None:
+            model.service = ServiceSelector(self, model)
+        return model.service
 
     service = property(_get_service)
 
-    def dispatch(self, port, operation, message):
-        req = port.envelope_message(message, operation)
-        resp = self.transport.dispatch(req)
+    def dispatch(
+        self, port, operation, message, result_mode=None, stream_request=None, timeout=None, deadline=None, fields=None
+    ):
+        """
+        :param timeout: Seconds the whole call may take; defaults to the context's `timeout`.
+        :param deadline: A `Deadline` to finish within instead, e.g. one shared with an enclosing call.
+        :param fields: A field path or several (see `foamy.projection`) to unmarshal instead of the whole
+                       response; streamed responses are pruned down to them while they're parsed.
+        """
+        result_mode = (result_mode or self.result_mode)
+        if result_mode not in RESULT_MODES:
+            raise ValueError("Unknown result mode %r (expected one of %r)" % (result_mode, RESULT_MODES))
+        projection = None
+        if fields is not None and operation.output:
+            if result_mode != RESULT_EAGER:
+                raise ValueError("Field projections only apply to the %r result mode, not %r" % (RESULT_EAGER, result_mode))
+            projection = port.binding.get_projection(operation, fields)
+        if deadline is None:
+            deadline = Deadline.from_timeout(timeout if timeout is not None else self.timeout)
+        if deadline is not None:
+            deadline.check("marshalling %s" % operation.name)
+        req = port.envelope_message(message, operation, stream_request)
+        req.deadline = deadline
+        req.parsers = self.parsers
+        if projection is not None:
+            req.keep = projection.document_keep
+        if result_mode == RESULT_BYTES:
+            req.stream = False  # The caller wants the body untouched, so don't have the transport parse it
+        resp = self.send(port, operation, req)
         if operation.output:
-            resp = port.unenvelope_message(resp.data, operation)
+            if result_mode == RESULT_BYTES:
+                return resp.data
+            resp = port.unenvelope_message(resp.get_body(), operation, resp.attachments, result_mode, projection)
             return resp
         else:
             return
+
+    def get_stats(self, operation):
+        stats = self.stats.get(operation)
+        if stats is None:
+            with self._stats_lock:
+                stats = self.stats.setdefault(operation, OperationStats(operation))
+        return stats
+
+    def get_limiter(self, port):
+        """ :return: The port's own `limiter` if set, otherwise one made by `limiter_factory` (or None). """
+        if port.limiter is not None:
+            return port.limiter
+        if self.limiter_factory is None:
+            return None
+        limiter = self.limiters.get(port)
+        if limiter is None:
+            with self._stats_lock:
+                limiter = self.limiters.get(port)
+                if limiter is None:
+                    limiter = self.limiters[port] = self.limiter_factory()
+        return limiter
+
+    def find_alternate_port(self, port):
+        """ Find another port with the same binding at a different address, if there is one. """
+        for service in self.services.in_order():
+            for other in service.ports.in_order():
+                if other.binding is port.binding and other.location != port.location:
+                    return other
+
+    def send(self, port, operation, request):
+        """
+        Send an enveloped request through the transport, applying the retry and hedge policies
+        and the concurrency limiter of the port each attempt goes to.
+        """
+        stats = self.get_stats(operation)
+        stats.increment("calls")
+        ports_by_url = {request.url: port}
+
+        def timed_dispatch(request):
+            limiter = self.get_limiter(ports_by_url.get(request.url, port))
+            if limiter is not None:
+                queue_timeout = limiter.queue_timeout
+                if request.deadline is not None:
+                    remaining = request.deadline.check("queueing for %s" % request.url)
+                    queue_timeout = (min(queue_timeout, remaining) if queue_timeout is not None else remaining)
+                try:
+                    limiter.acquire(queue_timeout)
+                except ConcurrencyLimitExceeded:
+                    if request.deadline is not None:
+                        request.deadline.check("a slot for %s freed up" % request.url)
+                    raise
+            start = time.time()
+            try:
+                response = self.transport.dispatch(request)
+            except Exception as exc:
+                if limiter is not None:
+                    limiter.release(time.time() - start, failed=limiter.is_overload(exc))
+                raise
+            latency = time.time() - start
+            if limiter is not None:
+                limiter.release(latency)
+            stats.latency.record(latency)
+            return response
+
+        send = timed_dispatch
+        if operation.idempotent and self.hedge_policy and is_replayable(request):
+            hedge_delay = self.hedge_policy.get_delay(stats)
+            if hedge_delay is not None:
+                alternate = self.find_alternate_port(port)
+                alternate_url = None
+                if alternate:  # Keep whatever the binding added to the location (HTTP paths, query strings)
+                    alternate_url = alternate.location + request.url[len(port.location):]
+                if alternate:
+                    ports_by_url[alternate_url] = alternate
+
+                def hedged_dispatch(request):
+                    return send_hedged(timed_dispatch, request, alternate_url, hedge_delay, stats)
+
+                send = hedged_dispatch
+
+        retry_policy = (self.retry_policy if operation.idempotent else None)
+        return send_with_retries(send, request, retry_policy, stats)
@@ -0,0 +1,161 @@
+"""
+Deadlines: a time budget for a whole call, shared by marshalling, queueing, every attempt and backoff.
+"""
+from foamy.excs import DeadlineExceeded
+import heapq
+import itertools
+import socket
+import threading
+import time
+
+
+class Deadline(object):
+    def __init__(self, timeout):
+        """ :param timeout: Seconds from now. """
+        self.timeout = timeout
+        self.expires_at = time.time() + timeout
+
+    @classmethod
+    def from_timeout(cls, timeout):
+        return (cls(timeout) if timeout is not None else None)
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.time())
+
+    def _get_expired(self):
+        return (time.time() >= self.expires_at)
+
+    expired = property(_get_expired)
+
+    def check(self, doing):
+        """
+        :param doing: What was about to happen, for the error message.
+        :return: The remaining seconds.
+        :raises DeadlineExceeded: if none are left.
+        """
+        remaining = self.expires_at - time.time()
+        if remaining <= 0:
+            raise DeadlineExceeded("Deadline of %.3f s exceeded before %s" % (self.timeout, doing), self)
+        return remaining
+
+    def iter_checked(self, chunks, doing):
+        """ Pass `chunks` through, checking the deadline before each one. """
+        for chunk in chunks:
+            self.check(doing)
+            yield chunk
+
+    def watch(self, doing):
+        """
+        :param doing: What the sockets are used for, for the error message.
+        :return: A `SocketWatch` for the sockets of the call; a context manager.
+        """
+        return SocketWatch(self, doing)
+
+    def __repr__(self):
+        return "<Deadline %.3f s, %.3f s left>" % (self.timeout, self.remaining())
+
+
+class SocketWatch(object):
+    """
+    Shuts down the sockets `add`ed to it when its deadline passes while it is entered.
+
+    Socket timeouts only bound each read or write, so a server trickling out a response
+    (or slowly taking in a request) could otherwise hold a call for any time at all.
+    Leaving the watch after it fired raises `DeadlineExceeded`, as what was read may be cut short.
+    """
+
+    def __init__(self, deadline, doing):
+        self.deadline = deadline
+        self.doing = doing
+        self.sockets = []
+        self.active = False
+        self.fired = False
+        self.lock = threading.Lock()
+
+    def add(self, sock):
+        with self.lock:
+            if self.fired:
+                _shutdown(sock)
+            elif sock not in self.sockets:
+                self.sockets.append(sock)
+
+    def fire(self):
+        with self.lock:
+            if not self.active:
+                return
+            self.fired = True
+            for sock in self.sockets:
+                _shutdown(sock)
+
+    def __enter__(self):
+        self.active = True
+        _watchdog.add(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self.lock:
+            self.active = False
+            del self.sockets[:]
+        if self.fired:
+            raise DeadlineExceeded("Deadline of %.3f s exceeded while %s" % (self.deadline.timeout, self.doing), self.deadline)
+
+
+class _NoWatch(object):
+    """ Stands in for a `SocketWatch` for calls without a deadline. """
+
+    def add(self, sock):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+NO_WATCH = _NoWatch()
+
+
+def watch_sockets(deadline, doing):
+    """ :return: `deadline.watch(doing)`, or `NO_WATCH` if `deadline` is None. """
+    return (deadline.watch(doing) if deadline is not None else NO_WATCH)
+
+
+def _shutdown(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except (socket.error, AttributeError):  # Already closed
+        pass
+
+
+class _Watchdog(object):
+    """ A single thread firing `SocketWatch`es as their deadlines pass, soonest first. """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.heap = []  # (expires_at, sequence, watch)
+        self.sequence = itertools.count()
+        self.thread = None
+
+    def add(self, watch):
+        with self.cond:
+            heapq.heappush(self.heap, (watch.deadline.expires_at, next(self.sequence), watch))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="foamy deadline watchdog")
+                self.thread.daemon = True
+                self.thread.start()
+            elif self.heap[0][2] is watch:  # Sooner than what the thread is waiting for
+                self.cond.notify()
+
+    def run(self):
+        with self.cond:
+            while True:
+                now = time.time()
+                while self.heap and (self.heap[0][0] <= now or not self.heap[0][2].active):
+                    expires_at, _, watch = heapq.heappop(self.heap)
+                    if expires_at <= now:
+                        watch.fire()
+                self.cond.wait(self.heap[0][0] - now if self.heap else None)
+
+
+_watchdog = _Watchdog()
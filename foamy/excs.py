@@ -8,3 +8,34 @@ class XMLValueError(ValueError):
 
     def __str__(self):
         return "%s [\n%s\n]" % (self.message, tostring(self.node, pretty_print=True))
+
+
+class TransportError(Exception):
+    """ The transport couldn't complete a request. """
+
+
+class ConnectionFailed(TransportError):
+    """ Connecting to the server failed, or the connection broke or timed out mid-request. """
+
+
+class HTTPError(TransportError):
+    def __init__(self, message, response):
+        self.response = response
+        self.code = response.code
+        TransportError.__init__(self, message)
+
+
+class ConcurrencyLimitExceeded(TransportError):
+    """ The port's concurrency limiter rejected a call instead of queueing it. """
+
+    def __init__(self, message, limiter):
+        self.limiter = limiter
+        TransportError.__init__(self, message)
+
+
+class DeadlineExceeded(TransportError):
+    """ The call's deadline passed before it could complete. Never retried. """
+
+    def __init__(self, message, deadline):
+        self.deadline = deadline
+        TransportError.__init__(self, message)
@@ -0,0 +1,119 @@
+"""
+Restriction facets compiled into validators, so that a `Context(strict=True)` rejects
+invalid values while marshalling instead of having the server fault on them.
+"""
+from foamy.types import MarshalValueError, SimpleType
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+BOUNDS = (
+    ("minInclusive", lambda value, bound: value >= bound, ">="),
+    ("maxInclusive", lambda value, bound: value <= bound, "<="),
+    ("minExclusive", lambda value, bound: value > bound, ">"),
+    ("maxExclusive", lambda value, bound: value < bound, "<"),
+)
+LENGTHS = (
+    ("length", lambda length, limit: length == limit, "exactly"),
+    ("minLength", lambda length, limit: length >= limit, "at least"),
+    ("maxLength", lambda length, limit: length <= limit, "at most"),
+)
+
+
+def basic_type(type):
+    """ The basic type a (chain of) simple type(s) restricts. """
+    while isinstance(type, SimpleType):
+        type = type.base
+    return type
+
+
+def count_digits(text):
+    """ :return: (total digits, fraction digits) of a decimal number's text, ignoring insignificant zeroes. """
+    integer, _, fraction = text.strip().lstrip("+-").partition(".")
+    integer = integer.lstrip("0")
+    fraction = fraction.rstrip("0")
+    return len(integer) + len(fraction), len(fraction)
+
+
+def compile_pattern(type, patterns):
+    """
+    Compile `pattern` facets (alternatives, if there are several) into a regex matching whole values.
+
+    XSD regexes are close enough to Python's for what WSDLs use in practice; ones that don't
+    compile (e.g. using `\\i` or `\\p{...}`) aren't checked.
+    """
+    try:
+        return re.compile("(?:%s)\\Z" % "|".join("(?:%s)" % pattern for pattern in patterns), re.UNICODE)
+    except re.error as exc:
+        logger.warning("%s: Not checking pattern %r: %s", type.name, patterns, exc)
+        return None
+
+
+def compile_validator(type):
+    """
+    :return: A function (value, marshalled text) raising `MarshalValueError` for values
+             `type`'s facets don't allow, or None if there's nothing to check.
+    """
+    checks = []
+    name = type.name
+    basic = basic_type(type)
+
+    if type.restriction:
+        allowed = frozenset(type.base.marshal(value) for value in type.restriction)
+
+        def check_enumeration(obj, text):
+            if text not in allowed:
+                raise MarshalValueError("%s: %r is not one of the %d allowed values" % (name, obj, len(allowed)))
+        checks.append(check_enumeration)
+
+    facets = type.facets
+    if facets.get("pattern"):
+        regex = compile_pattern(type, facets["pattern"])
+        if regex is not None:
+            patterns = " or ".join(facets["pattern"])
+
+            def check_pattern(obj, text):
+                if not regex.match(text):
+                    raise MarshalValueError("%s: %r doesn't match %s" % (name, obj, patterns))
+            checks.append(check_pattern)
+
+    for facet, test, description in LENGTHS:
+        if facet in facets:
+            limit = int(facets[facet])
+
+            def check_length(obj, text, facet=facet, test=test, description=description, limit=limit):
+                length = len(obj if isinstance(obj, basestring) else text)  # Octets for binary values
+                if not test(length, limit):
+                    raise MarshalValueError("%s: %r has length %d; %s %d allowed" % (name, obj, length, description, limit))
+            checks.append(check_length)
+
+    bounds = [(facet, test, symbol, basic.unmarshal(facets[facet])) for (facet, test, symbol) in BOUNDS if facet in facets]
+    if bounds:
+        def check_bounds(obj, text):
+            value = basic.unmarshal(text)
+            for facet, test, symbol, bound in bounds:
+                if not test(value, bound):
+                    raise MarshalValueError("%s: %r must be %s %s" % (name, obj, symbol, bound))
+        checks.append(check_bounds)
+
+    if "totalDigits" in facets or "fractionDigits" in facets:
+        max_total = int(facets.get("totalDigits", 0)) or None
+        max_fraction = (int(facets["fractionDigits"]) if "fractionDigits" in facets else None)
+
+        def check_digits(obj, text):
+            total, fraction = count_digits(text)
+            if max_total is not None and total > max_total:
+                raise MarshalValueError("%s: %r has more than %d digits" % (name, obj, max_total))
+            if max_fraction is not None and fraction > max_fraction:
+                raise MarshalValueError("%s: %r has more than %d fraction digits" % (name, obj, max_fraction))
+        checks.append(check_digits)
+
+    if not checks:
+        return None
+    if len(checks) == 1:
+        return checks[0]
+
+    def validate(obj, text):
+        for check in checks:
+            check(obj, text)
+    return validate
@@ -0,0 +1,171 @@
+"""
+Load many WSDLs at once into a context each, for gateways that talk to lots of services.
+
+Fetching, parsing and building the models happen on a pool of threads. WSDLs with the
+same content (e.g. one service deployed at several addresses) are parsed only once; each
+still gets a context of its own, since types are bound to their context. All contexts share
+one transport, XML parser set and resource loader, and the basic XSD types are shared by
+every context anyway.
+"""
+from foamy.context import Context
+from foamy.loader import ResourceLoader
+from foamy.xmlutils import XMLParsers
+from multiprocessing.pool import ThreadPool
+import collections
+import hashlib
+import logging
+import threading
+import time
+try:
+    from cStringIO import StringIO
+except:
+    from StringIO import StringIO
+
+logger = logging.getLogger(__name__)
+
+
+class FleetMember(object):
+    """ How loading one WSDL went: its context or the exception, and where the time went. """
+
+    def __init__(self, url):
+        self.url = url
+        self.context = None
+        self.error = None
+        self.digest = None  # SHA-1 of the WSDL's content
+        self.shared = False  # Whether the parsed document came from another member with the same content
+        self.fetch_time = 0.0
+        self.parse_time = 0.0
+        self.build_time = 0.0
+
+    def _get_ok(self):
+        return (self.context is not None)
+
+    ok = property(_get_ok)
+
+    def _get_total_time(self):
+        return self.fetch_time + self.parse_time + self.build_time
+
+    total_time = property(_get_total_time)
+
+    def __repr__(self):
+        if self.ok:
+            state = "fetched in %.1f ms, parsed in %.1f ms%s, built in %.1f ms" % (
+                self.fetch_time * 1000, self.parse_time * 1000, (" (shared)" if self.shared else ""), self.build_time * 1000
+            )
+        else:
+            state = "failed: %s" % (self.error,)
+        return "<FleetMember %s %s>" % (self.url, state)
+
+
+class Fleet(object):
+    """ The result of `FleetLoader.load`; maps URLs of the WSDLs that loaded to their contexts. """
+
+    def __init__(self, members, duration):
+        self.members = members  # In the order the URLs were given
+        self.duration = duration
+        self.contexts = collections.OrderedDict((member.url, member.context) for member in members if member.ok)
+
+    def _get_failures(self):
+        return [member for member in self.members if not member.ok]
+
+    failures = property(_get_failures)
+
+    def __getitem__(self, url):
+        return self.contexts[url]
+
+    def __contains__(self, url):
+        return (url in self.contexts)
+
+    def __iter__(self):
+        return iter(self.contexts)
+
+    def __len__(self):
+        return len(self.contexts)
+
+    def describe(self):
+        total = sum(member.total_time for member in self.members)
+        return "%d/%d WSDLs loaded in %.2f s (%.2f s of work; %d documents shared)" % (
+            len(self.contexts), len(self.members), self.duration, total,
+            sum(1 for member in self.members if member.shared)
+        )
+
+    def __str__(self):
+        return "<Fleet %s>" % self.describe()
+
+
+class FleetLoader(object):
+    def __init__(self, threads=8, transport=None, cache=None, parsers=None, **context_kwargs):
+        """
+        :param threads: How many WSDLs to load at a time.
+        :param cache: The `ResourceCache` for the shared loader.
+        :param context_kwargs: Passed on to each `Context`.
+
+        Loading runs on threads rather than processes: fetching is I/O, lxml parses without
+        holding the GIL, and a built context couldn't be sent back from a worker process
+        for less than building it again.
+        """
+        if transport is None:
+            from foamy.transport import RequestsTransport  # Deferred; importing requests is slow
+            transport = RequestsTransport()
+        self.threads = threads
+        self.transport = transport
+        self.parsers = parsers or XMLParsers()
+        self.loader = ResourceLoader(transport, cache, self.parsers)
+        self.context_kwargs = context_kwargs
+        self.documents = {}  # Digest -> parsed WSDL
+        self.lock = threading.Lock()
+
+    def _parse(self, member, data):
+        member.digest = hashlib.sha1(data).hexdigest()
+        with self.lock:
+            tree = self.documents.get(member.digest)
+        if tree is not None:
+            member.shared = True
+            return tree
+        parsed = self.parsers.parse(StringIO(data))
+        with self.lock:
+            tree = self.documents.setdefault(member.digest, parsed)
+        member.shared = (tree is not parsed)  # Another thread parsed the same content meanwhile
+        return tree
+
+    def load_one(self, url):
+        """ Load the WSDL at `url`; exceptions are recorded in the returned `FleetMember` instead of raised. """
+        member = FleetMember(url)
+        try:
+            start = time.time()
+            data = self.loader.get(url)
+            member.fetch_time = time.time() - start
+            start = time.time()
+            tree = self._parse(member, data)
+            member.parse_time = time.time() - start
+            start = time.time()
+            context = Context(transport=self.transport, loader=self.loader, parsers=self.parsers, **self.context_kwargs)
+            context.read_wsdl_tree(tree, source=url)
+            context.urls.append(url)  # So that `context.reload()` fetches it again
+            member.build_time = time.time() - start
+            member.context = context
+        except Exception as exc:
+            logger.warning("Loading %s failed: %s", url, exc, exc_info=True)
+            member.error = exc
+        return member
+
+    def load(self, urls):
+        """
+        Load each of `urls` (duplicates are loaded once) into a context.
+
+        :return: `Fleet`; WSDLs that failed to load are in its `failures`.
+        """
+        urls = list(collections.OrderedDict.fromkeys(urls))
+        start = time.time()
+        if self.threads > 1 and len(urls) > 1:
+            pool = ThreadPool(min(self.threads, len(urls)))
+            try:
+                members = pool.map(self.load_one, urls, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            members = [self.load_one(url) for url in urls]
+        fleet = Fleet(members, time.time() - start)
+        logger.debug("Fleet: %s", fleet.describe())
+        return fleet
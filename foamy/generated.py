@@ -0,0 +1,121 @@
+"""
+Runtime support for client modules generated by `foamy.codegen`.
+"""
+from foamy.mtom import attachment_scope, replace_includes
+from foamy.ns import COMMON_NAMESPACES as NS
+from foamy.objs import BODY_TAG, ENVELOPE_TAG, HEADER_TAG, Request
+from foamy.records import Record
+from foamy.xmlutils import DEFAULT_PARSERS
+from foamy.types import MarshalValueError, read_object_values
+from lxml.etree import Element, SubElement, cleanup_namespaces, tostring
+
+
+def read_values(obj, keys):
+    """ Read field values for marshalling like `TypeList` does: positionally from a full-length sequence, or by key. """
+    if isinstance(obj, (list, tuple)) and len(obj) == len(keys):
+        return dict(zip(keys, obj))
+    return read_object_values(obj, keys)
+
+
+def occurrences(value, min_occurs, max_occurs, check_max, where):
+    """ Turn a field value into the sequence of values to marshal, checking occurrence limits like `TypeList` does. """
+    if not isinstance(value, (list, tuple)):
+        if hasattr(value, "next"):  # An iterator
+            return _iter_counted(value, min_occurs, max_occurs, check_max, where)
+        value = (value,)
+    if check_max and len(value) > max_occurs:
+        raise MarshalValueError("%s has max_occurs %d, but got %d values" % (where, max_occurs, len(value)))
+    if len(value) < min_occurs:
+        raise MarshalValueError("%s has min_occurs %d, but got %d values" % (where, min_occurs, len(value)))
+    return value
+
+
+def _iter_counted(values, min_occurs, max_occurs, check_max, where):
+    count = 0
+    for value in values:
+        count += 1
+        if check_max and count > max_occurs:
+            raise MarshalValueError("%s has max_occurs %d, but got more values" % (where, max_occurs))
+        yield value
+    if count < min_occurs:
+        raise MarshalValueError("%s has min_occurs %d, but got %d values" % (where, min_occurs, count))
+
+
+def check_keys(obj, allowed_keys):
+    if hasattr(obj, "keys"):
+        in_obj_not_allowed = (set(obj.keys()) - allowed_keys)
+        if in_obj_not_allowed:
+            raise ValueError("ComplexAllType marshalling: Object %r has extraneous keys (%r)" % (obj, sorted(in_obj_not_allowed)))
+
+
+def set_attributes(element, obj, names):
+    for key, value in read_object_values(obj, names).iteritems():
+        element.attrib[key] = value
+
+
+class GeneratedOperation(object):
+    __slots__ = ("name", "soap_action", "location", "marshal", "unmarshal")
+
+    def __init__(self, name, soap_action, location, marshal, unmarshal):
+        self.name = name
+        self.soap_action = soap_action
+        self.location = location
+        self.marshal = marshal  # Function (body element, message)
+        self.unmarshal = unmarshal  # Function (payload element) -> result, or None for one-way operations
+
+
+class GeneratedClient(object):
+    operations = {}  # Operation name -> GeneratedOperation
+    pretty_print = True
+
+    def __init__(self, transport=None, compression=None, location=None, parsers=None):
+        """
+        :param location: Address to use instead of the ones in the WSDL.
+        :param parsers: `foamy.xmlutils.XMLParsers` for responses; defaults to `DEFAULT_PARSERS`.
+        """
+        if transport is None:
+            from foamy.transport import RequestsTransport
+            transport = RequestsTransport()
+        self.transport = transport
+        self.compression = compression
+        self.location = location
+        self.parsers = parsers or DEFAULT_PARSERS
+
+    def envelope_message(self, op_name, message):
+        operation = self.operations[op_name]
+        envelope = Element(ENVELOPE_TAG, nsmap=dict(NS))
+        SubElement(envelope, HEADER_TAG)
+        body = SubElement(envelope, BODY_TAG)
+        operation.marshal(body, message)
+        cleanup_namespaces(envelope)
+        xml = tostring(envelope, pretty_print=self.pretty_print, encoding="UTF-8", xml_declaration=True)
+        request = Request(self.location or operation.location, {
+            "Content-type": "text/xml; charset=utf-8",
+            "SOAPAction": '"%s"' % operation.soap_action
+        }, xml)
+        if self.compression:
+            self.compression.apply(request)
+        return request
+
+    def unenvelope_message(self, op_name, response):
+        body = response.get_body()
+        tree = (body if hasattr(body, "tag") else self.parsers.fromstring(body))
+        payload = tree.find(BODY_TAG).getchildren()[0]
+        if response.attachments is not None:
+            replace_includes(payload)
+        with attachment_scope(response.attachments):
+            return self.operations[op_name].unmarshal(payload)
+
+    def call(self, op_name, args, kwargs):
+        if kwargs:
+            message = kwargs
+        elif args:
+            message = args[0]
+        else:
+            message = None
+        request = self.envelope_message(op_name, message)
+        request.parsers = self.parsers
+        response = self.transport.dispatch(request)
+        if self.operations[op_name].unmarshal is None:
+            return None
+        return self.unenvelope_message(op_name, response)
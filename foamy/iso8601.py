@@ -15,13 +15,23 @@ import re
 __all__ = ["parse_date", "ParseError"]
 
 # Adapted from http://delete.me.uk/2005/03/iso8601.html
-ISO8601_REGEX = re.compile(
+ISO8601_PATTERN = (
     r"(?P<year>[0-9]{4})(-(?P<month>[0-9]{1,2})(-(?P<day>[0-9]{1,2})"
     r"((?P<separator>.)(?P<hour>[0-9]{2}):(?P<minute>[0-9]{2})(:(?P<second>[0-9]{2})(\.(?P<fraction>[0-9]+))?)?"
     r"(?P<timezone>Z|(([-+])([0-9]{2}):([0-9]{2})))?)?)?)?"
 )
 
-TIMEZONE_REGEX = re.compile("(?P<prefix>[+-])(?P<hours>[0-9]{2}).(?P<minutes>[0-9]{2})")
+TIMEZONE_PATTERN = "(?P<prefix>[+-])(?P<hours>[0-9]{2}).(?P<minutes>[0-9]{2})"
+
+# foamy: compiled on first use, to keep importing cheap
+_regexes = {}
+
+
+def _compiled(pattern):
+    regex = _regexes.get(pattern)
+    if regex is None:
+        regex = _regexes[pattern] = re.compile(pattern)
+    return regex
 
 
 class ParseError(Exception):
@@ -74,7 +84,7 @@ def parse_timezone(tzstring, default_timezone=UTC):
     # Addresses issue 4.
     if tzstring is None:
         return default_timezone
-    m = TIMEZONE_REGEX.match(tzstring)
+    m = _compiled(TIMEZONE_PATTERN).match(tzstring)
     prefix, hours, minutes = m.groups()
     hours, minutes = int(hours), int(minutes)
     if prefix == "-":
@@ -93,7 +103,7 @@ def parse_date(datestring, default_timezone=UTC):
     """
     if not isinstance(datestring, basestring):
         raise ParseError("Expecting a string %r" % datestring)
-    m = ISO8601_REGEX.match(datestring)
+    m = _compiled(ISO8601_PATTERN).match(datestring)
     if not m:
         raise ParseError("Unable to parse date string %r" % datestring)
     groups = m.groupdict()
@@ -0,0 +1,99 @@
+from foamy.mtom import attachment_scope, current_attachments
+import collections
+
+# Field kinds for `LazyRecord`
+ATTRIBUTE = 0  # an XML attribute of the record's element
+TEXT = 1  # the text content of the record's element
+CHILD = 2  # the first child element with the given tag, omitted if missing
+PART = 3  # the first child element with the given tag, None if missing
+
+
+class LazyRecord(collections.Mapping):
+    """
+    A read-only mapping over a response element that unmarshals each field only when it's
+    first accessed, and caches the result. Fields are also available as attributes.
+
+    Keys are the same as the eager result dicts would have.
+    """
+    __slots__ = ("_node", "_fields", "_cache", "_attachments")
+
+    def __init__(self, node, fields):
+        """
+        :param fields: OrderedDict of key -> (kind, arg, type), where `arg` is the attribute
+                       name for ATTRIBUTE fields and the child tag for CHILD and PART fields.
+                       It's shared between all records of a type.
+        """
+        self._node = node
+        self._fields = fields
+        self._cache = {}
+        self._attachments = current_attachments()
+
+    def _convert(self, key):
+        kind, arg, type = self._fields[key]
+        if kind == ATTRIBUTE:
+            return self._node.attrib.get(arg)
+        elif kind == TEXT:
+            value = type.unmarshal(self._node.text)
+            if value is None:
+                raise KeyError(key)
+            return value
+        child = self._node.find(arg)
+        if child is None:
+            if kind == PART:
+                return None
+            raise KeyError(key)
+        return type.unmarshal_lazy(child)
+
+    def __getitem__(self, key):
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        if self._attachments is None:
+            value = self._convert(key)
+        else:
+            with attachment_scope(self._attachments):
+                value = self._convert(key)
+        self._cache[key] = value
+        return value
+
+    def __getattr__(self, key):
+        if key.startswith("__"):
+            raise AttributeError(key)
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def _is_present(self, key):
+        if key in self._cache:
+            return True
+        kind, arg, type = self._fields[key]
+        if kind in (ATTRIBUTE, PART):
+            return True
+        if kind == CHILD:  # Without converting it
+            return (self._node.find(arg) is not None)
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def __contains__(self, key):
+        return (key in self._fields and self._is_present(key))
+
+    def __iter__(self):
+        return (key for key in self._fields if self._is_present(key))
+
+    def __len__(self):
+        return sum(1 for key in self._fields if self._is_present(key))
+
+    def __repr__(self):
+        return "<LazyRecord %s (%d of %d fields converted)>" % (self._node.tag, len(self._cache), len(self._fields))
+
+    def to_dict(self):
+        """ Convert all fields, recursively, into plain dicts like the eager result mode does. """
+        out = {}
+        for key, value in self.iteritems():
+            out[key] = (value.to_dict() if isinstance(value, LazyRecord) else value)
+        return out
@@ -0,0 +1,137 @@
+"""
+Client-side concurrency limiting, so a struggling endpoint isn't buried under ever more parallel calls.
+"""
+from foamy.excs import ConcurrencyLimitExceeded, ConnectionFailed, HTTPError
+import threading
+import time
+
+OVERLOAD_STATUSES = frozenset((429, 502, 503, 504))
+
+
+class AIMDLimiter(object):
+    """
+    Additive-increase/multiplicative-decrease concurrency limiter.
+
+    The limit grows by one for each call that completes in good time while the limiter was
+    at least half used, and is cut by `backoff_ratio` whenever a call fails with an overload
+    signal (a connection failure or one of `OVERLOAD_STATUSES`) or takes longer than
+    `latency_tolerance` times the baseline latency (a slow-moving average of recent latencies,
+    so a sudden slowdown is caught while a permanently slower endpoint is eventually accepted).
+    The first `warmup` latencies only establish the baseline.
+
+    Calls over the limit wait in a queue of at most `max_queue` callers for at most
+    `queue_timeout` seconds; otherwise `ConcurrencyLimitExceeded` is raised.
+    """
+
+    def __init__(
+        self, initial_limit=10, min_limit=1, max_limit=200, backoff_ratio=0.9,
+        latency_tolerance=2.0, smoothing=0.01, warmup=10,
+        max_queue=None, queue_timeout=None
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_ratio = backoff_ratio
+        self.latency_tolerance = latency_tolerance
+        self.smoothing = smoothing  # Weight of each new latency in the baseline average
+        self.warmup = warmup
+        self.max_queue = max_queue  # None: unbounded
+        self.queue_timeout = queue_timeout  # None: wait forever
+        self.baseline = None
+        self._samples = 0
+        self._limit = float(initial_limit)
+        self._in_flight = 0
+        self._queued = 0
+        self._cond = threading.Condition(threading.Lock())
+
+    def _get_limit(self):
+        return max(self.min_limit, int(self._limit))
+
+    limit = property(_get_limit)
+
+    def _get_in_flight(self):
+        return self._in_flight
+
+    in_flight = property(_get_in_flight)
+
+    def _get_queued(self):
+        return self._queued
+
+    queued = property(_get_queued)
+
+    def try_acquire(self):
+        """ Take a slot without waiting. For callers that can't block, e.g. event loops. """
+        with self._cond:
+            if self._in_flight < self.limit:
+                self._in_flight += 1
+                return True
+            return False
+
+    def acquire(self, timeout=None):
+        """
+        Take a slot, waiting in the queue if necessary.
+
+        :param timeout: Seconds to wait at most; defaults to `queue_timeout`.
+        :raises ConcurrencyLimitExceeded: if the queue is full or the wait timed out.
+        """
+        timeout = (self.queue_timeout if timeout is None else timeout)
+        with self._cond:
+            if self._in_flight < self.limit:
+                self._in_flight += 1
+                return
+            if self.max_queue is not None and self._queued >= self.max_queue:
+                raise ConcurrencyLimitExceeded("Concurrency limit reached (%s)" % self.describe(), self)
+            deadline = (time.time() + timeout if timeout is not None else None)
+            self._queued += 1
+            try:
+                while self._in_flight >= self.limit:
+                    if deadline is None:
+                        self._cond.wait()
+                        continue
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise ConcurrencyLimitExceeded("Timed out waiting for a slot (%s)" % self.describe(), self)
+                    self._cond.wait(remaining)
+                self._in_flight += 1
+            finally:
+                self._queued -= 1
+
+    def release(self, latency=None, failed=False):
+        """
+        Give back a slot and adjust the limit.
+
+        :param latency: Duration of the call in seconds, or None if unknown (the limit is left alone).
+        :param failed: Whether the call failed in a way that suggests the endpoint is overloaded.
+        """
+        with self._cond:
+            in_flight = self._in_flight
+            self._in_flight -= 1
+            if failed or (latency is not None and self._is_slow(latency)):
+                self._limit = max(self.min_limit, self._limit * self.backoff_ratio)
+            elif latency is not None and in_flight * 2 >= self.limit:
+                self._limit = min(self.max_limit, self._limit + 1)
+            self._cond.notify_all()
+
+    def _is_slow(self, latency):
+        self._samples += 1
+        if self.baseline is None:
+            self.baseline = latency
+        if self._samples <= self.warmup:  # Plain mean until warmed up
+            self.baseline += (latency - self.baseline) / self._samples
+            return False
+        slow = (latency > self.baseline * self.latency_tolerance)
+        self.baseline += (latency - self.baseline) * self.smoothing
+        return slow
+
+    def is_overload(self, exc):
+        if isinstance(exc, ConnectionFailed):
+            return True
+        return (isinstance(exc, HTTPError) and exc.code in OVERLOAD_STATUSES)
+
+    def as_dict(self):
+        return {"limit": self.limit, "in_flight": self._in_flight, "queued": self._queued, "baseline": self.baseline}
+
+    def describe(self):
+        return "limit %d, %d in flight, %d queued" % (self.limit, self._in_flight, self._queued)
+
+    def __str__(self):
+        return "<AIMDLimiter %s>" % self.describe()
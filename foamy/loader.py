@@ -1,5 +1,5 @@
 from foamy.objs import Request
-from lxml import etree
+from foamy.xmlutils import DEFAULT_PARSERS
 import hashlib
 import os
 import tempfile
@@ -39,27 +39,42 @@ class ResourceCache(object):
             out_fp.write(data)
 
 
+class NullCache(object):
+    """ A `ResourceCache` stand-in that keeps nothing, so every resource is fetched afresh. """
+
+    def get_fp(self, key):
+        return None
+
+    def get(self, key):
+        return None
+
+    def put(self, key, data):
+        pass
+
+
 class ResourceLoader(object):
-    def __init__(self, transport, cache=None):
+    def __init__(self, transport, cache=None, parsers=None):
         self.transport = transport
         self.cache = cache or ResourceCache()
+        self.parsers = parsers or DEFAULT_PARSERS
 
     def _download(self, url):
         if "://" in url:  # XXX: Worst heuristic ever
-            data = self.transport.dispatch(Request(url)).data
+            return self.transport.dispatch(Request(url, stream=False)).data
         else:
             with file(url, "rb") as fp:
                 return fp.read()
 
-    def load_xml(self, url):
-        fp = self.cache.get_fp(url)
+    def load_xml(self, url, refresh=False):
+        """ :param refresh: Fetch `url` even if it's in the cache. """
+        fp = (self.cache.get_fp(url) if not refresh else None)
         if fp:
             with fp:
-                return etree.parse(fp)
+                return self.parsers.parse(fp)
         else:
             data = self._download(url)
             self.cache.put(url, data)
-            return etree.parse(StringIO(data))
+            return self.parsers.parse(StringIO(data))
 
     def get(self, url):
         data = self.cache.get(url)
@@ -0,0 +1,321 @@
+"""
+MTOM/XOP support: binary data travels as MIME parts of a multipart/related message
+and is referenced from the envelope with `xop:Include` elements.
+"""
+from foamy.ns import COMMON_NAMESPACES as NS
+from foamy.xmlutils import DEFAULT_PARSERS
+from lxml import etree
+import contextlib
+import shutil
+import tempfile
+import threading
+
+XOP_INCLUDE_TAG = NS.tag("xop", "Include")
+XOP_CONTENT_TYPE = "application/xop+xml"
+_local = threading.local()
+
+
+class Attachment(object):
+    """ A binary MIME part; a file-like object over its content. """
+
+    def __init__(self, content_id, content_type="application/octet-stream", fp=None, data=None):
+        self.content_id = content_id
+        self.content_type = content_type
+        self.fp = fp
+        self.data = data
+
+    def _get_fp(self):
+        if self.fp is None:
+            self.fp = tempfile.SpooledTemporaryFile()
+            self.fp.write(self.data or "")
+            self.fp.seek(0)
+            self.data = None
+        return self.fp
+
+    def read(self, size=-1):
+        return self._get_fp().read(size)
+
+    def seek(self, offset, whence=0):
+        return self._get_fp().seek(offset, whence)
+
+    def tell(self):
+        return self._get_fp().tell()
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+
+    def iter_chunks(self, chunk_size=65536):
+        if self.data is not None:
+            yield self.data
+            return
+        while True:
+            chunk = self.fp.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def save(self, path_or_fp):
+        """ Copy the attachment's content to a path or file object without loading it all in memory. """
+        fp = self._get_fp()
+        fp.seek(0)
+        if hasattr(path_or_fp, "write"):
+            shutil.copyfileobj(fp, path_or_fp)
+        else:
+            with open(path_or_fp, "wb") as out_fp:
+                shutil.copyfileobj(fp, out_fp)
+
+
+class Attachments(dict):
+    """ Attachments of a single message, keyed by Content-ID. """
+
+    def __init__(self, threshold=0):
+        dict.__init__(self)
+        self.threshold = threshold
+
+    def add(self, value):
+        """
+        Register an outgoing binary value as an attachment.
+
+        :return: The Content-ID, or None if the value is small enough to be inlined as base64.
+        """
+        if hasattr(value, "read"):
+            attachment = Attachment(None, fp=value)
+        elif len(value) >= self.threshold:
+            attachment = Attachment(None, data=bytes(value))
+        else:
+            return None
+        import uuid  # Deferred; slow to import and only needed for MTOM
+        attachment.content_id = "%s@foamy" % uuid.uuid4().hex
+        self[attachment.content_id] = attachment
+        return attachment.content_id
+
+    def resolve(self, href):
+        import urllib
+        content_id = urllib.unquote(href[4:] if href.startswith("cid:") else href)
+        try:
+            return self[content_id]
+        except KeyError:
+            raise KeyError("Message refers to unknown attachment %r" % href)
+
+
+@contextlib.contextmanager
+def attachment_scope(attachments):
+    """ Make `attachments` visible to binary types (un)marshalled on this thread within the block. """
+    stack = _local.__dict__.setdefault("stack", [])
+    stack.append(attachments)
+    try:
+        yield attachments
+    finally:
+        stack.pop()
+
+
+def current_attachments():
+    stack = getattr(_local, "stack", None)
+    return (stack[-1] if stack else None)
+
+
+def insert_includes(tree, attachments):
+    """ Turn the `cid:` placeholders left by marshalling into `xop:Include` elements. """
+    for element in tree.iter():
+        text = element.text
+        if text and text.startswith("cid:") and text[4:] in attachments:
+            element.text = None
+            etree.SubElement(element, XOP_INCLUDE_TAG, {"href": text}, nsmap={"xop": NS.xop})
+
+
+def write_text(xf, text):
+    """ Write element text to an `lxml.etree.xmlfile` writer, turning `cid:` placeholders into `xop:Include`s. """
+    attachments = current_attachments()
+    if attachments and text.startswith("cid:") and text[4:] in attachments:
+        with xf.element(XOP_INCLUDE_TAG, {"href": text}):
+            pass
+    else:
+        xf.write(text)
+
+
+def replace_includes(tree):
+    """ Turn `xop:Include` elements into `cid:` placeholder text for unmarshalling. """
+    for include in list(tree.iter(XOP_INCLUDE_TAG)):
+        parent = include.getparent()
+        parent.remove(include)
+        parent.text = include.get("href")
+
+
+def build_multipart(xml, attachments, soap_content_type="text/xml"):
+    """
+    :param xml: The envelope, as bytes or an iterable of byte chunks. Attachments may
+                still be added to `attachments` while the chunks are produced.
+    :return: (Content-Type header value, iterator over body chunks)
+    """
+    import uuid
+    boundary = "uuid:%s" % uuid.uuid4()
+    root_id = "root.message@foamy"
+    content_type = 'multipart/related; type="%s"; boundary="%s"; start="<%s>"; start-info="%s"' % (
+        XOP_CONTENT_TYPE, boundary, root_id, soap_content_type
+    )
+
+    def generate():
+        yield (
+            "--%s\r\n"
+            "Content-Type: %s; charset=UTF-8; type=\"%s\"\r\n"
+            "Content-Transfer-Encoding: 8bit\r\n"
+            "Content-ID: <%s>\r\n\r\n" % (boundary, XOP_CONTENT_TYPE, soap_content_type, root_id)
+        )
+        if isinstance(xml, bytes):
+            yield xml
+        else:
+            for chunk in xml:
+                yield chunk
+        for content_id, attachment in attachments.iteritems():
+            yield (
+                "\r\n--%s\r\n"
+                "Content-Type: %s\r\n"
+                "Content-Transfer-Encoding: binary\r\n"
+                "Content-ID: <%s>\r\n\r\n" % (boundary, attachment.content_type, content_id)
+            )
+            for chunk in attachment.iter_chunks():
+                yield chunk
+        yield "\r\n--%s--\r\n" % boundary
+
+    return content_type, generate()
+
+
+class MultipartReader(object):
+    """ Incremental multipart/* body parser; feed it bytes, it hands part contents to writers as they arrive. """
+
+    def __init__(self, boundary, part_factory):
+        """
+        :param part_factory: Callable taking a dict of (lower-cased) part headers and returning
+                             an object with `write(data)` and `close()`.
+        """
+        self.delimiter = "\r\n--" + boundary
+        self.part_factory = part_factory
+        self.buffer = "\r\n"  # The first delimiter may be at the very start of the body
+        self.state = "preamble"
+        self.part = None
+
+    def feed(self, data):
+        self.buffer += data
+        delimiter = self.delimiter
+        while True:
+            if self.state == "preamble":
+                idx = self.buffer.find(delimiter)
+                if idx < 0:
+                    self.buffer = self.buffer[-len(delimiter):]
+                    return
+                self.buffer = self.buffer[idx + len(delimiter):]
+                self.state = "delimiter"
+            elif self.state == "delimiter":
+                if self.buffer.startswith("--"):
+                    self.state = "epilogue"
+                    continue
+                idx = self.buffer.find("\r\n")
+                if idx < 0:
+                    return
+                self.buffer = self.buffer[idx + 2:]
+                self.state = "headers"
+            elif self.state == "headers":
+                if self.buffer.startswith("\r\n"):
+                    header_block, self.buffer = "", self.buffer[2:]
+                else:
+                    idx = self.buffer.find("\r\n\r\n")
+                    if idx < 0:
+                        return
+                    header_block, self.buffer = self.buffer[:idx], self.buffer[idx + 4:]
+                headers = {}
+                for line in header_block.split("\r\n"):
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                self.part = self.part_factory(headers)
+                self.state = "body"
+            elif self.state == "body":
+                idx = self.buffer.find(delimiter)
+                if idx < 0:
+                    safe = len(self.buffer) - len(delimiter) + 1
+                    if safe > 0:
+                        self.part.write(self.buffer[:safe])
+                        self.buffer = self.buffer[safe:]
+                    return
+                self.part.write(self.buffer[:idx])
+                self.part.close()
+                self.part = None
+                self.buffer = self.buffer[idx + len(delimiter):]
+                self.state = "delimiter"
+            else:  # epilogue
+                self.buffer = ""
+                return
+
+    def close(self):
+        if self.state != "epilogue":
+            raise ValueError("Truncated multipart body (state %s)" % self.state)
+
+
+class _XMLPartWriter(object):
+    def __init__(self, parsers):
+        self.parser = parsers.new_feed_parser()
+        self.root = None
+
+    def write(self, data):
+        if data:
+            self.parser.feed(data)
+
+    def close(self):
+        self.root = self.parser.close()
+
+
+class _AttachmentPartWriter(object):
+    def __init__(self, attachment):
+        self.attachment = attachment
+
+    def write(self, data):
+        self.attachment.fp.write(data)
+
+    def close(self):
+        self.attachment.fp.seek(0)
+
+
+def is_multipart(content_type):
+    return (content_type or "").lower().startswith("multipart/related")
+
+
+def parse_multipart(chunks, content_type, attachment_threshold=1024 * 1024, parsers=None):
+    """
+    Parse a multipart/related message from an iterable of byte chunks.
+
+    The root part is fed straight into an XML parser; other parts are spooled into
+    temporary files that roll over to disk once larger than `attachment_threshold` bytes.
+
+    :param parsers: `XMLParsers` for the root part; defaults to `DEFAULT_PARSERS`.
+    :return: (root element of the envelope, Attachments)
+    """
+    import cgi  # Deferred; slow to import and only needed for multipart responses
+    main_type, params = cgi.parse_header(content_type)
+    boundary = params.get("boundary")
+    if not boundary:
+        raise ValueError("No boundary in %r" % content_type)
+    start = params.get("start", "").strip("<>")
+    attachments = Attachments()
+    state = {"root": None}
+
+    def part_factory(headers):
+        content_id = headers.get("content-id", "").strip("<>")
+        if state["root"] is None and (not start or content_id == start):
+            state["root"] = _XMLPartWriter(parsers or DEFAULT_PARSERS)
+            return state["root"]
+        attachment = Attachment(
+            content_id,
+            headers.get("content-type", "application/octet-stream"),
+            tempfile.SpooledTemporaryFile(max_size=attachment_threshold)
+        )
+        attachments[content_id] = attachment
+        return _AttachmentPartWriter(attachment)
+
+    reader = MultipartReader(boundary, part_factory)
+    for chunk in chunks:
+        if chunk:
+            reader.feed(chunk)
+    reader.close()
+    if state["root"] is None:
+        raise ValueError("No root part found in multipart message")
+    return state["root"].root, attachments
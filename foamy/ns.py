@@ -1,21 +1,18 @@
-class NamespaceMap(dict):
-    def __init__(self, *args, **kwargs):
-        dict.__init__(self, *args, **kwargs)
-        self.reverse = dict((url, name) for (name, url) in self.iteritems())
-
-    def __getattr__(self, key):
-        if key in self:
-            return self[key]
-        return dict.__getattribute__(self, key)
+class NamespaceLookup(object):
+    __slots__ = ()
 
     def tag(self, ns, tag):
         return "{%s}%s" % (self[ns], tag)
 
     def augment(self, *args, **kwargs):
-        dct = dict(self, **kwargs)
+        """ Return a scope with the given prefixes layered on top of this one; nothing is copied. """
+        if kwargs:
+            args += (kwargs,)
+        scope = self
         for arg in args:
-            dct.update(arg)
-        return self.__class__(dct)
+            if arg:
+                scope = NamespaceScope(scope, arg)
+        return scope
 
     def to_qname(self, cname):
         if ":" in cname:
@@ -24,6 +21,42 @@ class NamespaceMap(dict):
             ns, name = None, cname
         return self.tag(ns, name)
 
+
+class NamespaceMap(NamespaceLookup, dict):
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.reverse = dict((url, name) for (name, url) in self.iteritems())
+
+    def __getattr__(self, key):
+        if key in self:
+            return self[key]
+        return dict.__getattribute__(self, key)
+
+
+class NamespaceScope(NamespaceLookup):
+    """ A layer of prefix -> namespace mappings whose lookups fall through to a parent scope. """
+    __slots__ = ("parent", "mapping")
+
+    def __init__(self, parent, mapping):
+        self.parent = parent
+        self.mapping = mapping
+
+    def __getitem__(self, key):
+        scope = self
+        while isinstance(scope, NamespaceScope):
+            mapping = scope.mapping
+            if key in mapping:
+                return mapping[key]
+            scope = scope.parent
+        return scope[key]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
 COMMON_NAMESPACES = NamespaceMap(
     http="http://schemas.xmlsoap.org/wsdl/http/",
     mime="http://schemas.xmlsoap.org/wsdl/mime/",
@@ -42,4 +75,5 @@ COMMON_NAMESPACES = NamespaceMap(
     wsp="http://schemas.xmlsoap.org/ws/2004/09/policy",
     wssu="http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-utility-1.0.xsd",
     wsx="http://schemas.xmlsoap.org/ws/2004/09/mex",
+    xop="http://www.w3.org/2004/08/xop/include",
 )
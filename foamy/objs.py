@@ -1,10 +1,36 @@
+from foamy import lazy
 from foamy.excs import XMLValueError
+from foamy.mtom import Attachments, attachment_scope, build_multipart, insert_includes, replace_includes
 from foamy.ns import COMMON_NAMESPACES as NS
 from foamy.registry import QNameRegistry, NameRegistry
-from lxml.etree import Element, SubElement, tostring, fromstring, cleanup_namespaces
+from foamy.xmlutils import ANY_TAG, KEEP_ALL
+from lxml.etree import Element, SubElement, tostring, cleanup_namespaces, xmlfile
+import collections
 import logging
 logger = logging.getLogger(__name__)
 
+WSDL_OPERATION_TAG = NS.tag("wsdl", "operation")
+SOAP_OPERATION_TAG = NS.tag("soap", "operation")
+HTTP_OPERATION_TAG = NS.tag("http", "operation")
+WSDL_INPUT_TAG = NS.tag("wsdl", "input")
+WSDL_OUTPUT_TAG = NS.tag("wsdl", "output")
+HTTP_URL_ENCODED_TAG = NS.tag("http", "urlEncoded")
+HTTP_URL_REPLACEMENT_TAG = NS.tag("http", "urlReplacement")
+MIME_CONTENT_TAG = NS.tag("mime", "content")
+MIME_XML_TAG = NS.tag("mime", "mimeXml")
+FORM_CONTENT_TYPE = "application/x-www-form-urlencoded"
+ENVELOPE_TAG = NS.tag("soapenv", "Envelope")
+HEADER_TAG = NS.tag("soapenv", "Header")
+BODY_TAG = NS.tag("soapenv", "Body")
+FAULT_TAG = NS.tag("soapenv", "Fault")
+
+# Result modes for operation calls
+RESULT_EAGER = "eager"  # Unmarshal the whole response into dicts and basic values
+RESULT_LAZY = "lazy"  # Return `LazyRecord`s that unmarshal fields when accessed
+RESULT_ELEMENT = "element"  # Return the payload element of the response body as-is
+RESULT_BYTES = "bytes"  # Return the raw response body, unparsed
+RESULT_MODES = (RESULT_EAGER, RESULT_LAZY, RESULT_ELEMENT, RESULT_BYTES)
+
 
 class ContextBoundObject(object):
     def __init__(self, context, ns, name):
@@ -18,18 +44,56 @@ class ContextBoundObject(object):
 
 
 class Request(object):
-    def __init__(self, url, headers=None, data=None):
+    def __init__(self, url, headers=None, data=None, stream=None, method=None):
         self.url = url
         self.headers = headers or {}
         self.data = data
+        self.stream = stream  # None: use the transport's default
+        self.method = method  # None: POST if there is data, GET otherwise
+        self.deadline = None  # A `Deadline` the transport must finish within, if any
+        self.parsers = None  # `XMLParsers` for parsing the response; None: the defaults
+        self.keep = None  # `xmlutils.Pruner` trie of the response elements to keep while stream-parsing; None: all
 
 
 class Response(object):
-    def __init__(self, request, code, headers, data):
+    def __init__(self, request, code, headers, data, tree=None, body_file=None, attachments=None):
         self.request = request
         self.code = code
         self.headers = headers
-        self.data = data
+        self._data = data
+        self.tree = tree
+        self.body_file = body_file
+        self.attachments = attachments
+
+    def _get_data(self):
+        if self._data is None and self.body_file is not None:
+            self.body_file.seek(0)
+            return self.body_file.read()
+        return self._data
+
+    data = property(_get_data)
+
+    def get_body(self):
+        """ Return the parsed root element if the transport streamed it, or the raw body otherwise. """
+        return (self.tree if self.tree is not None else self.data)
+
+
+class _ChunkSink(object):
+    """ File-like target for `xmlfile` that collects output until drained. """
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
 
 
 class Binding(ContextBoundObject):
@@ -55,55 +119,279 @@ class Binding(ContextBoundObject):
                 return (protocol, dict(bind_tag.attrib))
 
     def parse_wsdl(self, binding_tag):
-        for op_tag in binding_tag.findall(NS.tag("wsdl", "operation")):
+        for op_tag in binding_tag.iterchildren(WSDL_OPERATION_TAG):
             self.parse_wsdl_operation(op_tag)
 
+    def _get_preference_names(self):
+        """ Names this binding goes by in `Context.binding_preference`. """
+        return (self.protocol,)
+
+    preference_names = property(_get_preference_names)
+
     def parse_wsdl_operation(self, op_tag):
         pass
 
-    def envelope_message(self, message, operation):
+    def envelope_message(self, message, operation, stream_request=None):
+        """
+        :return: A `Request`. Its `url`, if set, is relative to the port's location.
+        """
+        raise NotImplementedError("Not implemented")
+
+    def extract_payload(self, tree):
+        """ Find the element carrying the operation's output in a parsed response. """
         raise NotImplementedError("Not implemented")
 
-    def unenvelope_message(self, message, operation):
+    def unenvelope_message(self, message, operation, attachments=None, result_mode=RESULT_EAGER, projection=None):
+        raise NotImplementedError("Not implemented")
+
+    def get_projection(self, operation, paths):
+        """ The `Projection` of `paths` (a field path or several) onto `operation`'s output, compiled on first use. """
+        key = (operation, ((paths,) if isinstance(paths, basestring) else tuple(sorted(set(paths)))))
+        projections = self.__dict__.setdefault("_projections", {})
+        projection = projections.get(key)
+        if projection is None:
+            projection = projections[key] = self.compile_projection(operation, key[1])
+        return projection
+
+    def compile_projection(self, operation, paths):
         raise NotImplementedError("Not implemented")
 
 
 class SOAPBinding(Binding):
     protocol = "soap"
     usable = True
+    pretty_print = True
+    mtom = False  # Send binary values as MTOM/XOP attachments?
+    mtom_threshold = 1024  # Binary values smaller than this are inlined as base64 even with MTOM
+    stream_requests = False  # Write request envelopes incrementally while sending?
+    stream_chunk_size = 65536
 
     def parse_wsdl_operation(self, op_tag):
         # XXX: Not complete!
         operation = self.port_type.operations[op_tag.get("name")]
-        soap_op = op_tag.find(NS.tag("soap", "operation"))
+        soap_op = op_tag.find(SOAP_OPERATION_TAG)
         if soap_op is None:
             raise XMLValueError("SOAP binding, but no SOAP operation tag.", op_tag)
         default_dict = {"style": self.binding_options.get("style")}
         default_dict.update(soap_op.attrib)
         self.operation_bindings[operation] = default_dict
 
-    def envelope_message(self, message, operation):
+    def envelope_message(self, message, operation, stream_request=None):
+        if (self.stream_requests if stream_request is None else stream_request):
+            return self.envelope_message_streaming(message, operation)
         # XXX: `encoded`/`literal` is blissfully ignored
-        envelope = Element(NS.tag("soapenv", "Envelope"), nsmap=dict(NS))
-        header = SubElement(envelope, NS.tag("soapenv", "Header"))
-        body = SubElement(envelope, NS.tag("soapenv", "Body"))
+        envelope = Element(ENVELOPE_TAG, nsmap=dict(NS))
+        header = SubElement(envelope, HEADER_TAG)
+        body = SubElement(envelope, BODY_TAG)
 
         opbind = self.operation_bindings[operation]
-        for el in operation.input.message.marshal(message, style=opbind["style"]):
-            body.append(el)
+        attachments = (Attachments(self.mtom_threshold) if self.mtom else None)
+        with attachment_scope(attachments):
+            for el in operation.input.message.marshal(message, style=opbind["style"]):
+                body.append(el)
 
         cleanup_namespaces(envelope)
-        xml = tostring(envelope, pretty_print=True, encoding="UTF-8", xml_declaration=True)
+        if attachments:
+            insert_includes(body, attachments)
+        xml = tostring(envelope, pretty_print=self.pretty_print, encoding="UTF-8", xml_declaration=True)
         req = Request(None, {
             "Content-type": "text/xml; charset=utf-8",
             "SOAPAction": '"%s"' % opbind.get("soapAction")
         }, xml)
 
+        if attachments:
+            req.headers["Content-type"], req.data = build_multipart(xml, attachments)
+            req.headers["MIME-Version"] = "1.0"
+
+        return req
+
+    def envelope_message_streaming(self, message, operation):
+        """
+        Like `envelope_message`, but the request body is a generator that marshals and writes
+        the envelope as the transport sends it, so memory use doesn't grow with the message.
+        Repeated values may be given as iterators. Marshalling errors surface while sending.
+        """
+        opbind = self.operation_bindings[operation]
+        attachments = (Attachments(self.mtom_threshold) if self.mtom else None)
+        chunks = self.iter_envelope(message, operation, attachments)
+        req = Request(None, {
+            "Content-type": "text/xml; charset=utf-8",
+            "SOAPAction": '"%s"' % opbind.get("soapAction")
+        }, chunks)
+
+        if attachments is not None:  # Whether any values will become attachments isn't known yet
+            req.headers["Content-type"], req.data = build_multipart(chunks, attachments)
+            req.headers["MIME-Version"] = "1.0"
+
         return req
 
-    def unenvelope_message(self, body, operation):
+    def iter_envelope(self, message, operation, attachments=None):
+        opbind = self.operation_bindings[operation]
+        nsmap = {"soapenv": NS.soapenv}
+        if attachments is not None:
+            nsmap["xop"] = NS.xop
+        sink = _ChunkSink()
+        with xmlfile(sink, encoding="UTF-8", buffered=False) as xf:
+            xf.write_declaration()
+            with xf.element(ENVELOPE_TAG, nsmap=nsmap):
+                with xf.element(HEADER_TAG):
+                    pass
+                with xf.element(BODY_TAG):
+                    steps = operation.input.message.write(xf, message, style=opbind["style"])
+                    while True:
+                        try:
+                            if attachments is None:
+                                next(steps)
+                            else:
+                                # Only hold the attachment scope while marshalling, not across yields
+                                with attachment_scope(attachments):
+                                    next(steps)
+                        except StopIteration:
+                            break
+                        if sink.size >= self.stream_chunk_size:
+                            yield sink.drain()
+        yield sink.drain()
+
+    def extract_payload(self, tree):
+        return tree.find(BODY_TAG).getchildren()[0]
+
+    def unenvelope_message(self, body, operation, attachments=None, result_mode=RESULT_EAGER, projection=None):
         opbind = self.operation_bindings[operation]
-        return operation.output.message.unmarshal(body, style=opbind["style"])
+        if attachments is not None:
+            replace_includes(body)
+        with attachment_scope(attachments):
+            return operation.output.message.unmarshal(
+                body, style=opbind["style"], lazy=(result_mode == RESULT_LAZY), projection=projection
+            )
+
+    def compile_projection(self, operation, paths):
+        from foamy.projection import Projection, message_fields  # Deferred; `foamy.types` imports this module
+        projection = Projection(message_fields(operation.output.message), paths)
+        keep = projection.keep
+        if self.operation_bindings[operation]["style"] == "rpc":  # Under the wrapper element
+            keep = {ANY_TAG: keep}
+        projection.document_keep = {ENVELOPE_TAG: {HEADER_TAG: KEEP_ALL, BODY_TAG: {FAULT_TAG: KEEP_ALL, ANY_TAG: keep}}}
+        return projection
+
+
+class HTTPBinding(Binding):
+    """
+    The WSDL HTTP GET/POST binding: message parts travel as plain form values
+    (in the query string, the URL path or a form-encoded body) and the response
+    is a bare XML document instead of a SOAP envelope.
+    """
+    protocol = "http"
+    usable = True
+
+    def _get_verb(self):
+        return self.binding_options.get("verb", "GET").upper()
+
+    verb = property(_get_verb)
+
+    def _get_preference_names(self):
+        return ("http-%s" % self.verb.lower(), self.protocol)
+
+    preference_names = property(_get_preference_names)
+
+    def parse_wsdl_operation(self, op_tag):
+        operation = self.port_type.operations[op_tag.get("name")]
+        http_op = op_tag.find(HTTP_OPERATION_TAG)
+        if http_op is None:
+            raise XMLValueError("HTTP binding, but no HTTP operation tag.", op_tag)
+        opbind = {"location": http_op.get("location", ""), "input": None, "output_part": None}
+
+        input_tag = op_tag.find(WSDL_INPUT_TAG)
+        if input_tag is not None:
+            if input_tag.find(HTTP_URL_ENCODED_TAG) is not None:
+                opbind["input"] = "urlEncoded"
+            elif input_tag.find(HTTP_URL_REPLACEMENT_TAG) is not None:
+                opbind["input"] = "urlReplacement"
+            else:
+                content = input_tag.find(MIME_CONTENT_TAG)
+                if content is not None and content.get("type") == FORM_CONTENT_TYPE:
+                    opbind["input"] = "form"
+                elif input_tag.find(MIME_XML_TAG) is not None:
+                    opbind["input"] = "mimeXml"
+                else:
+                    raise XMLValueError("HTTP binding: unsupported input encoding.", input_tag)
+
+        output_tag = op_tag.find(WSDL_OUTPUT_TAG)
+        if output_tag is not None:
+            mime_xml = output_tag.find(MIME_XML_TAG)
+            if mime_xml is not None:
+                opbind["output_part"] = mime_xml.get("part")
+            else:
+                # XXX: Only XML responses are understood; mime:content is assumed to be text/xml
+                content = output_tag.find(MIME_CONTENT_TAG)
+                opbind["output_part"] = (content.get("part") if content is not None else None)
+        self.operation_bindings[operation] = opbind
+
+    def get_form_values(self, message, operation):
+        """ :return: list of (part name, UTF-8 encoded value) pairs. """
+        parts = operation.input.message.parts
+        if not hasattr(message, "keys"):
+            if len(parts) != 1:
+                raise TypeError("Input must be dict when marshalling multipart messages (got %r)" % message)
+            message = {parts[0][0]: message}
+        values = []
+        for name, type in parts:
+            if name not in message:
+                raise ValueError("While marshalling HTTP message: Missing part %r" % name)
+            value = type.marshal(message[name])
+            if hasattr(value, "tag"):
+                if len(value):
+                    raise ValueError("HTTP binding: part %r has complex content and can't be form-encoded" % name)
+                value = (value.text or u"")
+            values.append((name, unicode(value).encode("UTF-8")))
+        return values
+
+    def envelope_message(self, message, operation, stream_request=None):
+        import urllib  # Deferred, as in `foamy.mtom`
+        opbind = self.operation_bindings[operation]
+        path = opbind["location"]
+        encoding = opbind["input"]
+        req = Request(None, {}, None, method=self.verb)
+
+        if encoding == "mimeXml":
+            typename, type = operation.input.message.parts[0]
+            req.headers["Content-type"] = "text/xml; charset=utf-8"
+            req.data = tostring(type.marshal(message), encoding="UTF-8", xml_declaration=True)
+        elif encoding:
+            values = self.get_form_values(message, operation)
+            if encoding == "urlReplacement":
+                for name, value in values:
+                    path = path.replace("(%s)" % name, urllib.quote(value, safe=""))
+            elif encoding == "form":
+                req.headers["Content-type"] = FORM_CONTENT_TYPE
+                req.data = urllib.urlencode(values)
+            elif values:
+                path += ("&" if "?" in path else "?") + urllib.urlencode(values)
+        req.url = path
+        return req
+
+    def extract_payload(self, tree):
+        return tree  # No envelope; the document is the output part
+
+    def get_output_type(self, operation):
+        part_name = self.operation_bindings[operation]["output_part"]
+        parts = operation.output.message.parts
+        return (dict(parts)[part_name] if part_name else parts[0][1])
+
+    def unenvelope_message(self, body, operation, attachments=None, result_mode=RESULT_EAGER, projection=None):
+        type = self.get_output_type(operation)
+        with attachment_scope(attachments):
+            if projection is not None:
+                return projection.unmarshal(body)
+            if result_mode == RESULT_LAZY:
+                return type.unmarshal_lazy(body)
+            return type.unmarshal(body)
+
+    def compile_projection(self, operation, paths):
+        from foamy.projection import Projection, fields_of  # Deferred; `foamy.types` imports this module
+        type = self.get_output_type(operation)
+        projection = Projection(fields_of(type), paths)
+        projection.document_keep = {type.qname: projection.keep}  # The document is the payload
+        return projection
 
 
 class OperationPart(object):
@@ -120,6 +408,7 @@ class Operation(object):
         self.output = None
         self.faults = []
         self.documentation = None
+        self.idempotent = False  # Safe to retry and hedge?
 
     def __str__(self):
         return "<Operation %s:%s>" % (self.port_type.name, self.name)
@@ -164,6 +453,23 @@ class Message(ContextBoundObject):
         else:
             return [wrapper]
 
+    def write(self, xf, message, style):
+        """ Streaming counterpart of `marshal`; see `BaseType.write`. """
+        if len(self.parts) > 1:
+            for el in self.marshal(message, style):
+                xf.write(el)
+                yield
+            return
+
+        typename, type = self.parts[0]
+        if style == "document":
+            for _ in type.write(xf, message):
+                yield
+        else:
+            with xf.element(self.qname):
+                for _ in type.write(xf, message):
+                    yield
+
     def marshal_multipart(self, wrapper, message):
         if not isinstance(message, dict):
             raise TypeError("Input must be dict when marshalling multipart messages (got %r)" % message)
@@ -182,10 +488,15 @@ class Message(ContextBoundObject):
                 subel.text = marshalled
         return wrapper
 
-    def unmarshal(self, message, style):
+    def unmarshal(self, message, style, lazy=False, projection=None):
         if style == "rpc":  # Just simply unwrap the first layer of this XML onion for RPC
             message = message.getchildren()[0]
 
+        if projection is not None:
+            return projection.unmarshal(message)
+        if lazy:
+            return self.unmarshal_lazy(message)
+
         if len(self.parts) > 1:
             out = {}
             for name, type in self.parts:
@@ -196,6 +507,25 @@ class Message(ContextBoundObject):
             typename, type = self.parts[0]
             return type.unmarshal(message)
 
+    def _get_lazy_fields(self):
+        fields = self.__dict__.get("_lazy_fields")
+        if fields is None:
+            fields = collections.OrderedDict(
+                (name, (lazy.PART, "{%s}%s" % (self.ns, name), type))
+                for (name, type) in self.parts
+            )
+            self._lazy_fields = fields
+        return fields
+
+    lazy_fields = property(_get_lazy_fields)
+
+    def unmarshal_lazy(self, message):
+        if len(self.parts) > 1:
+            return lazy.LazyRecord(message, self.lazy_fields)
+        else:
+            typename, type = self.parts[0]
+            return type.unmarshal_lazy(message)
+
 
 class Port(object):
     def __init__(self, name, binding, protocol, location):
@@ -203,19 +533,31 @@ class Port(object):
         self.binding = binding
         self.protocol = protocol
         self.location = location
+        self.compression = None  # None: use the context's default
+        self.limiter = None  # None: use the context's `limiter_factory`, if any
+
+    def get_compression(self):
+        if self.compression is not None:
+            return self.compression
+        return self.binding.context.compression
 
     def __str__(self):
         return "<Port '%s' (protocol %s @ %s)>" % (self.name, self.protocol, self.location)
 
-    def envelope_message(self, message, operation):
-        request = self.binding.envelope_message(message, operation)
-        request.url = self.location
+    def envelope_message(self, message, operation, stream_request=None):
+        request = self.binding.envelope_message(message, operation, stream_request)
+        request.url = self.location + (request.url or "")
+        compression = self.get_compression()
+        if compression:
+            compression.apply(request)
         return request
 
-    def unenvelope_message(self, message, operation):
-        tree = fromstring(message)
-        body = tree.find(NS.tag("soapenv", "Body"))
-        response = self.binding.unenvelope_message(body.getchildren()[0], operation)
+    def unenvelope_message(self, message, operation, attachments=None, result_mode=RESULT_EAGER, projection=None):
+        tree = (message if hasattr(message, "tag") else self.binding.context.parsers.fromstring(message))
+        payload = self.binding.extract_payload(tree)
+        if result_mode == RESULT_ELEMENT:
+            return payload
+        response = self.binding.unenvelope_message(payload, operation, attachments, result_mode, projection)
         return response
 
 
@@ -0,0 +1,113 @@
+"""
+Field projections: unmarshal only the parts of a response that were asked for.
+
+A projection is a set of field paths, the keys of the eager result dicts joined by "/"
+(e.g. "Forecast/Temperature" or "Order/_id"). It's compiled once per operation (see
+`Binding.get_projection`) into the steps to unmarshal just those fields, and an
+`xmlutils.Pruner` trie of the elements they're in, so that streamed responses can drop
+everything else as it's parsed.
+
+Projected results are plain dicts holding only the selected keys and the keys leading to
+them. As in the eager mode, a repeated element yields its first occurrence.
+"""
+from foamy import lazy
+from foamy.records import type_fields
+from foamy.types import BaseComplexType
+from foamy.xmlutils import KEEP_ALL
+
+
+def parse_paths(paths):
+    """ :return: The selected keys as a nested dict; None for keys selected whole. """
+    selection = {}
+    for path in paths:
+        keys = [key for key in path.split("/") if key]
+        if not keys:
+            raise ValueError("Empty field path %r" % path)
+        node = selection
+        for key in keys[:-1]:
+            if key in node and node[key] is None:  # The enclosing field is already selected whole
+                break
+            node = node.setdefault(key, {})
+        else:
+            node[keys[-1]] = None
+    return selection
+
+
+def fields_of(type):
+    """ The fields of `type`'s results, as with `records.type_fields`, looking through elements of named complex types. """
+    while isinstance(getattr(type, "base", None), BaseComplexType) and not hasattr(type, "lazy_fields"):
+        type = type.base
+    return type_fields(type)
+
+
+def message_fields(message):
+    """ The fields of `message`'s results: its parts', or those of its only part. """
+    if len(message.parts) > 1:
+        return message.lazy_fields
+    return fields_of(message.parts[0][1])
+
+
+def compile_steps(fields, selection, prefix=""):
+    """
+    :return: (steps, keep): a list of (key, kind, arg, type, substeps) to unmarshal the
+             `selection` of `fields` with, and the `Pruner` trie of the child elements involved.
+    """
+    unknown = set(selection) - set(fields)
+    if unknown:
+        raise ValueError("No such fields: %s (there are %s)" % (
+            ", ".join(prefix + key for key in sorted(unknown)), ", ".join(prefix + key for key in fields) or "none"
+        ))
+    steps = []
+    keep = {}
+    for key, (kind, arg, type) in fields.iteritems():
+        if key not in selection:
+            continue
+        subselection = selection[key]
+        substeps = None
+        if kind in (lazy.ATTRIBUTE, lazy.TEXT):  # Kept with their element
+            if subselection is not None:
+                raise ValueError("%s%s has no fields" % (prefix, key))
+        elif subselection is None:
+            keep[arg] = KEEP_ALL
+        else:
+            substeps, keep[arg] = compile_steps(fields_of(type), subselection, "%s%s/" % (prefix, key))
+        steps.append((key, kind, arg, type, substeps))
+    return steps, keep
+
+
+def apply_steps(steps, node):
+    out = {}
+    for key, kind, arg, type, substeps in steps:
+        if kind == lazy.ATTRIBUTE:
+            out[key] = node.attrib.get(arg)
+        elif kind == lazy.TEXT:
+            value = type.unmarshal(node.text)
+            if value is not None:
+                out[key] = value
+        else:
+            child = node.find(arg)
+            if child is None:
+                if kind == lazy.PART:
+                    out[key] = None
+            elif substeps is None:
+                out[key] = type.unmarshal(child)
+            else:
+                out[key] = apply_steps(substeps, child)
+    return out
+
+
+class Projection(object):
+    def __init__(self, fields, paths):
+        """
+        :param fields: The fields of the results to project, as from `message_fields` or `fields_of`.
+        :param paths: Field paths to select.
+        """
+        self.paths = tuple(paths)
+        self.steps, self.keep = compile_steps(fields, parse_paths(self.paths))
+        self.document_keep = None  # The `Pruner` trie for whole response documents; set by the binding
+
+    def unmarshal(self, node):
+        return apply_steps(self.steps, node)
+
+    def __repr__(self):
+        return "<Projection %s>" % " ".join(self.paths)
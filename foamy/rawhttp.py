@@ -0,0 +1,199 @@
+"""
+A lean transport straight on `httplib`, with a pool of keep-alive connections, for small and
+fast calls where the per-call overhead of `RequestsTransport` shows.
+
+It only does what SOAP needs: no redirects, cookies, proxies or authentication, and the
+request headers are sent as given (no defaults beyond Host and the body's length).
+"""
+from foamy.compression import decode_chunks
+from foamy.deadline import watch_sockets
+from foamy.excs import ConnectionFailed, DeadlineExceeded, HTTPError
+from foamy.mtom import is_multipart, parse_multipart
+from foamy.objs import Response
+from foamy.xmlutils import feed_parse
+import httplib
+import logging
+import select
+import socket
+import threading
+import urlparse
+
+logger = logging.getLogger(__name__)
+CONNECTION_ERRORS = (socket.error, httplib.HTTPException)  # `socket.timeout` is a `socket.error`
+
+
+def _set_nodelay(sock):
+    # Request headers and streamed body chunks go out in separate writes; don't let them wait for ACKs
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class _HTTPConnection(httplib.HTTPConnection):  # (`httplib`'s are old-style classes; no mixins)
+    def connect(self):
+        httplib.HTTPConnection.connect(self)
+        _set_nodelay(self.sock)
+
+
+class _HTTPSConnection(httplib.HTTPSConnection):
+    def connect(self):
+        httplib.HTTPSConnection.connect(self)
+        _set_nodelay(self.sock)
+
+
+CONNECTION_CLASSES = {"http": _HTTPConnection, "https": _HTTPSConnection}
+
+
+def _is_dropped(conn):
+    """ Whether an idle connection was closed by the server; an idle socket shouldn't have anything to read. """
+    try:
+        return bool(select.select([conn.sock], [], [], 0)[0])
+    except (socket.error, select.error, ValueError):
+        return True
+
+
+class RawHTTPTransport(object):
+    def __init__(
+        self, stream=False, chunk_size=65536, spool_threshold=None, attachment_threshold=1024 * 1024,
+        timeout=None, connect_timeout=None, max_idle=10
+    ):
+        """
+        The parameters are those of `RequestsTransport`, and:
+
+        :param max_idle: Idle connections to keep open per host.
+        """
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.spool_threshold = spool_threshold
+        self.attachment_threshold = attachment_threshold
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_idle = max_idle
+        self.idle = {}  # (scheme, netloc) -> list of connections, most recently used last
+        self.lock = threading.Lock()
+
+    def get_timeout(self, request):
+        """ :return: The (connect, read) timeout for `request`, or None. """
+        if request.deadline is not None:
+            remaining = request.deadline.check("sending %s" % request.url)
+            return (min(self.connect_timeout or remaining, remaining), remaining)
+        if self.timeout is None and self.connect_timeout is None:
+            return None
+        return (self.connect_timeout or self.timeout, self.timeout)
+
+    def _checkout(self, key, timeout):
+        with self.lock:
+            idle = self.idle.get(key)
+            while idle:
+                conn = idle.pop()
+                if not _is_dropped(conn):
+                    break
+                conn.close()
+            else:
+                conn = None
+        if conn is None:
+            scheme, netloc = key
+            conn = CONNECTION_CLASSES[scheme](netloc)
+            if timeout is not None:
+                conn.timeout = timeout[0]
+            conn.connect()
+        conn.sock.settimeout(timeout[1] if timeout is not None else None)
+        return conn
+
+    def _release(self, key, conn, resp):
+        if resp.will_close or not resp.isclosed():
+            conn.close()
+            return
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """ Close all idle connections. """
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.itervalues():
+            for conn in conns:
+                conn.close()
+
+    def _send(self, conn, method, path, request):
+        data = request.data
+        conn.putrequest(method, path, skip_accept_encoding=True)
+        for key, value in request.headers.iteritems():
+            conn.putheader(key, value)
+        if data is None:
+            if method in ("POST", "PUT"):
+                conn.putheader("Content-Length", "0")
+            conn.endheaders()
+        elif isinstance(data, bytes):
+            conn.putheader("Content-Length", str(len(data)))
+            conn.endheaders(data)
+        else:  # A streamed body
+            conn.putheader("Transfer-Encoding", "chunked")
+            conn.endheaders()
+            if request.deadline is not None:
+                data = request.deadline.iter_checked(data, "sending %s" % request.url)
+            for chunk in data:
+                if chunk:
+                    conn.send(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            conn.send(b"0\r\n\r\n")
+
+    def _iter_body(self, request, resp):
+        chunks = iter(lambda: resp.read(self.chunk_size), b"")
+        if request.deadline is not None:
+            chunks = request.deadline.iter_checked(chunks, "reading %s" % request.url)
+        return decode_chunks(chunks, resp.getheader("Content-Encoding"))
+
+    def dispatch(self, request):
+        url = urlparse.urlsplit(request.url)
+        key = (url.scheme, url.netloc)
+        if url.scheme not in CONNECTION_CLASSES:
+            raise ValueError("Unsupported URL scheme in %s" % request.url)
+        path = str(url.path or "/") + ("?%s" % url.query if url.query else "")
+        method = str(request.method or ("POST" if request.data else "GET"))
+        stream = (self.stream if request.stream is None else request.stream)
+        deadline = request.deadline
+        logger.debug("DISPATCHING: %s -> %s: %s", method, request.url, request.data or "")
+
+        conn = None
+        try:
+            with watch_sockets(deadline, "talking to %s" % request.url) as watch:
+                conn = self._checkout(key, self.get_timeout(request))
+                watch.add(conn.sock)
+                self._send(conn, method, path, request)
+                resp = conn.getresponse()
+                headers = resp.msg  # Case-insensitive
+                if resp.status >= 400:
+                    body = b"".join(self._iter_body(request, resp))
+                    self._release(key, conn, resp)
+                    conn = None
+                    raise HTTPError(
+                        "HTTP %d (%s) from %s" % (resp.status, resp.reason, request.url),
+                        Response(request, resp.status, headers, body)
+                    )
+                content_type = headers.get("Content-Type")
+                tree = body = body_file = attachments = None
+                if is_multipart(content_type):
+                    tree, attachments = parse_multipart(
+                        self._iter_body(request, resp), content_type, self.attachment_threshold, request.parsers
+                    )
+                elif stream:
+                    tree, body_file = feed_parse(
+                        self._iter_body(request, resp), self.spool_threshold, request.parsers, request.keep
+                    )
+                else:
+                    body = b"".join(self._iter_body(request, resp))
+                self._release(key, conn, resp)
+                conn = None
+                return Response(request, resp.status, headers, body, tree=tree, body_file=body_file, attachments=attachments)
+        except CONNECTION_ERRORS as exc:
+            if conn is not None:
+                conn.close()
+            if deadline is not None and deadline.expired:
+                raise DeadlineExceeded("Deadline of %.3f s exceeded: %s: %s" % (deadline.timeout, request.url, exc), deadline)
+            raise ConnectionFailed("%s: %s" % (request.url, exc))
+        except Exception:
+            if conn is not None:
+                conn.close()
+            raise
@@ -0,0 +1,241 @@
+"""
+Record real traffic to a compact file, and serve it back later without a network,
+for deterministic tests and benchmarks.
+
+The file is a magic line followed by records, each a fixed-size header
+(`RECORD_HEADER`) and then the URL, request headers, request body,
+response headers and response body. Response bodies are stored decoded,
+so replay never decompresses anything.
+"""
+from foamy.compression import Decoder
+from foamy.excs import HTTPError, TransportError
+from foamy.mtom import is_multipart, parse_multipart
+from foamy.objs import Request, Response
+import hashlib
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+MAGIC = b"FOAMYREC1\n"
+# Key, start offset (s), latency (s), status, then lengths of url, request headers, request body, response headers, response body
+RECORD_HEADER = struct.Struct("<20sddHIIIII")
+# Headers that describe how the body was transferred rather than the body itself
+TRANSFER_HEADERS = frozenset(("content-encoding", "content-length", "transfer-encoding", "connection"))
+_BLANK_RE = re.compile(br">\s+<")
+_CONTENT_ID_RE = re.compile(br"[0-9a-f]{32}@foamy")
+
+
+class UnrecordedRequest(TransportError):
+    """ The replayed recording has no response for this request. """
+
+
+def _header(headers, name):
+    name = name.lower()
+    for key, value in headers.iteritems():
+        if key.lower() == name:
+            return value
+
+
+def request_body(request):
+    """ The request body as bytes, joining streamed bodies. """
+    data = request.data
+    if data is not None and not isinstance(data, bytes):
+        data = b"".join(data)
+    return data
+
+
+def request_key(request, body):
+    """
+    Key a request by URL, SOAPAction and its body with compression undone, whitespace
+    between tags dropped and random MIME boundaries and content IDs blanked out.
+    """
+    body = (body or b"")
+    encoding = _header(request.headers, "Content-Encoding")
+    if encoding:
+        decoder = Decoder(encoding)
+        body = decoder.decode(body) + decoder.flush()
+    content_type = (_header(request.headers, "Content-type") or "")
+    if is_multipart(content_type):
+        boundary = re.search(r'boundary="?([^";]+)', content_type)
+        if boundary:
+            body = body.replace(boundary.group(1), b"")
+        body = _CONTENT_ID_RE.sub(b"", body)
+    digest = hashlib.sha1(request.url or b"")
+    digest.update(b"\0%s\0" % (_header(request.headers, "SOAPAction") or b""))
+    digest.update(_BLANK_RE.sub(b"><", body.strip()))
+    return digest.digest()
+
+
+def _encode_headers(headers):
+    return b"\r\n".join(b"%s: %s" % (key, value) for (key, value) in sorted(headers.iteritems()))
+
+
+def _decode_headers(data):
+    return dict(line.split(b": ", 1) for line in data.split(b"\r\n")) if data else {}
+
+
+class RecordingTransport(object):
+    """ Passes requests on to `transport`, appending each exchange to the recording at `path`. """
+
+    def __init__(self, transport, path):
+        self.transport = transport
+        self.path = path
+        self.lock = threading.Lock()
+        self.start = time.time()
+        new = (not os.path.exists(path) or not os.path.getsize(path))
+        self.fp = open(path, "ab")
+        if new:
+            self.fp.write(MAGIC)
+
+    def dispatch(self, request):
+        body = request_body(request)
+        request.data = body
+        request.stream = False  # Keep the raw response body around to record it
+        started = time.time()
+        try:
+            response = self.transport.dispatch(request)
+        except HTTPError as exc:
+            self.record(request, body, started, exc.response)
+            raise
+        self.record(request, body, started, response)
+        return response
+
+    def record(self, request, body, started, response):
+        latency = time.time() - started
+        resp_headers = dict(
+            (key, value) for (key, value) in response.headers.items()
+            if key.lower() not in TRANSFER_HEADERS
+        )
+        parts = (
+            request.url or b"", _encode_headers(request.headers), body or b"",
+            _encode_headers(resp_headers), response.data or b"",
+        )
+        header = RECORD_HEADER.pack(
+            request_key(request, body), started - self.start, latency, response.code,
+            *[len(part) for part in parts]
+        )
+        with self.lock:
+            self.fp.write(header + b"".join(parts))
+            self.fp.flush()
+
+    def close(self):
+        self.fp.close()
+
+
+class Exchange(object):
+    """ A recorded request/response pair; fields are read from the memory map on access. """
+    __slots__ = ("recording", "offset", "key", "started", "latency", "code", "lengths")
+
+    def __init__(self, recording, offset, key, started, latency, code, lengths):
+        self.recording = recording
+        self.offset = offset  # Where the URL starts
+        self.key = key
+        self.started = started
+        self.latency = latency
+        self.code = code
+        self.lengths = lengths
+
+    def _field(self, index):
+        start = self.offset + sum(self.lengths[:index])
+        return self.recording.map[start:start + self.lengths[index]]
+
+    def get_request(self):
+        return Request(self._field(0), _decode_headers(self._field(1)), self._field(2) or None)
+
+    def get_response(self, request):
+        return Response(request, self.code, _decode_headers(self._field(3)), self._field(4))
+
+
+class Recording(object):
+    """ A recording opened for reading; the file is memory-mapped, and only the record headers are read up front. """
+
+    def __init__(self, path):
+        with open(path, "rb") as fp:
+            self.map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not a foamy recording" % path)
+        self.exchanges = []
+        self.by_key = {}
+        offset = len(MAGIC)
+        size = len(self.map)
+        while offset < size:
+            fields = RECORD_HEADER.unpack_from(self.map, offset)
+            offset += RECORD_HEADER.size
+            exchange = Exchange(self, offset, fields[0], fields[1], fields[2], fields[3], fields[4:])
+            self.exchanges.append(exchange)
+            self.by_key.setdefault(exchange.key, []).append(exchange)
+            offset += sum(exchange.lengths)
+
+    def __len__(self):
+        return len(self.exchanges)
+
+    def close(self):
+        self.map.close()
+
+
+class ReplayTransport(object):
+    def __init__(self, path_or_recording, speed=None, attachment_threshold=1024 * 1024):
+        """
+        :param speed: None to answer immediately; otherwise take the recorded latency divided by this
+                      (1.0 for the original timing, 2.0 for twice as fast...).
+
+        Requests recorded several times (e.g. a failure and its retry) get the recorded responses
+        in order, starting over after the last one.
+        """
+        self.recording = (
+            path_or_recording if isinstance(path_or_recording, Recording) else Recording(path_or_recording)
+        )
+        self.speed = speed
+        self.attachment_threshold = attachment_threshold
+        self.lock = threading.Lock()
+        self.served = {}
+
+    def dispatch(self, request):
+        body = request_body(request)
+        key = request_key(request, body)
+        exchanges = self.recording.by_key.get(key)
+        if not exchanges:
+            raise UnrecordedRequest("No recorded response for %s (SOAPAction %s)" % (
+                request.url, _header(request.headers, "SOAPAction")
+            ))
+        with self.lock:
+            index = self.served.get(key, 0)
+            self.served[key] = index + 1
+        exchange = exchanges[index % len(exchanges)]
+        if self.speed:
+            time.sleep(exchange.latency / self.speed)
+        response = exchange.get_response(request)
+        if response.code >= 400:
+            raise HTTPError("HTTP %d from %s (replayed)" % (response.code, request.url), response)
+        content_type = _header(response.headers, "Content-Type")
+        if is_multipart(content_type):
+            response.tree, response.attachments = parse_multipart(
+                [response.data], content_type, self.attachment_threshold, request.parsers
+            )
+        return response
+
+
+def replay_requests(path_or_recording, send, speed=1.0):
+    """
+    Send the recorded requests again through `send` (e.g. a transport's `dispatch`), in the
+    original order, spaced as they were originally (divided by `speed`; None for no spacing).
+
+    :return: list of (request, response or exception)
+    """
+    recording = (path_or_recording if isinstance(path_or_recording, Recording) else Recording(path_or_recording))
+    results = []
+    start = time.time()
+    for exchange in recording.exchanges:
+        if speed:
+            delay = start + exchange.started / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        request = exchange.get_request()
+        try:
+            results.append((request, send(request)))
+        except TransportError as exc:
+            results.append((request, exc))
+    return results
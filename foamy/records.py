@@ -0,0 +1,199 @@
+"""
+Compact fixed-layout result records, instead of a dict per unmarshalled element.
+
+A context either leaves results as dicts (`RECORD_DICT`), or builds a `__slots__` record class
+(`RECORD_SLOTS`) or namedtuple (`RECORD_NAMEDTUPLE`) per schema type from its field list;
+classes registered with `Context.register_record_class` take precedence for their types.
+"""
+from foamy import lazy
+import collections
+import keyword
+import re
+
+# Record modes
+RECORD_DICT = "dict"  # Plain dicts, with "_name" keys for attributes and "$" for simple content
+RECORD_SLOTS = "slots"  # Generated `Record` subclasses
+RECORD_NAMEDTUPLE = "namedtuple"  # Generated namedtuples; missing fields are None
+RECORD_MODES = (RECORD_DICT, RECORD_SLOTS, RECORD_NAMEDTUPLE)
+MISSING = object()  # Positional value for a field to leave unset
+
+
+def identifier(name):
+    name = re.sub(r"\W", "_", name)
+    if not name or name[0].isdigit():
+        name = "_" + name
+    if keyword.iskeyword(name):
+        name += "_"
+    return name
+
+
+def slot_names(keys):
+    """ Attribute names for result keys: "$" becomes `value` and "_name" becomes `attr_name`. """
+    names = []
+    for key in keys:
+        if key == "$":
+            name = "value"
+        elif key.startswith("_"):
+            name = "attr%s" % key
+        else:
+            name = key
+        name = identifier(name)
+        while name in names:
+            name += "_"
+        names.append(name)
+    return names
+
+
+class Record(object):
+    """
+    Base class for record classes.
+
+    Fields live in slots, and are also readable as a mapping with the same keys the dynamic
+    path's result dicts use (`"$"` for simple content, `"_name"` for attributes).
+    Unset fields are left out, just like missing keys.
+
+    This is registered as a `collections.Mapping` rather than derived from it, since
+    the ABCs don't declare `__slots__` and instances would get a `__dict__` after all.
+    """
+    __slots__ = ()
+    _keys = ()  # (key, slot) pairs, in field order
+    _slot_by_key = {}
+
+    def __init__(self, *args, **kwargs):
+        for slot, value in zip(self.__slots__, args):
+            if value is not MISSING:
+                setattr(self, slot, value)
+        for slot, value in kwargs.iteritems():
+            setattr(self, slot, value)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, self._slot_by_key[key])
+        except (KeyError, AttributeError):
+            raise KeyError(key)
+
+    def __iter__(self):
+        return (key for (key, slot) in self._keys if hasattr(self, slot))
+
+    def __len__(self):
+        return sum(1 for (key, slot) in self._keys if hasattr(self, slot))
+
+    def __repr__(self):
+        return "<%s %s>" % (
+            self.__class__.__name__,
+            " ".join("%s=%r" % (slot, getattr(self, slot)) for (key, slot) in self._keys if hasattr(self, slot))
+        )
+
+    __contains__ = collections.Mapping.__contains__.__func__
+    __eq__ = collections.Mapping.__eq__.__func__
+    __ne__ = collections.Mapping.__ne__.__func__
+    __hash__ = None
+    get = collections.Mapping.get.__func__
+    keys = collections.Mapping.keys.__func__
+    items = collections.Mapping.items.__func__
+    values = collections.Mapping.values.__func__
+    iterkeys = collections.Mapping.iterkeys.__func__
+    iteritems = collections.Mapping.iteritems.__func__
+    itervalues = collections.Mapping.itervalues.__func__
+
+    def to_dict(self):
+        """ Convert into plain dicts, recursively, as the dynamic path would have returned. """
+        out = {}
+        for key, value in self.iteritems():
+            out[key] = (value.to_dict() if isinstance(value, Record) else value)
+        return out
+
+
+collections.Mapping.register(Record)
+
+
+def make_record_class(name, keys):
+    fields = tuple(zip(keys, slot_names(keys)))
+    slots = tuple(slot for (key, slot) in fields)
+    namespace = {
+        "__slots__": slots,
+        "_keys": fields,
+        "_slot_by_key": dict(fields),
+    }
+    if slots:  # A straight-line `__init__`, like namedtuple's, is much faster than `Record`'s loop
+        source = "def __init__(self, %s):\n" % ", ".join("%s=MISSING" % slot for slot in slots)
+        for slot in slots:
+            source += "    if %s is not MISSING: self.%s = %s\n" % (slot, slot, slot)
+        scope = {"MISSING": MISSING}
+        exec source in scope
+        namespace["__init__"] = scope["__init__"]
+    return type(identifier(name), (Record,), namespace)
+
+
+def make_namedtuple(name, keys):
+    return collections.namedtuple(identifier(name), slot_names(keys), rename=True)
+
+
+def type_fields(type):
+    """ The fields of `type`'s results, as an OrderedDict of key -> (kind, arg, type) like `LazyRecord` uses. """
+    fields = getattr(type, "lazy_fields", None)
+    if fields is None:
+        fields = collections.OrderedDict()
+        for attr_name in type.attributes:
+            fields["_%s" % attr_name] = (lazy.ATTRIBUTE, attr_name, None)
+        if type.base:
+            fields["$"] = (lazy.TEXT, None, type.base)
+    return fields
+
+
+class RecordPlan(object):
+    """ How to build records of one type: the fields to read, in order, and how to construct from them. """
+
+    def __init__(self, fields, cls):
+        self.fields = [(kind, arg, type) for (kind, arg, type) in fields.itervalues()]
+        self.cls = cls
+        keys = list(fields)
+        if issubclass(cls, Record):
+            cls_keys = [key for (key, slot) in cls._keys]
+            defaults = MISSING
+        else:  # namedtuples and other classes taking their fields positionally
+            names = getattr(cls, "_fields", None) or cls.__slots__
+            by_name = dict(zip(slot_names(keys), keys))
+            cls_keys = [by_name.get(name, (name if name in fields else None)) for name in names]
+            defaults = None
+        if cls_keys == keys:
+            self.order = None
+        else:
+            self.order = [(keys.index(key) if key in fields else None) for key in cls_keys]
+        self.default = defaults
+
+    def unmarshal(self, node, text):
+        """ :param text: The element's unmarshalled simple content, if any. """
+        default = self.default  # For fields missing from the element
+        values = []
+        append = values.append
+        for kind, arg, type in self.fields:
+            if kind == lazy.ATTRIBUTE:
+                append(node.attrib.get(arg))
+            elif kind == lazy.TEXT:
+                append(default if text is None else text)
+            else:
+                child = node.find(arg)
+                append(default if child is None else type.unmarshal(child))
+        if self.order is not None:
+            values = [(default if index is None else values[index]) for index in self.order]
+        return self.cls(*values)
+
+
+def get_record_plan(type):
+    """ The cached `RecordPlan` for `type` under its context's record mode and registrations, or None for dicts. """
+    context = type.context
+    key = (context.record_mode, context.record_classes_version)
+    cached = type.__dict__.get("_record_plan")
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    mode = key[0]
+    plan = None
+    cls = context.record_classes.get(type.qname)
+    fields = type_fields(type)
+    if cls is None and fields and mode != RECORD_DICT:
+        cls = (make_namedtuple if mode == RECORD_NAMEDTUPLE else make_record_class)(type.name, list(fields))
+    if cls is not None:
+        plan = RecordPlan(fields, cls)
+    type._record_plan = (key, plan)
+    return plan
@@ -1,3 +1,6 @@
+import collections
+
+
 class Registry(dict):
     """ Generic automatic dict-based registry that also keeps track of order of element addition. """
 
@@ -23,3 +26,33 @@ class QNameRegistry(Registry):
 
 class NameRegistry(Registry):
     KEY_ATTRIBUTE = "name"
+
+
+class Model(object):
+    """
+    Everything a context has read from WSDLs. `Context.reload` builds a new one beside the
+    current one and swaps it in with a single assignment.
+    """
+
+    def __init__(self):
+        self.types = QNameRegistry()
+        self.messages = QNameRegistry()
+        self.port_types = QNameRegistry()
+        self.bindings = QNameRegistry()
+        self.services = QNameRegistry()
+        self.interned_types = {}  # See `types.local_element_type`
+        self.documents = collections.OrderedDict()  # Source -> `Document`, in the order they were read
+        self.service = None  # The `ServiceSelector` over these, once built
+        # (kind, qname, tag) -> (digest, object, references or None) per definition read, if recorded
+        self.definitions = {}
+
+
+class Document(object):
+    """ What one WSDL document added to a `Model`, so that it can be reloaded on its own. """
+
+    def __init__(self, source):
+        self.source = source
+        self.objects = []  # (kind, object) per definition registered, in order
+        self.keys = []  # (kind, qname, tag) of its definitions in `Model.definitions`, if recorded
+        self.digest = None  # Of the whole document, if recorded
+        self.schema_digests = {}  # Index of each schema in the document -> its digest, if recorded
@@ -0,0 +1,162 @@
+"""
+Retries with backoff and hedged requests for idempotent operations.
+"""
+from foamy.excs import ConnectionFailed, HTTPError, TransportError
+import Queue
+import copy
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def is_replayable(request):
+    # Streamed bodies (generators) can only be sent once
+    return (request.data is None or isinstance(request.data, bytes))
+
+
+class RetryPolicy(object):
+    def __init__(self, max_attempts=3, backoff=0.1, max_backoff=5.0, jitter=True, retry_statuses=None):
+        """
+        :param max_attempts: Total number of attempts, including the first one.
+        :param backoff: Base delay in seconds; doubled on each further attempt.
+        :param max_backoff: Upper bound for a single delay.
+        :param jitter: Whether to pick the delay uniformly between 0 and the exponential bound
+                       ("full jitter") to keep clients from retrying in lockstep.
+        :param retry_statuses: HTTP status codes to retry on. Defaults to all 5xx codes.
+        """
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_statuses = (frozenset(retry_statuses) if retry_statuses is not None else None)
+
+    def is_retryable(self, exc):
+        if isinstance(exc, ConnectionFailed):
+            return True
+        if isinstance(exc, HTTPError):
+            if self.retry_statuses is None:
+                return (500 <= exc.code < 600)
+            return (exc.code in self.retry_statuses)
+        return False
+
+    def get_delay(self, attempt):
+        """ :param attempt: Zero-based index of the attempt that just failed. """
+        delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+
+class HedgePolicy(object):
+    def __init__(self, quantile=0.95, min_samples=20, min_delay=0.005):
+        """
+        :param quantile: Send a second copy of the request when the first hasn't answered
+                         within this quantile of the operation's observed latency.
+        :param min_samples: Don't hedge before this many latencies have been observed.
+        :param min_delay: Never hedge sooner than this many seconds.
+        """
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+
+    def get_delay(self, stats):
+        if len(stats.latency) < self.min_samples:
+            return None
+        return max(self.min_delay, stats.latency.quantile(self.quantile))
+
+
+class _Attempt(threading.Thread):
+    def __init__(self, send, request, results):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.send = send
+        self.request = request
+        self.results = results
+        self.cancelled = False
+
+    def run(self):
+        try:
+            result = (self, self.send(self.request), None)
+        except Exception as exc:
+            result = (self, None, exc)
+        self.results.put(result)
+        if self.cancelled:  # Checked after putting, so `send_hedged` either drains the result or has set this
+            self.discard(result[1])
+
+    def discard(self, response):
+        body_file = getattr(response, "body_file", None)
+        if body_file is not None:
+            body_file.close()
+
+
+def send_hedged(send, request, alternate_url, delay, stats):
+    """
+    Send `request`; if it hasn't completed within `delay` seconds, send a copy
+    (to `alternate_url` if given) and return whichever answers first.
+
+    The losing attempt can't be interrupted mid-flight, but it is marked as cancelled
+    and its result is discarded as soon as it completes.
+    """
+    results = Queue.Queue()
+    primary = _Attempt(send, request, results)
+    primary.start()
+    try:
+        return _unpack(results.get(timeout=delay))
+    except Queue.Empty:
+        pass
+
+    hedge_request = copy.copy(request)
+    hedge_request.headers = dict(request.headers)
+    if alternate_url:
+        hedge_request.url = alternate_url
+    hedge = _Attempt(send, hedge_request, results)
+    hedge.start()
+    stats.increment("hedges")
+    logger.debug("Hedging %s after %.3f s", stats.operation.name, delay)
+
+    attempt, response, exc = results.get()
+    if exc is not None:  # First one to finish failed; the other one may still succeed.
+        attempt, response, exc = results.get()
+    loser = (hedge if attempt is primary else primary)
+    loser.cancelled = True
+    try:  # The loser may have finished already
+        loser.discard(results.get_nowait()[1])
+    except Queue.Empty:
+        pass
+    if attempt is hedge and exc is None:
+        stats.increment("hedge_wins")
+    return _unpack((attempt, response, exc))
+
+
+def _unpack(result):
+    attempt, response, exc = result
+    if exc is not None:
+        raise exc
+    return response
+
+
+def send_with_retries(send, request, policy, stats):
+    """ Call `send(request)`, retrying transport failures that `policy` deems retryable. """
+    attempt = 0
+    while True:
+        try:
+            return send(request)
+        except TransportError as exc:
+            stats.increment("failures")
+            if (
+                policy is None or
+                attempt + 1 >= policy.max_attempts or
+                not policy.is_retryable(exc) or
+                not is_replayable(request)
+            ):
+                raise
+            delay = policy.get_delay(attempt)
+            if request.deadline is not None and request.deadline.remaining() <= delay:
+                raise  # No time left for another attempt
+            logger.debug("Retrying %s in %.3f s after %s", stats.operation.name, delay, exc)
+            time.sleep(delay)
+            attempt += 1
+            stats.increment("retries")
@@ -5,3 +5,9 @@ def open_soap(wsdl_url, **context_kwargs):
     ctx = Context(**context_kwargs)
     ctx.read_wsdl_from_url(wsdl_url)
     return ctx
+
+
+def open_fleet(wsdl_urls, threads=8, **context_kwargs):
+    """ Load several WSDLs concurrently; see `foamy.fleet.FleetLoader`. :return: `foamy.fleet.Fleet` """
+    from foamy.fleet import FleetLoader  # Deferred; keeps `open_soap` imports lean
+    return FleetLoader(threads=threads, **context_kwargs).load(wsdl_urls)
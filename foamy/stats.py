@@ -0,0 +1,54 @@
+import collections
+import threading
+
+
+class LatencyTracker(object):
+    """ Keeps the most recent call latencies and answers quantile queries over them. """
+
+    def __init__(self, size=1000):
+        self.samples = collections.deque(maxlen=size)
+        self.lock = threading.Lock()
+        self._sorted = None
+
+    def record(self, latency):
+        with self.lock:
+            self.samples.append(latency)
+            self._sorted = None
+
+    def quantile(self, q):
+        """ :return: The `q` quantile (0..1) of recent latencies, or None if nothing has been recorded. """
+        with self.lock:
+            if not self.samples:
+                return None
+            if self._sorted is None:
+                self._sorted = sorted(self.samples)
+            values = self._sorted
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def __len__(self):
+        return len(self.samples)
+
+
+class OperationStats(object):
+    COUNTERS = ("calls", "failures", "retries", "hedges", "hedge_wins")
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.latency = LatencyTracker()
+        self.lock = threading.Lock()
+        for counter in self.COUNTERS:
+            setattr(self, counter, 0)
+
+    def increment(self, counter, amount=1):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    def as_dict(self):
+        out = dict((counter, getattr(self, counter)) for counter in self.COUNTERS)
+        out["p50"] = self.latency.quantile(0.5)
+        out["p95"] = self.latency.quantile(0.95)
+        out["p99"] = self.latency.quantile(0.99)
+        return out
+
+    def __str__(self):
+        return "<OperationStats %s: %s>" % (self.operation.name, self.as_dict())
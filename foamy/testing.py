@@ -0,0 +1,158 @@
+"""
+A local HTTP server that stands in for a real SOAP endpoint in tests and benchmarks.
+"""
+from foamy.compression import Decoder, compress
+import BaseHTTPServer
+import SocketServer
+import socket
+import sys
+import threading
+import time
+
+
+class StandInRequest(object):
+    def __init__(self, method, path, headers, raw_body):
+        # `headers` has lower-cased keys
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.raw_body = raw_body
+
+    def _get_body(self):
+        decoder = Decoder(self.headers.get("content-encoding"))
+        return decoder.decode(self.raw_body) + decoder.flush()
+
+    body = property(_get_body)
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Buffer each response and send it at once; separate small writes stall on Nagle's algorithm
+    # and the client's delayed ACKs, adding some 40 ms to every call
+    wbufsize = -1
+
+    def _read_chunked(self):
+        chunks = []
+        while True:
+            line = self.rfile.readline()
+            if not line:  # The client gave up mid-body
+                return None
+            size = int(line.split(";")[0].strip(), 16)
+            if not size:
+                self.rfile.readline()
+                break
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+        return "".join(chunks)
+
+    def _handle(self):
+        if "chunked" in self.headers.get("Transfer-Encoding", ""):
+            raw_body = self._read_chunked()
+            if raw_body is None:
+                self.close_connection = 1
+                return
+        else:
+            length = int(self.headers.get("Content-Length") or 0)
+            raw_body = (self.rfile.read(length) if length else "")
+        request = StandInRequest(self.command, self.path, dict((key.lower(), value) for (key, value) in self.headers.items()), raw_body)
+        self.server.stand_in.requests.append(request)
+        code, headers, body = self.server.stand_in.handler(request)
+        headers = dict(headers or {})
+        encoding = self.server.stand_in.response_encoding
+        if encoding and encoding in request.headers.get("accept-encoding", ""):
+            body = compress(body, encoding)
+            headers["Content-Encoding"] = encoding
+        self.send_response(code)
+        for key, value in headers.iteritems():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        trickle = self.server.stand_in.trickle
+        if trickle:
+            self.wfile.flush()
+            for byte in body:
+                self.wfile.write(byte)
+                self.wfile.flush()
+                time.sleep(trickle)
+        else:
+            self.wfile.write(body)
+
+    do_GET = do_POST = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        BaseHTTPServer.HTTPServer.__init__(self, *args, **kwargs)
+        self.connections = set()
+        self.closing = False
+
+    def process_request(self, request, client_address):
+        self.connections.add(request)
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+        self.connections.discard(request)
+
+    def handle_error(self, request, client_address):
+        if self.closing:
+            return
+        if isinstance(sys.exc_info()[1], socket.error):  # The client gave up, e.g. after a timeout
+            return
+        BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+    def close_connections(self):
+        # Wake up handlers blocked on idle keep-alive connections
+        self.closing = True
+        for sock in list(self.connections):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        deadline = time.time() + 5
+        while self.connections and time.time() < deadline:
+            time.sleep(0.01)
+
+
+class StandInServer(object):
+    def __init__(self, handler, response_encoding=None, host="127.0.0.1", port=0, trickle=None):
+        """
+        :param handler: Callable taking a `StandInRequest` and returning (code, headers, body).
+        :param response_encoding: Compress response bodies with this encoding when the client accepts it.
+        :param trickle: Send response bodies a byte at a time, this many seconds apart, like a struggling server.
+        """
+        self.handler = handler
+        self.response_encoding = response_encoding
+        self.trickle = trickle
+        self.requests = []
+        self.server = _ThreadingHTTPServer((host, port), StandInHandler)
+        self.server.stand_in = self
+        self.thread = None
+
+    def _get_url(self):
+        host, port = self.server.server_address
+        return "http://%s:%d/" % (host, port)
+
+    url = property(_get_url)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.close_connections()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -1,24 +1,184 @@
+from foamy.compression import decode_chunks
+from foamy.deadline import watch_sockets
+from foamy.excs import ConnectionFailed, DeadlineExceeded, HTTPError
+from foamy.mtom import is_multipart, parse_multipart
 from foamy.objs import Response
+from foamy.xmlutils import feed_parse
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3 import connection, connectionpool
+from requests.packages.urllib3.exceptions import ProtocolError, ReadTimeoutError
 import logging
 import requests
+import threading
 logger = logging.getLogger(__name__)
+_local = threading.local()  # `watch`: the `SocketWatch` of the call being dispatched on this thread, if any
+
+CONNECTION_ERRORS = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    ProtocolError,
+    ReadTimeoutError,
+)
+
+
+def _watch(sock):
+    watch = getattr(_local, "watch", None)
+    if watch is not None and sock is not None:
+        watch.add(sock)
+
+
+class _WatchedHTTPConnection(connection.HTTPConnection):
+    """ Adds its socket to the current call's `SocketWatch`, whether it is new or reused from the pool. """
+
+    def connect(self):
+        connection.HTTPConnection.connect(self)
+        _watch(self.sock)
+
+    def send(self, data):
+        _watch(self.sock)
+        connection.HTTPConnection.send(self, data)
+
+
+class _WatchedHTTPSConnection(connection.HTTPSConnection):
+    def connect(self):
+        connection.HTTPSConnection.connect(self)
+        _watch(self.sock)
+
+    def send(self, data):
+        _watch(self.sock)
+        connection.HTTPSConnection.send(self, data)
+
+
+class _WatchedHTTPConnectionPool(connectionpool.HTTPConnectionPool):
+    ConnectionCls = _WatchedHTTPConnection
+
+
+class _WatchedHTTPSConnectionPool(connectionpool.HTTPSConnectionPool):
+    ConnectionCls = _WatchedHTTPSConnection
+
+
+class _WatchedAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _WatchedHTTPConnectionPool,
+            "https": _WatchedHTTPSConnectionPool,
+        }
 
 
 class RequestsTransport(object):
-    def __init__(self):
+    def __init__(
+        self, stream=False, chunk_size=65536, spool_threshold=None, attachment_threshold=1024 * 1024,
+        timeout=None, connect_timeout=None
+    ):
+        """
+        :param stream: Whether to feed response bodies into the XML parser while they are being
+                       downloaded, instead of reading them into memory first.
+                       Requests may override this with their `stream` attribute.
+        :param chunk_size: Read size for streamed responses.
+        :param spool_threshold: When streaming, also keep the raw body, spooled to a temporary file
+                                when larger than this many bytes. None to not keep the raw body at all.
+        :param attachment_threshold: MIME attachments of multipart responses larger than this many bytes
+                                     are spooled to temporary files.
+        :param timeout: Seconds to wait for each socket read for requests without a deadline.
+                        None to wait forever.
+        :param connect_timeout: Seconds to wait for a connection. Defaults to `timeout`, or
+                                for requests with a deadline, to whatever is left of it.
+        """
         self.session = requests.session()
+        for prefix in ("http://", "https://"):  # So that deadlines can cut off slow sends and reads
+            self.session.mount(prefix, _WatchedAdapter())
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.spool_threshold = spool_threshold
+        self.attachment_threshold = attachment_threshold
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+
+    def get_timeout(self, request):
+        """ :return: The (connect, read) timeout for `request`, or None. """
+        if request.deadline is not None:
+            # Sending and every read get whatever is left, and a `SocketWatch` cuts off a call that outlasts it
+            remaining = request.deadline.check("sending %s" % request.url)
+            return (min(self.connect_timeout or remaining, remaining), remaining)
+        if self.timeout is None and self.connect_timeout is None:
+            return None
+        return (self.connect_timeout or self.timeout, self.timeout)
 
     def dispatch(self, request):
         kw = {"url": request.url, "headers": request.headers}
         if request.data:
-            kw["method"] = "POST"
+            kw["method"] = (request.method or "POST")
             kw["data"] = request.data
+            if request.deadline is not None and not isinstance(request.data, bytes):  # A streamed body
+                kw["data"] = request.deadline.iter_checked(request.data, "sending %s" % request.url)
         else:
-            kw["method"] = "GET"
+            kw["method"] = (request.method or "GET")
+
+        stream = (self.stream if request.stream is None else request.stream)
+        deadline = request.deadline
+        if stream or deadline is not None:  # With a deadline, the body is read here chunk by chunk
+            kw["stream"] = True
+        timeout = self.get_timeout(request)
+        if timeout is not None:
+            kw["timeout"] = timeout
 
         logger.debug("DISPATCHING: %s -> %s: %s", kw["method"], kw["url"], kw.get("data", ""))
 
+        try:
+            with watch_sockets(deadline, "talking to %s" % request.url) as watch:
+                _local.watch = watch
+                try:
+                    return self._exchange(request, kw, stream)
+                finally:
+                    _local.watch = None
+        except CONNECTION_ERRORS as exc:
+            if deadline is not None and deadline.expired:
+                raise DeadlineExceeded("Deadline of %.3f s exceeded: %s: %s" % (deadline.timeout, request.url, exc), deadline)
+            raise ConnectionFailed("%s: %s" % (request.url, exc))
+
+    def _exchange(self, request, kw, stream):
+        deadline = request.deadline
         resp = self.session.request(**kw)
-        resp.raise_for_status()
+        body = None
+        if deadline is not None and not stream:
+            try:
+                body = b"".join(deadline.iter_checked(resp.iter_content(self.chunk_size), "reading %s" % request.url))
+            finally:
+                resp.close()
+        elif not stream or resp.status_code >= 400:
+            body = resp.content
+        if resp.status_code >= 400:
+            raise HTTPError(
+                "HTTP %d (%s) from %s" % (resp.status_code, resp.reason, request.url),
+                Response(request, resp.status_code, resp.headers, body)
+            )
+        if stream:
+            return self._read_streamed(request, resp)
+        return self._read_buffered(request, resp, body)
+
+    def _read_buffered(self, request, resp, body):
+        content_type = resp.headers.get("Content-Type")
+        if is_multipart(content_type):
+            tree, attachments = parse_multipart([body], content_type, self.attachment_threshold, request.parsers)
+            return Response(request, resp.status_code, resp.headers, body, tree=tree, attachments=attachments)
+        return Response(request, resp.status_code, resp.headers, body)
 
-        return Response(request, resp.status_code, resp.headers, resp.content)
+    def _read_streamed(self, request, resp):
+        content_type = resp.headers.get("Content-Type")
+        try:
+            # Read the raw stream and decompress it ourselves, so decoding also happens chunk by chunk
+            chunks = resp.raw.stream(self.chunk_size, decode_content=False)
+            if request.deadline is not None:
+                chunks = request.deadline.iter_checked(chunks, "reading %s" % request.url)
+            chunks = decode_chunks(chunks, resp.headers.get("Content-Encoding"))
+            if is_multipart(content_type):
+                tree, attachments = parse_multipart(chunks, content_type, self.attachment_threshold, request.parsers)
+                body_file = None
+            else:
+                tree, body_file = feed_parse(chunks, self.spool_threshold, request.parsers, request.keep)
+                attachments = None
+        finally:
+            resp.close()
+        return Response(request, resp.status_code, resp.headers, None, tree=tree, body_file=body_file, attachments=attachments)
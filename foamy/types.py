@@ -1,9 +1,13 @@
 # -- encoding: UTF-8 --
+from foamy import lazy
 from foamy.excs import XMLValueError
+from foamy.mtom import write_text
 from foamy.ns import COMMON_NAMESPACES as NS
 from foamy.objs import ContextBoundObject
+from foamy.records import get_record_plan
 from foamy.xmlutils import self_or_child
 from lxml.etree import Element, tostring
+import collections
 import logging
 import sys
 
@@ -11,6 +15,22 @@ import sys
 logger = logging.getLogger(__name__)
 SENTINEL = object()
 SIMPLE_CONTENT_TAG = NS.tag("schema", "simpleContent")
+SIMPLE_TYPE_TAG = NS.tag("schema", "simpleType")
+COMPLEX_TYPE_TAG = NS.tag("schema", "complexType")
+ELEMENT_TAG = NS.tag("schema", "element")
+SEQUENCE_TAG = NS.tag("schema", "sequence")
+ALL_TAG = NS.tag("schema", "all")
+ATTRIBUTE_TAG = NS.tag("schema", "attribute")
+RESTRICTION_TAG = NS.tag("schema", "restriction")
+ENUMERATION_TAG = NS.tag("schema", "enumeration")
+FACET_NAMES = dict((NS.tag("schema", name), name) for name in (
+    "pattern", "length", "minLength", "maxLength", "minInclusive", "maxInclusive",
+    "minExclusive", "maxExclusive", "totalDigits", "fractionDigits",
+))
+EXTENSION_TAG = NS.tag("schema", "extension")
+UNION_TAG = NS.tag("schema", "union")
+LIST_TAG = NS.tag("schema", "list")
+ANNOTATION_TAG = NS.tag("schema", "annotation")
 
 
 class MarshalValueError(ValueError):
@@ -24,6 +44,20 @@ class BaseType(object):
     def unmarshal(self, node):
         raise NotImplementedError("Not implemented: unmarshal()")
 
+    def unmarshal_lazy(self, node):
+        """ Like `unmarshal`, but may return a `LazyRecord` that converts its fields on access. """
+        return self.unmarshal(node)
+
+    def write(self, xf, obj):
+        """
+        Write what `marshal` would return for `obj` to the `lxml.etree.xmlfile` writer `xf`.
+
+        This is a generator that yields after each repeated (maxOccurs > 1) element written,
+        so the caller can pass the output on as it's produced.
+        """
+        xf.write(self.marshal(obj))
+        yield
+
     def craft(self):
         raise NotImplementedError("Not implemented: craft()")
 
@@ -54,6 +88,7 @@ class Type(ContextBoundObject, BaseType):
         self.max_occurs = 1
         self.attributes = {}
         self.restriction = None
+        self.facets = {}  # Restriction facets other than enumerations; name -> value ("pattern" -> list of them)
 
     def parse_xmlschema_element(self, nsmap, element):
         base = element.get("type")
@@ -69,20 +104,29 @@ class Type(ContextBoundObject, BaseType):
         self._read_restriction(nsmap, element)
 
     def _read_restriction(self, nsmap, element):
-        rest_tag = element.find(NS.tag("schema", "restriction"))
+        rest_tag = next(element.iterchildren(RESTRICTION_TAG), None)
         if rest_tag is None:
             return
         rest_base = self.context.resolve_type(nsmap.to_qname(rest_tag.get("base")))
         restriction = []
-        for enum_tag in rest_tag.findall(NS.tag("schema", "enumeration")):
-            enum_val = rest_base.unmarshal(enum_tag.text or enum_tag.get("value"))
-            restriction.append(enum_val)
+        facets = {}
+        for facet_tag in rest_tag.iterchildren():
+            if facet_tag.tag == ENUMERATION_TAG:
+                enum_val = rest_base.unmarshal(facet_tag.text or facet_tag.get("value"))
+                restriction.append(enum_val)
+            elif facet_tag.tag in FACET_NAMES:
+                facet = FACET_NAMES[facet_tag.tag]
+                if facet == "pattern":  # Several patterns are alternatives
+                    facets.setdefault(facet, []).append(facet_tag.get("value"))
+                else:
+                    facets[facet] = facet_tag.get("value")
         self.restriction = restriction
+        self.facets = facets
         if not self.base and rest_base:
             self.base = rest_base
 
     def _read_attributes(self, nsmap, element):
-        for attr_tag in element.findall(NS.tag("schema", "attribute")):
+        for attr_tag in element.iterchildren(ATTRIBUTE_TAG):
             attr_name = attr_tag.get("name")
             attr_type = self.context.resolve_type(nsmap.to_qname(attr_tag.get("type")))
             self.attributes[attr_name] = attr_type
@@ -97,21 +141,60 @@ class Type(ContextBoundObject, BaseType):
     def marshal(self, obj):
         node = Element(self.qname)
         if self.base:
-            node.text = self._get_base_marshal(obj)
+            value = self._get_base_marshal(obj)
+            if hasattr(value, "tag"):  # A named complex type; adopt its content
+                node.attrib.update(value.attrib)
+                node.text = value.text
+                node.extend(value)
+            else:
+                node.text = value
         if self.attributes:
             for key, value in read_object_values(obj, self.attributes).iteritems():
                 node.attrib[key] = value
         return node
 
+    def _get_write_attrib(self, obj):
+        if not self.attributes and not isinstance(self.base, BaseComplexType):
+            return None
+        attrib = {}
+        if isinstance(self.base, BaseComplexType):
+            attrib.update(self.base._get_write_attrib(obj) or {})
+        if self.attributes:
+            attrib.update(read_object_values(obj, self.attributes))
+        return attrib
+
+    def write_content(self, xf, obj):
+        """ Write the text and children of this type's element for `obj`; a generator like `write`. """
+        if isinstance(self.base, BaseComplexType):
+            for _ in self.base.write_content(xf, obj):
+                yield
+        elif self.base:
+            text = self._get_base_marshal(obj)
+            if text is not None:
+                write_text(xf, text)
+
+    def write(self, xf, obj):
+        with xf.element(self.qname, self._get_write_attrib(obj) or None):
+            for _ in self.write_content(xf, obj):
+                yield
+
     def unmarshal(self, node):
         # XXX: This doesn't do anything near the Right Thing, but it does something.
-        assert (node.tag == self.qname)
+        # (A named complex type reads the content of whichever element is declared with it.)
+        assert (node.tag == self.qname or isinstance(self, BaseComplexType))
         basic_um = None
         if self.base:
-            basic_um = self.base.unmarshal(node.text)
+            if isinstance(self.base, BaseComplexType):  # Its content is this element's, as in `marshal`
+                basic_um = self.base.unmarshal(node)
+            else:
+                basic_um = self.base.unmarshal(node.text)
             if not self.attributes and basic_um is not None:
                 return basic_um
 
+        plan = get_record_plan(self)
+        if plan is not None:
+            return plan.unmarshal(node, basic_um)
+
         out = {}
         for attr_name, attr_type in self.attributes.iteritems():
             out["_%s" % attr_name] = node.attrib.get(attr_name)
@@ -132,6 +215,16 @@ class TypeList(object):
         return iter(self.content)
 
     def marshal(self, obj, always_allow_multiple=False):
+        for t, val in self.iter_values(obj, always_allow_multiple):
+            yield t.marshal(val)
+
+    def iter_values(self, obj, always_allow_multiple=False):
+        """
+        Yield (type, value) for each element to marshal from `obj`, in order.
+
+        Repeated values may be given as lists, tuples or iterators (such as generators);
+        iterators are consumed lazily, with occurrence limits checked as they go.
+        """
         if isinstance(obj, (list, tuple)) and len(obj) == len(self.keys):
             vals = dict(zip(self.keys, obj))
         else:
@@ -141,6 +234,10 @@ class TypeList(object):
             if t.name in vals:
                 val = vals[t.name]
                 if not isinstance(val, (list, tuple)):
+                    if hasattr(val, "next"):  # An iterator
+                        for sval in self._iter_counted(t, val, always_allow_multiple):
+                            yield t, sval
+                        continue
                     val = (val,)
                 if not always_allow_multiple and len(val) > t.max_occurs:
                     raise MarshalValueError("%s:%s has max_occurs %d, but got %d values" % (self.parent, t.name, t.max_occurs, len(val)))
@@ -148,20 +245,30 @@ class TypeList(object):
                     raise MarshalValueError("%s:%s has min_occurs %d, but got %d values" % (self.parent, t.name, t.min_occurs, len(val)))
 
                 for sval in val:
-                    yield t.marshal(sval)
+                    yield t, sval
             else:
                 if t.nillable:
-                    yield t.marshal(None)
+                    yield t, None
                     continue
                 if t.min_occurs > 0:
                     raise MarshalValueError("Value %s:%s is required (min_occurs %d), but no value could be found." % (self.parent, t.name, t.min_occurs))
 
+    def _iter_counted(self, t, values, always_allow_multiple):
+        count = 0
+        for sval in values:
+            count += 1
+            if not always_allow_multiple and count > t.max_occurs:
+                raise MarshalValueError("%s:%s has max_occurs %d, but got more values" % (self.parent, t.name, t.max_occurs))
+            yield sval
+        if count < t.min_occurs:
+            raise MarshalValueError("%s:%s has min_occurs %d, but got %d values" % (self.parent, t.name, t.min_occurs, count))
+
 
 class BaseComplexType(Type):
-    def parse_type_list(self, nsmap, list_el):
+    def parse_type_list(self, nsmap, list_el, optional=False):
         lst = []
-        for element in list_el.findall(NS.tag("schema", "element")):
-            typeobj = type_from_xmlschema_element(nsmap, self.context, self.ns, element)
+        for element in list_el.iterchildren(ELEMENT_TAG):
+            typeobj = local_element_type(nsmap, self.context, self.ns, element, optional)
             lst.append(typeobj)
         return TypeList(self, lst)
 
@@ -169,8 +276,8 @@ class BaseComplexType(Type):
 class ComplexSequenceType(BaseComplexType):
     def parse_xmlschema_element(self, nsmap, element):
         super(ComplexSequenceType, self).parse_xmlschema_element(nsmap, element)
-        complex_type = self_or_child(element, NS.tag("schema", "complexType"))
-        self.sequence = self.parse_type_list(nsmap, complex_type.find(NS.tag("schema", "sequence")))
+        complex_type = self_or_child(element, COMPLEX_TYPE_TAG)
+        self.sequence = self.parse_type_list(nsmap, complex_type.find(SEQUENCE_TAG))
 
     def marshal(self, obj):
         out = BaseComplexType.marshal(self, obj)
@@ -178,26 +285,56 @@ class ComplexSequenceType(BaseComplexType):
             out.append(el)
         return out
 
+    def write_content(self, xf, obj):
+        for _ in BaseComplexType.write_content(self, xf, obj):
+            yield
+        for t, value in self.sequence.iter_values(obj):
+            for _ in t.write(xf, value):
+                yield
+            if t.max_occurs > 1:
+                yield
+
     def unmarshal(self, node):
         out = BaseComplexType.unmarshal(self, node)
+        if not isinstance(out, dict):  # A basic value, or a record (whose plan reads the sequence too)
+            return out
         for t in self.sequence:
             ttag = node.find(t.qname)
             if ttag is not None:
                 out[t.name] = t.unmarshal(ttag)
         return out
 
+    def unmarshal_lazy(self, node):
+        assert (node.tag == self.qname)
+        if self.base and not self.attributes:  # Mirror `Type.unmarshal`'s shortcut for simple values
+            basic_um = self.base.unmarshal(node.text)
+            if basic_um is not None:
+                return basic_um
+        return lazy.LazyRecord(node, self.lazy_fields)
+
+    def _get_lazy_fields(self):
+        fields = self.__dict__.get("_lazy_fields")
+        if fields is None:
+            fields = collections.OrderedDict()
+            for attr_name in self.attributes:
+                fields["_%s" % attr_name] = (lazy.ATTRIBUTE, attr_name, None)
+            if self.base:
+                fields["$"] = (lazy.TEXT, None, self.base)
+            for t in self.sequence:
+                fields.setdefault(t.name, (lazy.CHILD, t.qname, t))
+            self._lazy_fields = fields
+        return fields
+
+    lazy_fields = property(_get_lazy_fields)
+
 
 class ComplexAllType(BaseComplexType):
     def parse_xmlschema_element(self, nsmap, element):
         super(ComplexAllType, self).parse_xmlschema_element(nsmap, element)
-        complex_type = self_or_child(element, NS.tag("schema", "complexType"))
-        self.all = self.parse_type_list(nsmap, complex_type.find(NS.tag("schema", "all")))
-        for type in self.all:
-            type.min_occurs = 0
-
-    def marshal(self, obj):
-        out = BaseComplexType.marshal(self, obj)
+        complex_type = self_or_child(element, COMPLEX_TYPE_TAG)
+        self.all = self.parse_type_list(nsmap, complex_type.find(ALL_TAG), optional=True)
 
+    def _check_keys(self, obj):
         if hasattr(obj, "keys"):
             obj_keys = set(obj.keys())
             allowed_keys = set(self.all.keys)
@@ -205,10 +342,23 @@ class ComplexAllType(BaseComplexType):
             if in_obj_not_allowed:
                 raise ValueError("ComplexAllType marshalling: Object %r has extraneous keys (%r)" % (obj, sorted(in_obj_not_allowed)))
 
+    def marshal(self, obj):
+        out = BaseComplexType.marshal(self, obj)
+        self._check_keys(obj)
         for el in self.all.marshal(obj, True):
             out.append(el)
         return out
 
+    def write_content(self, xf, obj):
+        self._check_keys(obj)
+        for _ in BaseComplexType.write_content(self, xf, obj):
+            yield
+        for t, value in self.all.iter_values(obj, True):
+            for _ in t.write(xf, value):
+                yield
+            if t.max_occurs > 1:
+                yield
+
     def unmarshal(self, obj):
         raise NotImplementedError("Not implemented: ComplexAllType.unmarshal()")
 
@@ -217,7 +367,7 @@ class SimpleContentType(Type):
     def parse_xmlschema_element(self, nsmap, element):
         super(SimpleContentType, self).parse_xmlschema_element(nsmap, element)
         simple_content = self_or_child(element, SIMPLE_CONTENT_TAG)
-        ext_tag = simple_content.find(NS.tag("schema", "extension"))
+        ext_tag = simple_content.find(EXTENSION_TAG)
         if ext_tag is None:
             raise XMLValueError("simpleContent without s:extension...", simple_content)
         base = ext_tag.get("base")
@@ -228,33 +378,67 @@ class SimpleContentType(Type):
 class SimpleType(Type):
     def parse_xmlschema_element(self, nsmap, element):
         super(SimpleType, self).parse_xmlschema_element(nsmap, element)
-        if element.find(NS.tag("schema", "union")) is not None:
+        if element.find(UNION_TAG) is not None:
             raise NotImplementedError("Not implemented: unions")
-        if element.find(NS.tag("schema", "list")) is not None:
+        if element.find(LIST_TAG) is not None:
             raise NotImplementedError("Not implemented: lists")
 
+    def _read_restriction(self, nsmap, element):
+        # For an element with an anonymous simple type, the restriction is in that
+        super(SimpleType, self)._read_restriction(nsmap, self_or_child(element, SIMPLE_TYPE_TAG))
+
+    def get_validator(self):
+        """ The function checking marshalled values against this type's facets (None if it has none), compiled on first use. """
+        validator = self.__dict__.get("_validator", SENTINEL)
+        if validator is SENTINEL:
+            from foamy.facets import compile_validator  # Deferred; only needed in strict mode
+            validator = self._validator = compile_validator(self)
+        return validator
+
     def marshal(self, obj):
-        return self._get_base_marshal(obj)
+        text = self._get_base_marshal(obj)
+        if self.context.strict and text is not None:
+            validator = self.get_validator()
+            if validator is not None:
+                validator(obj, text)
+        return text
+
+    write = BaseType.write.__func__
 
     def unmarshal(self, obj):
         raise NotImplementedError("Not implemented: SimpleType::unmarshal")
 
 
+def classify_xmlschema_element(element):
+    """
+    Find the complexType, simpleType and simpleContent definitions for a schema element
+    (the element itself or one of its direct children) in a single pass over its children.
+    """
+    found = {COMPLEX_TYPE_TAG: None, SIMPLE_TYPE_TAG: None, SIMPLE_CONTENT_TAG: None}
+    if element.tag in found:
+        found[element.tag] = element
+    for child in element:
+        if found.get(child.tag, element) is None:
+            found[child.tag] = child
+    return found[COMPLEX_TYPE_TAG], found[SIMPLE_TYPE_TAG], found[SIMPLE_CONTENT_TAG]
+
+
 def type_from_xmlschema_element(nsmap, context, tns, element, defer=False):
-    complex_type = self_or_child(element, NS.tag("schema", "complexType"))
-    simple_type = self_or_child(element, NS.tag("schema", "simpleType"))
-    simple_content = self_or_child(element, SIMPLE_CONTENT_TAG)
+    complex_type, simple_type, simple_content = classify_xmlschema_element(element)
 
     if simple_type is not None:
         cls = SimpleType
     elif simple_content is not None:
         cls = SimpleContentType
     elif complex_type is not None:
-        if complex_type.find(NS.tag("schema", "all")) is not None:
-            cls = ComplexAllType
-        elif complex_type.find(NS.tag("schema", "sequence")) is not None:
-            cls = ComplexSequenceType
-        else:
+        cls = None
+        for child in complex_type:
+            if child.tag == ALL_TAG:
+                cls = ComplexAllType
+                break
+            elif child.tag == SEQUENCE_TAG and cls is None:
+                cls = ComplexSequenceType
+        if cls is None:
             raise ValueError("Unparsable complexType!")
     else:
         cls = Type
@@ -267,3 +451,60 @@ def type_from_xmlschema_element(nsmap, context, tns, element, defer=False):
         type.parse_xmlschema_element(nsmap, element)
 
     return type
+
+
+def structural_key(nsmap, tns, element, optional=False):
+    """
+    A key for what a local element declaration parses into, equal for declarations that
+    parse into identical types; None for ones with content of their own (inline types,
+    attributes or restrictions), which aren't compared.
+    """
+    for child in element:
+        if child.tag != ANNOTATION_TAG and isinstance(child.tag, basestring):
+            return None
+    type_name = element.get("type")
+    ref = element.get("ref")
+    return (
+        tns, element.get("name"),
+        (nsmap.to_qname(type_name) if type_name else None), (nsmap.to_qname(ref) if ref else None),
+        element.get("nillable") == "true", ("0" if optional else element.get("minOccurs", "1")), element.get("maxOccurs", "1"),
+    )
+
+
+def ref_type(nsmap, context, element, optional=False):
+    """ The type for an `<element ref="...">` declaration. """
+    target = context.resolve_type(nsmap.to_qname(element.get("ref")))
+    type = Type(context, target.ns, target.name)
+    type.parse_xmlschema_element(nsmap, element)
+    if optional:
+        type.min_occurs = 0
+    if (type.min_occurs, type.max_occurs, type.nillable) == (target.min_occurs, target.max_occurs, target.nillable):
+        return target  # The global declaration itself will do
+    # Otherwise wrap it like an element of a named type
+    type.base = target
+    return type
+
+
+def local_element_type(nsmap, context, tns, element, optional=False):
+    """
+    The type for an element declared within a complex type.
+
+    Structurally identical declarations in a context share one type object (see
+    `structural_key`), so types must not be modified after parsing.
+
+    :param optional: Whether the element may be left out regardless of its minOccurs (as in `xs:all`).
+    """
+    key = (structural_key(nsmap, tns, element, optional) if context.intern_types else None)
+    if key is not None:
+        type = context.interned_types.get(key)
+        if type is not None:
+            return type
+    if element.get("ref"):
+        type = ref_type(nsmap, context, element, optional)
+    else:
+        type = type_from_xmlschema_element(nsmap, context, tns, element)
+        if optional:
+            type.min_occurs = 0
+    if key is not None:
+        context.interned_types[key] = type
+    return type
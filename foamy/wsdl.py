@@ -1,105 +1,350 @@
 from foamy.ns import COMMON_NAMESPACES as NS
-from foamy.objs import Binding, SOAPBinding, Message, OperationPart, PortType, Operation, Service, Port
-from foamy.types import type_from_xmlschema_element
+from foamy.objs import Binding, HTTPBinding, SOAPBinding, Message, OperationPart, PortType, Operation, Service, Port
+from foamy.registry import Document
+from foamy.types import type_from_xmlschema_element, SIMPLE_TYPE_TAG, ELEMENT_TAG, COMPLEX_TYPE_TAG
+from lxml.etree import Element, tostring
+import hashlib
 import logging
 logger = logging.getLogger(__name__)
 
+DEFINITIONS_TAG = NS.tag("wsdl", "definitions")
+TYPES_TAG = NS.tag("wsdl", "types")
+MESSAGE_TAG = NS.tag("wsdl", "message")
+PORT_TYPE_TAG = NS.tag("wsdl", "portType")
+BINDING_TAG = NS.tag("wsdl", "binding")
+SERVICE_TAG = NS.tag("wsdl", "service")
+PART_TAG = NS.tag("wsdl", "part")
+OPERATION_TAG = NS.tag("wsdl", "operation")
+INPUT_TAG = NS.tag("wsdl", "input")
+OUTPUT_TAG = NS.tag("wsdl", "output")
+FAULT_TAG = NS.tag("wsdl", "fault")
+DOCUMENTATION_TAG = NS.tag("wsdl", "documentation")
+PORT_TAG = NS.tag("wsdl", "port")
+SCHEMA_TAG = NS.tag("schema", "schema")
+ADDRESS_TAGS = {  # Address tag -> (preference, protocol); a port with several addresses uses the most preferred
+    NS.tag("soap", "address"): (0, "soap"),
+    NS.tag("soap12", "address"): (1, "soap12"),
+    NS.tag("http", "address"): (2, "http"),
+}
+# The `Model` registry each top-level section's definition goes in (schema definitions go in "types")
+SECTION_KINDS = {
+    MESSAGE_TAG: "messages",
+    PORT_TYPE_TAG: "port_types",
+    BINDING_TAG: "bindings",
+    SERVICE_TAG: "services",
+}
+# Attributes naming other definitions, by kind of definition: attribute -> kind of the definition named
+REFERENCE_ATTRIBUTES = {
+    "types": {"type": "types", "base": "types", "ref": "types", "itemType": "types"},
+    "messages": {"element": "types", "type": "types"},
+    "port_types": {"message": "messages"},
+    "bindings": {"type": "port_types", "message": "messages"},
+    "services": {"binding": "bindings"},
+}
+
 
 def parse_port_wsdl(port_tag):
-    for protocol, tagname in (
-        ("soap", NS.tag("soap", "address")),
-        ("soap12", NS.tag("soap12", "address")),
-        ("http", NS.tag("http", "address")),
-    ):
-        addr_tag = port_tag.find(tagname)
-        if addr_tag is not None:
-            return (protocol, addr_tag.get("location"))
+    best = None
+    for child in port_tag:
+        rank = ADDRESS_TAGS.get(child.tag)
+        if rank and (best is None or rank < best[0]):
+            best = (rank, child)
+    if best is not None:
+        return (best[0][1], best[1].get("location"))
+
+
+def definition_qname(tns, element):
+    return "{%s}%s" % (tns, element.get("name"))
+
+
+def definition_digest(element):
+    """ SHA-1 of a definition's markup, which lxml serializes with all the prefixes in scope (as qname values may use them). """
+    return hashlib.sha1(tostring(element, with_tail=False)).digest()
+
+
+def find_dirty(readers, previous):
+    """
+    Find what a reload has to parse again.
+
+    :param readers: `WSDLReader`s that have `scan`ned the documents being reloaded.
+    :param previous: The `Model` being reloaded.
+    :return: The (kind, qname)s of definitions that are new, changed or gone from these
+             documents, and of those in them referring to any of these, directly or not.
+    """
+    owners = {}
+    for reader in readers:
+        for key in reader.digests:
+            owners.setdefault(key, reader)
+    dirty = set()
+    for key, reader in owners.iteritems():
+        entry = previous.definitions.get(key)
+        if entry is None or entry[0] != reader.digests[key]:
+            dirty.add(key[:2])
+    for reader in readers:
+        document = previous.documents.get(reader.source)
+        if document is not None:
+            dirty.update(key[:2] for key in document.keys if key not in owners)
+    if not dirty:
+        return dirty
+    dependents = {}
+    for key, reader in owners.iteritems():
+        name = key[:2]
+        for reference in reader.get_references(key):
+            dependents.setdefault(reference, []).append(name)
+    pending = list(dirty)
+    while pending:
+        for dependent in dependents.pop(pending.pop(), ()):
+            if dependent not in dirty:
+                dirty.add(dependent)
+                pending.append(dependent)
+    return dirty
 
 
 class WSDLReader(object):
     BINDING_CLASSES = {
-        "soap": SOAPBinding
+        "soap": SOAPBinding,
+        "http": HTTPBinding,
     }
 
-    def __init__(self, context, wsdl_tree):
+    # Top-level sections are parsed in this order, as later ones refer to earlier ones
+    SECTION_ORDER = (TYPES_TAG, MESSAGE_TAG, PORT_TYPE_TAG, BINDING_TAG, SERVICE_TAG)
+
+    # Schema definitions are registered kind by kind, so these win name clashes in this order
+    SCHEMA_DEFINITION_ORDER = (SIMPLE_TYPE_TAG, ELEMENT_TAG, COMPLEX_TYPE_TAG)
+
+    def __init__(self, context, wsdl_tree, model=None, previous=None, source=None):
+        """
+        :param model: The `Model` to read into; defaults to the context's own.
+        :param previous: When reloading, the `Model` to take definitions from instead of parsing
+                         them again, unless `dirty` (see `find_dirty`).
+        :param source: What the document is known as in the model (see `Context.sources`).
+        """
         self.context = context
+        self.model = (model if model is not None else context.model)
+        self.previous = previous
+        self.source = source
+        self.document = Document(source)
+        self.previous_document = (previous.documents.get(source) if previous is not None else None)
+        self.scanned = False
+        self.unchanged = False  # Set by `scan` if the document is the same as in `previous`
+        self.dirty = frozenset()
+        self.digests = {}  # (kind, qname, tag) -> digest, from `scan`
+        self.scopes = {}  # (kind, qname, tag) -> (element, nsmap, qname cache), from `scan`
+        self.references = {}  # (kind, qname, tag) -> (kind, qname)s named, from `get_references`
+        self.record = (context.reloadable or previous is not None)  # Keep digests in `model.definitions`?
         self.definitions = wsdl_tree.getroot()
         self.nsmap = NS.augment(self.definitions.nsmap)
-        assert self.definitions.tag == NS.tag("wsdl", "definitions")
+        assert self.definitions.tag == DEFINITIONS_TAG
         self.target_namespace = self.definitions.get("targetNamespace")
+        self.section_parsers = {
+            MESSAGE_TAG: self.parse_message,
+            PORT_TYPE_TAG: self.parse_port_type,
+            BINDING_TAG: self.parse_binding,
+            SERVICE_TAG: self.parse_service,
+        }
+
+    def get_sections(self):
+        sections = dict((tag, []) for tag in self.SECTION_ORDER)
+        for child in self.definitions:
+            bucket = sections.get(child.tag)
+            if bucket is not None:
+                bucket.append(child)
+        return sections
 
     def parse(self):
-        for types in self.definitions.findall(NS.tag("wsdl", "types")):
+        self.model.documents[self.source] = self.document
+        if self.record and not self.scanned:
+            self.document.digest = definition_digest(self.definitions)
+        sections = self.get_sections()
+        self.schema_index = 0
+        for types in sections[TYPES_TAG]:
             self.parse_types(types)
+        for tag in self.SECTION_ORDER[1:]:
+            kind = SECTION_KINDS[tag]
+            parser = self.section_parsers[tag]
+            registry = getattr(self.model, kind)
+            for section in sections[tag]:
+                qname = definition_qname(self.target_namespace, section)
+                obj = self.get_unchanged(kind, qname, section)
+                if obj is None:
+                    obj = parser(section)
+                if obj is not None:
+                    registry.register(obj)
+                    self.document.objects.append((kind, obj))
+                self.remember(kind, qname, section, obj)
+
+    def scan(self, full=False):
+        """
+        Go through the definitions `parse` would, without parsing them, and take their digests.
+
+        If the whole document is the same as in `previous`, this stops there and sets `unchanged`,
+        unless `full`. Definitions in schemas (or documents) that haven't changed keep the digests
+        they had in `previous` rather than being serialized again.
+        """
+        self.scanned = True
+        previous_document = self.previous_document
+        if previous_document is None or previous_document.digest is None:
+            previous_document = Document(self.source)
+        if self.document.digest is None:
+            self.document.digest = definition_digest(self.definitions)
+        unchanged = (self.document.digest == previous_document.digest)
+        self.unchanged = (unchanged and not full)
+        if self.unchanged:
+            return
+        qnames = {}  # Attribute value -> qname, in `self.nsmap` (each schema has its own)
+        sections = self.get_sections()
+        index = 0
+        for tag in self.SECTION_ORDER:
+            for section in sections[tag]:
+                if tag != TYPES_TAG:
+                    self.scan_definition(SECTION_KINDS[tag], self.target_namespace, section, self.nsmap, qnames, unchanged)
+                    continue
+                for schema in section.iterchildren(SCHEMA_TAG):
+                    tns = schema.get("targetNamespace")
+                    nsmap = self.nsmap.augment(schema.nsmap)  # As in `parse_xmlschema`
+                    schema_qnames = {}
+                    digest = previous_document.schema_digests.get(index)
+                    if not unchanged:
+                        digest = definition_digest(schema)
+                    self.document.schema_digests[index] = digest
+                    same = (digest is not None and digest == previous_document.schema_digests.get(index))
+                    index += 1
+                    for element in schema:
+                        if element.tag in self.SCHEMA_DEFINITION_ORDER:
+                            self.scan_definition("types", tns, element, nsmap, schema_qnames, same)
 
-        for message in self.definitions.findall(NS.tag("wsdl", "message")):
-            self.parse_message(message)
+    def scan_definition(self, kind, tns, element, nsmap, qnames, unchanged):
+        """ :param unchanged: Whether the document or schema `element` is in is known not to have changed. """
+        key = (kind, definition_qname(tns, element), element.tag)
+        if key in self.digests:  # As with registries, the first definition wins
+            return
+        entry = (self.previous.definitions.get(key) if unchanged else None)
+        self.digests[key] = (entry[0] if entry is not None else definition_digest(element))
+        self.scopes[key] = (element, nsmap, qnames)
 
-        for port_type in self.definitions.findall(NS.tag("wsdl", "portType")):
-            self.parse_port_type(port_type)
+    def get_references(self, key):
+        """
+        :return: The (kind, qname)s of the definitions a scanned definition names; kept from
+                 `previous` if the definition hasn't changed.
+        """
+        references = self.references.get(key)
+        if references is not None:
+            return references
+        entry = self.previous.definitions.get(key)
+        if entry is not None and entry[0] == self.digests[key] and entry[2] is not None:
+            references = self.references[key] = entry[2]
+            return references
+        element, nsmap, qnames = self.scopes[key]
+        references = set()
+        attributes = REFERENCE_ATTRIBUTES[key[0]].items()
+        for node in element.iter(Element):
+            for attribute, target_kind in attributes:
+                value = node.get(attribute)
+                if not value:
+                    continue
+                target = qnames.get(value)
+                if target is None:
+                    try:
+                        target = qnames[value] = nsmap.to_qname(value)
+                    except KeyError:  # Not a qname after all (e.g. a MIME content type)
+                        continue
+                references.add((target_kind, target))
+        references = self.references[key] = frozenset(references)
+        return references
 
-        for binding in self.definitions.findall(NS.tag("wsdl", "binding")):
-            self.parse_binding(binding)
+    def get_unchanged(self, kind, qname, element):
+        """ :return: The object `previous` has for a definition that's not dirty, or None. """
+        if self.previous is None or (kind, qname) in self.dirty:
+            return None
+        entry = self.previous.definitions.get((kind, qname, element.tag))
+        return (entry[1] if entry else None)
 
-        for service in self.definitions.findall(NS.tag("wsdl", "service")):
-            self.parse_service(service)
+    def remember(self, kind, qname, element, obj):
+        if not self.record:
+            return
+        key = (kind, qname, element.tag)
+        if key in self.model.definitions:  # As with registries, the first definition wins
+            return
+        self.document.keys.append(key)
+        digest = self.digests.get(key) or definition_digest(element)
+        references = self.references.get(key)
+        if references is None and self.previous is not None:  # Nothing changed, so `find_dirty` didn't need them
+            entry = self.previous.definitions.get(key)
+            if entry is not None and entry[0] == digest:
+                references = entry[2]
+        self.model.definitions[key] = (digest, obj, references)
 
     def parse_types(self, types):
-        for schema in types.findall(NS.tag("schema", "schema")):
-            self.parse_xmlschema(schema)
+        for schema in types:
+            if schema.tag == SCHEMA_TAG:
+                self.parse_xmlschema(schema)
 
     def parse_xmlschema(self, schema):
         tns = schema.get("targetNamespace")
-        self.nsmap = self.nsmap.augment(schema.nsmap)
+        nsmap = self.nsmap.augment(schema.nsmap)  # Only for this schema; its prefixes mustn't leak into the next
+        if self.record and not self.scanned:
+            self.document.schema_digests[self.schema_index] = definition_digest(schema)
+        self.schema_index += 1
         # XXX: Always assumes elementFormDefault="qualified"
         new_types = []
 
-        elts = []
-        elts.extend(schema.findall(NS.tag("schema", "simpleType")))
-        elts.extend(schema.findall(NS.tag("schema", "element")))
-        elts.extend(schema.findall(NS.tag("schema", "complexType")))
+        definitions = dict((tag, []) for tag in self.SCHEMA_DEFINITION_ORDER)
+        for element in schema:
+            bucket = definitions.get(element.tag)
+            if bucket is not None:
+                bucket.append(element)
 
-        for element in elts:
-            typeobj = type_from_xmlschema_element(self.nsmap, self.context, tns, element, defer=True)
-            self.context.types.register(typeobj)
-            new_types.append((typeobj, element))
+        for tag in self.SCHEMA_DEFINITION_ORDER:
+            for element in definitions[tag]:
+                qname = definition_qname(tns, element)
+                typeobj = self.get_unchanged("types", qname, element)
+                if typeobj is None:
+                    typeobj = type_from_xmlschema_element(nsmap, self.context, tns, element, defer=True)
+                    new_types.append((typeobj, element))
+                self.model.types.register(typeobj)
+                self.document.objects.append(("types", typeobj))
+                self.remember("types", qname, element, typeobj)
 
         for typeobj, element in new_types:
-            typeobj.parse_xmlschema_element(self.nsmap, element)
+            typeobj.parse_xmlschema_element(nsmap, element)
 
     def parse_message(self, message_tag):
         message = Message(self.context, self.target_namespace, message_tag.get("name"))
-        for part_tag in message_tag.findall(NS.tag("wsdl", "part")):
+        for part_tag in message_tag.iterchildren(PART_TAG):
             typename = part_tag.get("element") or part_tag.get("type")
             typename = self.nsmap.to_qname(typename)
             message.add_part(part_tag.get("name"), self.context.resolve_type(typename))
-        self.context.messages.register(message)
+        return message
 
     def parse_op_part(self, c_tag):
         message = self.nsmap.to_qname(c_tag.get("message"))
-        return OperationPart(self.context.messages[message])
+        return OperationPart(self.model.messages[message])
 
     def parse_port_type(self, port_type_tag):
         port_type = PortType(self.context, self.target_namespace, port_type_tag.get("name"))
-        for op_tag in port_type_tag.findall(NS.tag("wsdl", "operation")):
+        previous = (self.previous.port_types.get(port_type.qname) if self.previous is not None else None)
+        for op_tag in port_type_tag.iterchildren(OPERATION_TAG):
             op = Operation(port_type, op_tag.get("name"))
-            for c_tag in op_tag.getchildren():
-                if c_tag.tag == NS.tag("wsdl", "input"):
+            for c_tag in op_tag:
+                tag = c_tag.tag
+                if tag == INPUT_TAG:
                     op.input = self.parse_op_part(c_tag)
-                elif c_tag.tag == NS.tag("wsdl", "output"):
+                elif tag == OUTPUT_TAG:
                     op.output = self.parse_op_part(c_tag)
-                elif c_tag.tag == NS.tag("wsdl", "fault"):
+                elif tag == FAULT_TAG:
                     op.faults.append(self.parse_op_part(c_tag))
-                elif c_tag.tag == NS.tag("wsdl", "documentation"):
+                elif tag == DOCUMENTATION_TAG:
                     op.documentation = c_tag.text
                 else:
                     raise NotImplementedError("Not implemented: %s" % c_tag.tag)
+            if previous is not None and op.name in previous.operations:  # Keep what was set on the reloaded one
+                op.idempotent = previous.operations[op.name].idempotent
             port_type.operations.register(op)
-        self.context.port_types.register(port_type)
+        return port_type
 
     def parse_binding(self, binding_tag):
         port_type_name = self.nsmap.to_qname(binding_tag.get("type"))
-        port_type = self.context.port_types[port_type_name]
+        port_type = self.model.port_types[port_type_name]
         protocol = Binding.detect_binding_protocol(binding_tag)
         binding_name = binding_tag.get("name")
 
@@ -112,19 +357,19 @@ class WSDLReader(object):
         binding_cls = self.BINDING_CLASSES.get(protocol, Binding)
         binding = binding_cls(self.context, self.target_namespace, binding_name, port_type, args)
         binding.parse_wsdl(binding_tag)
-        self.context.bindings.register(binding)
+        return binding
 
     def parse_service(self, service_tag):
         service = Service(self.context, self.target_namespace, service_tag.get("name"))
         service.documentation = service_tag.get("documentation")
 
-        for port_tag in service_tag.findall(NS.tag("wsdl", "port")):
+        for port_tag in service_tag.iterchildren(PORT_TAG):
             binding_name = self.nsmap.to_qname(port_tag.get("binding"))
-            binding = self.context.bindings[binding_name]
+            binding = self.model.bindings[binding_name]
             protocol, address = parse_port_wsdl(port_tag)
             port_name = port_tag.get("name")
             if not protocol:
                 logger.warn("Unable to detect service %s port %s protocol", service.name, port_name)
             port = Port(port_name, binding, protocol, address)
             service.ports.register(port)
-        self.context.services.register(service)
+        return service
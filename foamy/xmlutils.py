@@ -1,5 +1,172 @@
+from lxml import etree
+import tempfile
+import threading
+
+
 def self_or_child(element, tag):
     if element.tag == tag:
         return element
     else:
         return element.find(tag)
+
+
+class XMLParsers(object):
+    """
+    Parser settings for responses and WSDLs, with a reusable parser per thread
+    (an lxml parser can't be used by several threads at once).
+
+    Entities aren't resolved and nothing is fetched over the network, so documents can't
+    expand entities or pull in external resources, and blank text between elements is
+    dropped for smaller trees.
+    """
+
+    def __init__(self, remove_blank_text=True, huge_tree=False, collect_ids=True):
+        """
+        :param huge_tree: Lift libxml2's limits on tree depth and text size, for very large
+                          trusted documents. This also lifts their protection against hostile ones.
+        :param collect_ids: Whether to keep a table of the documents' `xml:id`s; foamy never uses it.
+        """
+        self.options = {
+            "remove_blank_text": remove_blank_text,
+            "resolve_entities": False,
+            "no_network": True,
+            "huge_tree": huge_tree,
+            "collect_ids": collect_ids,
+        }
+        self._local = threading.local()
+
+    def get_parser(self):
+        parser = getattr(self._local, "parser", None)
+        if parser is None:
+            parser = self._local.parser = etree.XMLParser(**self.options)
+        return parser
+
+    def new_feed_parser(self):
+        """ A parser of its own for the `feed` interface, which keeps state between calls. """
+        return etree.XMLParser(**self.options)
+
+    def new_pull_parser(self, events, tag=None):
+        """ A `feed` parser that also reports `events` (for elements with one of the tags in `tag`, if given). """
+        return etree.XMLPullParser(events, tag=tag, **self.options)
+
+    def fromstring(self, data):
+        return etree.fromstring(data, self.get_parser())
+
+    def parse(self, source):
+        return etree.parse(source, self.get_parser())
+
+
+DEFAULT_PARSERS = XMLParsers()
+
+# For `Pruner` tries
+ANY_TAG = "*"  # Key matching elements of any tag not listed
+KEEP_ALL = "**"  # Value keeping an element's whole subtree
+
+
+class Pruner(object):
+    """
+    Drops elements from a document while it's being parsed, soon after each is complete.
+
+    What to keep is given as a trie of tags: a dict mapping the tags of the root elements
+    to keep to dicts for their children, and so on; `KEEP_ALL` keeps a whole subtree.
+    Text and attributes of kept elements are always kept, and documents whose root isn't
+    in the trie are left alone.
+
+    Rather than handling parser events per element, `prune` is called after each chunk
+    is fed, and walks down the kept elements that are still open.
+    """
+
+    def __init__(self, keep):
+        self.keep = keep
+        self.root = None
+        self.root_trie = None
+        self.done = {}  # Open kept element -> how many of its first children are complete, kept and pruned
+
+    def get_root_tags(self):
+        """ The root tags to get "start" events for, or None for all (if any root tag goes). """
+        return (None if ANY_TAG in self.keep else list(self.keep))
+
+    def handle(self, events):
+        for event, element in events:
+            if self.root is None:
+                self.root = element
+                self.root_trie = self.keep.get(element.tag, self.keep.get(ANY_TAG))
+
+    def prune(self, final=False):
+        if self.root is not None and self.root_trie is not None and self.root_trie is not KEEP_ALL:
+            self._prune(self.root, self.root_trie, final)
+
+    def _prune(self, element, trie, final):
+        """
+        Drop the complete children of `element` that `trie` (None when dropping `element`)
+        doesn't keep; the last child is still being parsed unless `final`.
+
+        Kept children are found with lxml's tag filtering and the others deleted in slices
+        between them, so dropped elements never get Python proxies.
+        """
+        count = len(element)
+        if not count:
+            return
+        complete = (count if final else count - 1)
+        if not trie:  # Dropping `element`, or keeping none of its children
+            del element[:complete]
+            if not final:
+                self._prune(element[0], None, False)
+            return
+        index = self.done.pop(element, 0)  # Children before this one are kept, and pruned already
+        tags = (() if ANY_TAG in trie else tuple(trie))
+        previous = (element[index - 1] if index else None)
+        for child in (previous.itersiblings(*tags) if previous is not None else element.iterchildren(*tags)):
+            position = element.index(child, index)
+            if position >= complete:
+                break
+            if position > index:
+                del element[index:position]
+                complete -= (position - index)
+            subtrie = trie.get(child.tag, trie.get(ANY_TAG))
+            if subtrie is not KEEP_ALL:
+                self._prune(child, subtrie, True)
+            index += 1
+        if complete > index:
+            del element[index:complete]
+        if not final:
+            last = element[-1]
+            subtrie = trie.get(last.tag, trie.get(ANY_TAG))
+            if subtrie is not KEEP_ALL:
+                self._prune(last, subtrie, False)
+            self.done[element] = index
+
+
+def feed_parse(chunks, spool_threshold=None, parsers=None, keep=None):
+    """
+    Parse an XML document from an iterable of byte chunks as they arrive.
+
+    If `spool_threshold` is not None, the raw body is also kept in a spooled temporary file
+    that rolls over to disk once it grows past that many bytes.
+
+    :param parsers: `XMLParsers` to parse with; defaults to `DEFAULT_PARSERS`.
+    :param keep: A `Pruner` trie of the elements to keep, or None to keep everything.
+    :return: (root element, spool file or None)
+    """
+    parsers = (parsers or DEFAULT_PARSERS)
+    pruner = None
+    if keep is not None:
+        pruner = Pruner(keep)
+        parser = parsers.new_pull_parser(("start",), tag=pruner.get_root_tags())
+    else:
+        parser = parsers.new_feed_parser()
+    spool = (tempfile.SpooledTemporaryFile(max_size=spool_threshold) if spool_threshold is not None else None)
+    for chunk in chunks:
+        if not chunk:
+            continue
+        parser.feed(chunk)
+        if pruner is not None:
+            pruner.handle(parser.read_events())
+            pruner.prune()
+        if spool is not None:
+            spool.write(chunk)
+    root = parser.close()
+    if pruner is not None:
+        pruner.handle(parser.read_events())
+        pruner.prune(final=True)
+    return root, spool
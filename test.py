@@ -1,8 +1,18 @@
 import sys
 import logging
 import datetime
+import time
 DEBUG = ("-d" in sys.argv[1:])
+from foamy.compression import Compression
+from foamy.deadline import Deadline
+from foamy.excs import ConcurrencyLimitExceeded, DeadlineExceeded, HTTPError
+from foamy.limiter import AIMDLimiter
+from foamy.retry import HedgePolicy, RetryPolicy
+from foamy.mtom import Attachment, Attachments, build_multipart, parse_multipart
 from foamy.shortcuts import open_soap
+from foamy.types import MarshalValueError
+from foamy.testing import StandInServer
+from foamy.transport import RequestsTransport
 
 if DEBUG:
 	logging.basicConfig(level=logging.DEBUG)
@@ -34,7 +44,1050 @@ def test_calculator():
 	print "64 * 32 = %s" % cr["Result"]
 
 
+CC_RESPONSE = """<?xml version="1.0" encoding="utf-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"><soap:Body>
+<ConversionRateResponse xmlns="http://www.webserviceX.NET/"><ConversionRateResult>%s</ConversionRateResult></ConversionRateResponse>
+</soap:Body></soap:Envelope>"""
+
+
+def test_compression():
+	def handler(request):
+		assert "<ns0:FromCurrency>EUR</ns0:FromCurrency>" in request.body
+		return (200, {"Content-Type": "text/xml; charset=utf-8"}, CC_RESPONSE % "1.25")
+
+	for stream in (False, True):
+		with StandInServer(handler, response_encoding="gzip") as server:
+			ctx = open_soap("ex/currencyconvertor.wsdl", transport=RequestsTransport(stream=stream), compression=Compression("gzip", threshold=0))
+			cc = ctx.service
+			cc.ConversionRate.port.location = server.url
+			cr = cc.ConversionRate({"FromCurrency": "EUR", "ToCurrency": "USD"})
+			assert cr["ConversionRateResult"] == 1.25
+			request = server.requests[-1]
+			assert request.headers["content-encoding"] == "gzip"
+			assert len(request.raw_body) < len(request.body)
+		print "Compression (stream=%s): %d -> %d bytes" % (stream, len(request.body), len(request.raw_body))
+
+
+def test_streaming_response():
+	from foamy.objs import Request
+	padding = "<!-- %s -->" % ("x" * 200000)
+	body = (CC_RESPONSE % "1.25").replace("</soap:Body>", padding + "</soap:Body>")
+
+	def handler(request):
+		return (200, {"Content-Type": "text/xml; charset=utf-8"}, body)
+
+	with StandInServer(handler) as server:
+		results = []
+		for stream in (False, True):
+			ctx = open_soap("ex/currencyconvertor.wsdl", transport=RequestsTransport(stream=stream, chunk_size=4096))
+			ctx.service.ConversionRate.port.location = server.url
+			results.append(ctx.service.ConversionRate(FromCurrency="EUR", ToCurrency="USD"))
+		assert results[0] == results[1] and results[1]["ConversionRateResult"] == 1.25, results
+
+		transport = RequestsTransport(stream=True, chunk_size=4096, spool_threshold=1024)
+		resp = transport.dispatch(Request(server.url, data="<x/>"))
+		assert resp.body_file is not None and resp.body_file._rolled  # Past the threshold, so on disk
+		assert resp.data == body
+		assert resp.get_body().tag == "{http://schemas.xmlsoap.org/soap/envelope/}Envelope"
+		assert RequestsTransport(stream=True).dispatch(Request(server.url, data="<x/>")).body_file is None  # Not kept by default
+	print "Streaming response: same result as buffered; %d byte body spooled to disk" % len(body)
+
+
+HTTP_CC_RESPONSE = """<?xml version="1.0" encoding="utf-8"?>
+<double xmlns="http://www.webserviceX.NET/">%s</double>"""
+
+
+def test_http_binding():
+	def handler(request):
+		if request.method == "GET":
+			assert request.path == "/CurrencyConvertor.asmx/ConversionRate?FromCurrency=EUR&ToCurrency=USD", request.path
+		else:
+			assert request.path.endswith("/ConversionRate")
+			assert request.headers["content-type"] == "application/x-www-form-urlencoded"
+			assert request.body == "FromCurrency=EUR&ToCurrency=USD"
+		return (200, {"Content-Type": "text/xml; charset=utf-8"}, HTTP_CC_RESPONSE % "1.25")
+
+	with StandInServer(handler) as server:
+		location = server.url + "CurrencyConvertor.asmx"
+		soap_op = open_soap("ex/currencyconvertor.wsdl").service.ConversionRate
+		assert soap_op.port.protocol == "soap"  # Preferred by default
+		for preference in ("http-get", "http-post"):
+			ctx = open_soap("ex/currencyconvertor.wsdl", binding_preference=(preference, "soap"))
+			op = ctx.service.ConversionRate
+			op.port.location = location
+			assert op(FromCurrency="EUR", ToCurrency="USD") == 1.25
+			assert server.requests[-1].method == preference[5:].upper()
+	soap_size = len(soap_op.port.envelope_message({"FromCurrency": "EUR", "ToCurrency": "USD"}, soap_op.operation).data)
+	print "HTTP binding: GET and POST OK (%d bytes of form data vs. a %d byte SOAP envelope)" % (len(server.requests[-1].body), soap_size)
+
+
+def test_result_modes():
+	def handler(request):
+		return (200, {"Content-Type": "text/xml; charset=utf-8"}, CC_RESPONSE % "1.25")
+
+	with StandInServer(handler) as server:
+		cc = open_soap("ex/currencyconvertor.wsdl").service
+		cc.ConversionRate.port.location = server.url
+		lazy = cc.ConversionRate(FromCurrency="EUR", ToCurrency="USD", _result_mode="lazy")
+		assert lazy.ConversionRateResult == 1.25
+		element = cc.ConversionRate(FromCurrency="EUR", ToCurrency="USD", _result_mode="element")
+		assert element.tag == "{http://www.webserviceX.NET/}ConversionRateResponse"
+		raw = cc.ConversionRate(FromCurrency="EUR", ToCurrency="USD", _result_mode="bytes")
+		assert raw == CC_RESPONSE % "1.25"
+
+	def store_handler(request):
+		return (200, {"Content-Type": "text/xml; charset=utf-8"}, STORE_NAMED_RESPONSE % ("a.bin", "AAEC"))
+
+	with StandInServer(store_handler) as server:
+		ctx = open_soap("ex/attachments.wsdl")
+		store = ctx.service.Store
+		store.port.location = server.url
+		store.result_mode = "lazy"  # For this operation only; the context's default stays eager
+		record = store(Name="a.bin", Content="")
+		assert "0 of 2 fields converted" in repr(record), repr(record)
+		assert len(record) == 2 and "Content" in record and list(record) == ["Name", "Content"]
+		assert not record._cache  # Checking which fields are there doesn't convert them
+		assert record.Name == "a.bin" and record._cache == {"Name": "a.bin"}
+		assert "1 of 2 fields converted" in repr(record)
+		assert record["Content"] == "\x00\x01\x02" and record._cache["Content"] is record["Content"]  # Converted once, then cached
+		assert store(Name="a.bin", Content="", _result_mode="eager") == {"Name": "a.bin", "Content": "\x00\x01\x02"}
+		assert ctx.result_mode == "eager" and isinstance(ctx.dispatch(store.port, store.operation, {"Name": "a.bin", "Content": ""}), dict)
+	print "Result modes: lazy (converted on access, chosen per operation), element and bytes OK"
+
+
+def test_record_classes():
+	import collections
+	from lxml.etree import fromstring
+	from foamy.records import Record
+	ns = "http://example.com/attachments/"
+	full = fromstring('<Store xmlns="%s"><Name>test</Name><Content>AAEC</Content></Store>' % ns)
+	partial = fromstring('<Store xmlns="%s"><Content>AAEC</Content></Store>' % ns)
+
+	ctx = open_soap("ex/attachments.wsdl")
+	store = ctx.types["{%s}Store" % ns]
+	expected = store.unmarshal(full)
+	assert expected == {"Name": "test", "Content": "\x00\x01\x02"}, expected
+
+	ctx.record_mode = "slots"
+	record = store.unmarshal(full)
+	assert isinstance(record, Record) and not hasattr(record, "__dict__")
+	assert record.Name == "test" and record.to_dict() == expected
+	assert store.unmarshal(partial).to_dict() == {"Content": "\x00\x01\x02"}  # Missing fields are left unset
+
+	ctx.record_mode = "namedtuple"
+	record = store.unmarshal(full)
+	assert record._fields == ("Name", "Content") and tuple(record) == ("test", "\x00\x01\x02")
+	assert store.unmarshal(partial).Name is None
+
+	Stored = collections.namedtuple("Stored", "Content Name Size")  # Matched up by name, not position
+	ctx.register_record_class(store.qname, Stored)
+	assert store.unmarshal(full) == Stored("\x00\x01\x02", "test", None)
+
+	ctx.record_mode = "dict"
+	assert store.unmarshal(full) == Stored("\x00\x01\x02", "test", None)  # Registered classes apply in every mode
+	ctx.register_record_class(store.qname, None)
+	assert store.unmarshal(full) == expected
+	print "Record classes: slots, namedtuple and registered classes OK"
+
+
+FACETS_SCHEMA = """<s:schema xmlns:s="http://www.w3.org/2001/XMLSchema" xmlns:tns="http://example.com/facets/" targetNamespace="http://example.com/facets/">
+	<s:element name="Quantity"><s:simpleType><s:restriction base="s:int"><s:minInclusive value="1"/><s:maxExclusive value="100"/></s:restriction></s:simpleType></s:element>
+	<s:element name="Code"><s:simpleType><s:restriction base="s:string"><s:minLength value="2"/><s:maxLength value="4"/></s:restriction></s:simpleType></s:element>
+	<s:element name="Price"><s:simpleType><s:restriction base="s:decimal"><s:totalDigits value="5"/><s:fractionDigits value="2"/></s:restriction></s:simpleType></s:element>
+</s:schema>"""
+
+
+def test_strict_validation():
+	from lxml.etree import fromstring
+	from foamy.context import Context
+	from foamy.types import type_from_xmlschema_element
+	from foamy.ns import NamespaceMap
+
+	ctx = open_soap("ex/currencyconvertor.wsdl", strict=True)
+	cc = ctx.service.ConversionRate
+	cc.port.envelope_message({"FromCurrency": "EUR", "ToCurrency": "USD"}, cc.operation)
+	try:
+		cc.port.envelope_message({"FromCurrency": "XXX", "ToCurrency": "USD"}, cc.operation)
+		raise AssertionError("XXX is not a currency in the enumeration")
+	except MarshalValueError:
+		pass
+	ctx.strict = False
+	cc.port.envelope_message({"FromCurrency": "XXX", "ToCurrency": "USD"}, cc.operation)  # Not checked
+
+	ctx = open_soap("ex/ndfdXML.wsdl", strict=True)
+	zip_code = ctx.types["{http://graphical.weather.gov/xml/DWMLgen/schema/DWML.xsd}zipCodeType"]
+	assert zip_code.marshal("20910-1234") == "20910-1234"
+
+	ctx = Context(transport=object(), strict=True)
+	schema = fromstring(FACETS_SCHEMA)
+	types = dict(
+		(element.get("name"), type_from_xmlschema_element(NamespaceMap(schema.nsmap), ctx, "http://example.com/facets/", element))
+		for element in schema
+	)
+	assert types["Quantity"].marshal(99) == "99"
+	assert types["Code"].marshal("ABC") == "ABC"
+	assert types["Price"].marshal("123.40") == "123.40"
+	for name, value in (
+		("zip", "2091"), ("Quantity", 0), ("Quantity", 100), ("Code", "A"), ("Code", "ABCDE"),
+		("Price", "12345.6"), ("Price", "1.234"),
+	):
+		type = (zip_code if name == "zip" else types[name])
+		try:
+			type.marshal(value)
+			raise AssertionError("%s: %r should have been rejected" % (name, value))
+		except MarshalValueError:
+			pass
+	print "Strict validation: enumerations, patterns, bounds, lengths and digits OK"
+
+
+def test_fleet():
+	from foamy.loader import NullCache
+	import threading
+	from foamy.fleet import FleetLoader
+	lock = threading.Lock()
+	in_flight = [0, 0]  # Now, most at once
+
+	def handler(request):
+		with lock:
+			in_flight[0] += 1
+			in_flight[1] = max(in_flight)
+		time.sleep(0.05)
+		with lock:
+			in_flight[0] -= 1
+		name = request.path.rsplit("/", 1)[-1]
+		if name == "missing.wsdl":
+			return (404, {}, "Not found")
+		return (200, {"Content-Type": "text/xml"}, open("ex/" + name.split("-")[-1], "rb").read())
+
+	class Records(logging.Handler):
+		def __init__(self):
+			logging.Handler.__init__(self)
+			self.records = []
+
+		def emit(self, record):
+			self.records.append(record)
+
+	records = Records()
+	fleet_logger = logging.getLogger("foamy.fleet")
+	fleet_logger.addHandler(records)
+	try:
+		with StandInServer(handler) as server:
+			urls = [server.url + "/" + name for name in (
+				"currencyconvertor.wsdl", "ndfdXML.wsdl", "orders.wsdl", "missing.wsdl", "mirror-currencyconvertor.wsdl",
+			)] + ["ex/attachments.wsdl", "ex/orders.wsdl"]
+			fleet = FleetLoader(threads=8, transport=RequestsTransport(), cache=NullCache()).load(urls + urls[:2])
+	finally:
+		fleet_logger.removeHandler(records)
+	assert len(fleet.members) == 7 and len(fleet) == 6
+	assert [member.url for member in fleet.failures] == [urls[3]] and isinstance(fleet.failures[0].error, HTTPError)
+	assert fleet[urls[0]] is not fleet[urls[4]]  # Same content, but a context each
+	assert fleet[urls[0]].service.ConversionRate and fleet["ex/attachments.wsdl"].service.Store
+	assert sum(1 for member in fleet.members if member.shared) == 2  # The mirror and the local orders.wsdl
+	assert in_flight[1] > 1, in_flight  # Fetched concurrently
+	warnings = [record.getMessage() for record in records.records if record.levelno == logging.WARNING]
+	assert len(warnings) == 1 and warnings[0].startswith("Loading %s failed" % urls[3]), warnings
+	print "Fleet: %s" % fleet.describe()
+
+
+STORE_NAMED_RESPONSE = """<?xml version="1.0" encoding="utf-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"><soap:Body>
+<StoreResponse xmlns="http://example.com/attachments/"><Name>%s</Name><Content>%s</Content></StoreResponse>
+</soap:Body></soap:Envelope>"""
+
+
+def test_projection():
+	import base64
+	from lxml.etree import fromstring
+	from foamy.projection import Projection, fields_of
+	from foamy.xmlutils import feed_parse
+	content = base64.b64encode("\x00" * 300000)
+
+	def handler(request):
+		return (200, {"Content-Type": "text/xml; charset=utf-8"}, STORE_NAMED_RESPONSE % ("big.bin", content))
+
+	with StandInServer(handler) as server:
+		ctx = open_soap("ex/attachments.wsdl")
+		op = ctx.service.Store
+		op.port.location = server.url
+		for stream in (False, True):
+			ctx.transport.stream = stream
+			assert op(Name="big.bin", Content="", _fields="Name") == {"Name": "big.bin"}
+			assert op(Name="big.bin", Content="", _fields=["Name", "Content"])["Content"] == "\x00" * 300000
+		try:
+			op(Name="big.bin", Content="", _fields="Size")
+			raise AssertionError("Unknown fields should be rejected")
+		except ValueError:
+			pass
+
+	projection = op.port.binding.get_projection(op.operation, "Name")
+	assert op.port.binding.get_projection(op.operation, ["Name"]) is projection  # Compiled once
+	tree, _ = feed_parse([STORE_NAMED_RESPONSE % ("big.bin", content)], keep=projection.document_keep)
+	assert [el.tag.split("}")[1] for el in tree.iter()] == ["Envelope", "Body", "StoreResponse", "Name"]
+
+	ctx = open_soap("ex/orders.wsdl")
+	order = fromstring(
+		'<SubmitOrder xmlns="http://example.com/orders/"><OrderId>A-1</OrderId>'
+		'<Item><Sku>S-1</Sku><Quantity>2</Quantity></Item><Item><Sku>S-2</Sku><Quantity>3</Quantity></Item></SubmitOrder>'
+	)
+	submit_order = ctx.types["{http://example.com/orders/}SubmitOrder"]
+	projected = Projection(fields_of(submit_order), ["OrderId", "Item/Sku"]).unmarshal(order)
+	assert projected == {"OrderId": "A-1", "Item": {"Sku": "S-1"}}, projected
+	print "Projection: selected fields only, pruned while streaming"
+
+
+INTERN_WSDL = """<wsdl:definitions xmlns:wsdl="http://schemas.xmlsoap.org/wsdl/" xmlns:s="http://www.w3.org/2001/XMLSchema"
+	xmlns:tns="http://example.com/intern/" targetNamespace="http://example.com/intern/">
+<wsdl:types><s:schema targetNamespace="http://example.com/intern/">
+	<s:element name="Note" type="s:string"/>
+	<s:complexType name="Person"><s:sequence>
+		<s:element name="Name" type="s:string"/><s:element name="Age" type="s:int" minOccurs="0"/><s:element ref="tns:Note"/>
+	</s:sequence></s:complexType>
+	<s:complexType name="Pet"><s:sequence>
+		<s:element name="Name" type="s:string"/><s:element name="Age" type="s:int" minOccurs="0"/><s:element ref="tns:Note" minOccurs="0"/>
+	</s:sequence></s:complexType>
+	<s:complexType name="Plant"><s:all>
+		<s:element name="Name" type="s:string"/>
+	</s:all></s:complexType>
+	<s:element name="Tag"><s:complexType><s:sequence><s:element name="Label" type="s:string"/></s:sequence></s:complexType></s:element>
+	<s:complexType name="Owner"><s:sequence>
+		<s:element name="Name" type="s:string"/><s:element ref="tns:Tag" minOccurs="0"/>
+	</s:sequence></s:complexType>
+</s:schema></wsdl:types>
+</wsdl:definitions>"""
+
+
+def test_interning():
+	from lxml.etree import ElementTree, fromstring, tostring
+	from foamy.context import Context
+
+	def read(intern_types):
+		ctx = Context(transport=object(), intern_types=intern_types)
+		ctx.read_wsdl_tree(ElementTree(fromstring(INTERN_WSDL)))
+		return ctx, [list(ctx.types["{http://example.com/intern/}%s" % name].sequence) for name in ("Person", "Pet")]
+
+	ctx, (person, pet) = read(True)
+	assert person[0] is pet[0] and person[1] is pet[1]  # Name and Age are shared
+	assert person[2] is ctx.types["{http://example.com/intern/}Note"]  # A plain ref is the global element
+	assert pet[2] is not person[2] and pet[2].min_occurs == 0 and person[2].min_occurs == 1
+	plant_name = list(ctx.types["{http://example.com/intern/}Plant"].all)[0]
+	assert plant_name.min_occurs == 0 and person[0].min_occurs == 1  # `xs:all` doesn't leak into the sequences
+	assert tostring(ctx.types["{http://example.com/intern/}Pet"].marshal({"Name": "Rex", "Note": "Good dog"})).count("Good dog") == 1
+	owner_type = ctx.types["{http://example.com/intern/}Owner"]
+	assert list(owner_type.sequence)[1].base is ctx.types["{http://example.com/intern/}Tag"]  # Wrapped for its minOccurs
+	owner = {"Name": "Ann", "Tag": {"Label": "red"}}
+	assert owner_type.unmarshal(fromstring(tostring(owner_type.marshal(owner)))) == owner
+
+	ctx, (person, pet) = read(False)
+	assert person[0] is not pet[0]
+	print "Interning: identical element declarations share a type"
+
+
+# The ex/ WSDLs' models as read before `WSDLReader` walked each document once (HTTP bindings aside,
+# which were parsed later): how many definitions of each kind there are, and outlines of some of them
+MODEL_KINDS = ("types", "messages", "port_types", "bindings", "services")
+MODEL_OUTLINES = {
+	"attachments.wsdl": ((2, 2, 1, 1, 1), {
+		"types Store": "sequence(Name: string, Content: base64Binary)",
+		"messages StoreSoapOut": "parameters: StoreResponse",
+		"port_types AttachmentsSoap": "Store(StoreSoapIn) -> StoreSoapOut",
+		"services Attachments": "AttachmentsSoap: soap http://localhost/Attachments via AttachmentsSoap",
+	}),
+	"currencyconvertor.wsdl": ((4, 6, 3, 4, 1), {
+		"types ConversionRate": "sequence(FromCurrency: Currency, ToCurrency: Currency)",
+		"messages ConversionRateHttpGetIn": "FromCurrency: string, ToCurrency: string",
+		"bindings CurrencyConvertorSoap": "SOAPBinding of CurrencyConvertorSoap: ConversionRate",
+		"bindings CurrencyConvertorSoap12": "Binding of CurrencyConvertorSoap: ",
+		"bindings CurrencyConvertorHttpGet": "HTTPBinding of CurrencyConvertorHttpGet: ConversionRate",
+	}),
+	"ndfdXML.wsdl": ((13, 24, 1, 1, 1), {
+		"types unitType": "string{e, m}",
+		"types displayLevelType": "integer{1, 2, 3, 4, 12, 34, 1234}",
+		"messages LatLonListLineRequest": "endPoint1Lat: decimal, endPoint1Lon: decimal, endPoint2Lat: decimal, endPoint2Lon: decimal",
+		"messages NDFDgenByDayRequest":
+			"latitude: decimal, longitude: decimal, startDate: date, numDays: integer, Unit: unitType, format: formatType",
+		"services ndfdXML": "ndfdXMLPort: soap http://graphical.weather.gov/xml/SOAP_server/ndfdXMLserver.php via ndfdXMLBinding",
+	}),
+	"orders.wsdl": ((3, 2, 1, 1, 1), {
+		"types SubmitOrder": "sequence(OrderId: string, Item: LineItem+)",
+		"types LineItem": "sequence(Sku: string, Quantity: int)",
+		"bindings OrdersSoap": "SOAPBinding of OrdersSoap: SubmitOrder",
+	}),
+	"parasoft-calculator.wsdl": ((8, 8, 1, 1, 1), {
+		"types divide": "sequence(numerator: float, denominator: float)",
+		"messages divide1Out": "parameters: divideResponse",
+		"port_types ICalculator":
+			"add(add0In) -> add0Out, divide(divide1In) -> divide1Out, multiply(multiply2In) -> multiply2Out, subtract(subtract3In) -> subtract3Out",
+		"services Calculator": "ICalculator: soap http://ws1.parasoft.com/glue/calculator via ICalculator",
+	}),
+}
+
+
+def outline_definition(ctx, kind, obj):
+	""" A short description of a definition in `ctx`, naming the definitions it refers to. """
+	from foamy.basic_types import BASIC_TYPES
+	basic_names = dict((id(t), qname.split("}")[1]) for qname, t in BASIC_TYPES.items())
+
+	def occurs(t):
+		if t.max_occurs > 1:
+			return ("+" if t.min_occurs else "*")
+		return ("?" if not t.min_occurs else "")
+
+	def outline_type(t, top=False):
+		if id(t) in basic_names:
+			return basic_names[id(t)]
+		if not top and ctx.types.get(t.qname) is t:
+			return t.name
+		content = (getattr(t, "sequence", None) or getattr(t, "all", None))
+		if content is not None:
+			fields = ", ".join("%s: %s%s" % (c.name, outline_type(c), occurs(c)) for c in content)
+			out = "%s(%s)" % (("all" if hasattr(t, "all") else "sequence"), fields)
+			return (out if not t.base else "%s + %s" % (outline_type(t.base), out))
+		out = (outline_type(t.base) if t.base is not None else type(t).__name__)
+		if t.restriction:
+			out += "{%s}" % ", ".join(str(value) for value in t.restriction)
+		if t.attributes:
+			out += " @%s" % ",".join(sorted(t.attributes))
+		return out
+
+	if kind == "types":
+		return outline_type(obj, top=True)
+	if kind == "messages":
+		return ", ".join("%s: %s" % (name, outline_type(t)) for name, t in obj.parts)
+	if kind == "port_types":
+		return ", ".join(
+			"%s(%s) -> %s" % (name, op.input.message.name if op.input else "", op.output.message.name if op.output else "")
+			for name, op in sorted(obj.operations.items())
+		)
+	if kind == "bindings":
+		return "%s of %s: %s" % (type(obj).__name__, obj.port_type.name, ", ".join(sorted(op.name for op in obj.operation_bindings)))
+	return ", ".join(
+		"%s: %s %s via %s" % (name, port.protocol, port.location, port.binding.name) for name, port in sorted(obj.ports.items())
+	)
+
+
+def test_reader_equivalence():
+	from lxml.etree import ElementTree, fromstring, parse
+	from foamy.context import Context
+	problems = []
+	for name, (counts, outlines) in sorted(MODEL_OUTLINES.items()):
+		ctx = Context(transport=object())
+		ctx.read_wsdl_tree(parse("ex/" + name))
+		registries = [getattr(ctx, kind) for kind in MODEL_KINDS]
+		if tuple(len(registry) for registry in registries) != counts:
+			problems.append("%s: %s definitions, not %s" % (name, tuple(len(registry) for registry in registries), counts))
+		for key, expected in sorted(outlines.items()):
+			kind, local_name = key.split()
+			found = [obj for obj in getattr(ctx, kind).values() if obj.name == local_name]
+			actual = (outline_definition(ctx, kind, found[0]) if found else "(missing)")
+			if actual != expected:
+				problems.append("%s: %s is %s, not %s" % (name, key, actual, expected))
+	assert not problems, "\n".join(problems)
+
+	# A schema's prefixes are its own; here the message's `t` is the one declared on the definitions
+	ctx = Context(transport=object())
+	ctx.read_wsdl_tree(ElementTree(fromstring("""<wsdl:definitions xmlns:wsdl="http://schemas.xmlsoap.org/wsdl/"
+		xmlns:s="http://www.w3.org/2001/XMLSchema" xmlns:t="urn:one" targetNamespace="urn:one"><wsdl:types>
+		<s:schema targetNamespace="urn:one"><s:element name="Foo" type="s:string"/></s:schema>
+		<s:schema targetNamespace="urn:two" xmlns:t="urn:two"><s:element name="Foo" type="s:int"/></s:schema>
+	</wsdl:types><wsdl:message name="FooIn"><wsdl:part name="parameters" element="t:Foo"/></wsdl:message></wsdl:definitions>""")))
+	assert ctx.messages["{urn:one}FooIn"].parts[0][1] is ctx.types["{urn:one}Foo"]
+
+	# A port with several addresses uses the SOAP one, wherever it is
+	wsdl = open("ex/orders.wsdl", "rb").read()
+	soap_address = wsdl[wsdl.index("<soap:address"):wsdl.index("/>", wsdl.index("<soap:address")) + 2]
+	http_address = '<http:address xmlns:http="http://schemas.xmlsoap.org/wsdl/http/" location="http://example.com/http"/>'
+	ctx = Context(transport=object())
+	ctx.read_wsdl_tree(ElementTree(fromstring(wsdl.replace(soap_address, http_address + soap_address))))
+	port = list(ctx.services.values()[0].ports.values())[0]
+	assert (port.protocol, port.location) == ("soap", "http://localhost/Orders"), (port.protocol, port.location)
+	print "Reader: the ex/ WSDLs read into the same model as before"
+
+
+RELOAD_WSDL = """<wsdl:definitions xmlns:wsdl="http://schemas.xmlsoap.org/wsdl/" xmlns:s="http://www.w3.org/2001/XMLSchema"
+	xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/" xmlns:tns="http://example.com/reload/" targetNamespace="http://example.com/reload/">
+<wsdl:types><s:schema targetNamespace="http://example.com/reload/">
+	<s:complexType name="Address"><s:sequence><s:element name="City" type="s:string"/>%(address)s</s:sequence></s:complexType>
+	<s:element name="GetCustomer"><s:complexType><s:sequence><s:element name="Id" type="s:int"/></s:sequence></s:complexType></s:element>
+	<s:element name="GetCustomerResponse"><s:complexType><s:sequence>
+		<s:element name="Name" type="s:string"/><s:element name="Home" type="tns:Address"/>
+	</s:sequence></s:complexType></s:element>
+	<s:element name="Ping"><s:complexType><s:sequence><s:element name="Text" type="s:string"/></s:sequence></s:complexType></s:element>
+</s:schema></wsdl:types>
+<wsdl:message name="GetCustomerIn"><wsdl:part name="parameters" element="tns:GetCustomer"/></wsdl:message>
+<wsdl:message name="GetCustomerOut"><wsdl:part name="parameters" element="tns:GetCustomerResponse"/></wsdl:message>
+<wsdl:message name="PingIn"><wsdl:part name="parameters" element="tns:Ping"/></wsdl:message>
+<wsdl:message name="PingOut"><wsdl:part name="parameters" element="tns:Ping"/></wsdl:message>
+<wsdl:portType name="CustomersSoap">
+	<wsdl:operation name="GetCustomer"><wsdl:input message="tns:GetCustomerIn"/><wsdl:output message="tns:GetCustomerOut"/></wsdl:operation>
+</wsdl:portType>
+<wsdl:portType name="PingSoap">
+	<wsdl:operation name="Ping"><wsdl:input message="tns:PingIn"/><wsdl:output message="tns:PingOut"/></wsdl:operation>
+</wsdl:portType>
+<wsdl:binding name="CustomersSoap" type="tns:CustomersSoap">
+	<soap:binding transport="http://schemas.xmlsoap.org/soap/http"/>
+	<wsdl:operation name="GetCustomer"><soap:operation soapAction="http://example.com/reload/GetCustomer" style="document"/>
+		<wsdl:input><soap:body use="literal"/></wsdl:input><wsdl:output><soap:body use="literal"/></wsdl:output></wsdl:operation>
+</wsdl:binding>
+<wsdl:binding name="PingSoap" type="tns:PingSoap">
+	<soap:binding transport="http://schemas.xmlsoap.org/soap/http"/>
+	<wsdl:operation name="Ping"><soap:operation soapAction="http://example.com/reload/Ping" style="document"/>
+		<wsdl:input><soap:body use="literal"/></wsdl:input><wsdl:output><soap:body use="literal"/></wsdl:output></wsdl:operation>
+</wsdl:binding>
+<wsdl:service name="Customers">
+	<wsdl:port name="CustomersSoap" binding="tns:CustomersSoap"><soap:address location="http://localhost/customers"/></wsdl:port>
+</wsdl:service>
+<wsdl:service name="Ping">
+	<wsdl:port name="PingSoap" binding="tns:PingSoap"><soap:address location="%(ping)s"/></wsdl:port>
+</wsdl:service>
+</wsdl:definitions>"""
+
+
+RELOAD_EXTRA_WSDL = """<wsdl:definitions xmlns:wsdl="http://schemas.xmlsoap.org/wsdl/" xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/"
+	xmlns:r="http://example.com/reload/" xmlns:tns="http://example.com/reload/extra/" targetNamespace="http://example.com/reload/extra/">
+<wsdl:message name="EchoIn"><wsdl:part name="parameters" element="r:Ping"/></wsdl:message>
+<wsdl:portType name="EchoSoap"><wsdl:operation name="Echo"><wsdl:input message="tns:EchoIn"/><wsdl:output message="tns:EchoIn"/></wsdl:operation></wsdl:portType>
+<wsdl:binding name="EchoSoap" type="tns:EchoSoap">
+	<soap:binding transport="http://schemas.xmlsoap.org/soap/http"/>
+	<wsdl:operation name="Echo"><soap:operation soapAction="http://example.com/reload/Echo" style="document"/>
+		<wsdl:input><soap:body use="literal"/></wsdl:input><wsdl:output><soap:body use="literal"/></wsdl:output></wsdl:operation>
+</wsdl:binding>
+<wsdl:service name="Echo"><wsdl:port name="EchoSoap" binding="tns:EchoSoap"><soap:address location="http://localhost/echo"/></wsdl:port></wsdl:service>
+</wsdl:definitions>"""
+
+
+def test_reload():
+	import os
+	import tempfile
+	from foamy.context import Context
+	from lxml.etree import ElementTree, fromstring
+
+	def tree(address="", ping="http://localhost/ping"):
+		return ElementTree(fromstring(RELOAD_WSDL % {"address": address, "ping": ping}))
+
+	def q(name):
+		return "{http://example.com/reload/}%s" % name
+
+	ctx = Context(transport=object(), reloadable=True)
+	ctx.read_wsdl_tree(tree())
+	old = ctx.model
+	get_customer = ctx.service.GetCustomer
+	get_customer.idempotent = True
+	get_customer.timeout = 5
+	ping = ctx.service.Ping
+	ping.result_mode = "lazy"
+	assert ctx.reload_trees([tree()]) == set()
+	assert ctx.model is not old and ctx.types == old.types and ctx.service.Ping is ping
+
+	# A new element in Address: everything leading to it is parsed again, the Ping side is kept
+	old = ctx.model
+	dirty = ctx.reload_trees([tree(address='<s:element name="Zip" type="s:string" minOccurs="0"/>')])
+	assert dirty == set([
+		("types", q("Address")), ("types", q("GetCustomerResponse")), ("messages", q("GetCustomerOut")),
+		("port_types", q("CustomersSoap")), ("bindings", q("CustomersSoap")), ("services", q("Customers")),
+	]), dirty
+	for kind, name in [("types", "GetCustomer"), ("types", "Ping"), ("messages", "GetCustomerIn"), ("services", "Ping")]:
+		assert getattr(ctx, kind)[q(name)] is getattr(old, kind)[q(name)], name
+	assert [t.name for t in ctx.types[q("Address")].sequence] == ["City", "Zip"] and len(list(old.types[q("Address")].sequence)) == 1
+	assert ctx.service.Ping is ping and ctx.service.GetCustomer is not get_customer
+	assert ctx.service.GetCustomer.idempotent and ctx.service.GetCustomer.timeout == 5
+	assert ctx.types[q("GetCustomerResponse")].marshal({"Name": "A", "Home": {"City": "B", "Zip": "C"}}) is not None
+	assert get_customer.operation.output.message.parts[0][1] is old.types[q("GetCustomerResponse")]  # Old calls are unaffected
+
+	# A changed address only rebuilds its service
+	assert ctx.reload_trees([tree(address='<s:element name="Zip" type="s:string" minOccurs="0"/>', ping="http://ping/")]) == set([
+		("services", q("Ping"))
+	])
+	assert ctx.service.Ping.port.location == "http://ping/" and ctx.service.Ping.result_mode == "lazy"
+
+	# Without digests from the first read, the first reload parses everything, and later ones don't
+	ctx = Context(transport=object())
+	ctx.read_wsdl_tree(tree())
+	assert len(ctx.reload_trees([tree()])) == 14
+	assert ctx.reload_trees([tree()]) == set()
+
+	fd, path = tempfile.mkstemp(suffix=".wsdl")
+	try:
+		with os.fdopen(fd, "wb") as fp:
+			fp.write(RELOAD_WSDL % {"address": "", "ping": "http://localhost/ping"})
+		ctx = Context(transport=object(), reloadable=True)
+		ctx.read_wsdl_from_url(path)
+		with open(path, "wb") as fp:
+			fp.write(RELOAD_WSDL % {"address": "", "ping": "http://ping/"})
+		assert ctx.reload() == set([("services", q("Ping"))])  # Not from the resource cache
+	finally:
+		os.remove(path)
+
+	# Reloading some documents keeps the others' definitions, unless they refer to changed ones
+	ctx = Context(transport=object(), reloadable=True)
+	ctx.read_wsdl_from_url("ex/currencyconvertor.wsdl")
+	ctx.read_wsdl_from_url("ex/orders.wsdl")
+	conversion_rate = ctx.service.ConversionRate
+	assert ctx.reload(["ex/orders.wsdl"]) == set()
+	assert ctx.service.ConversionRate is conversion_rate and ctx.sources == ["ex/currencyconvertor.wsdl", "ex/orders.wsdl"]
+	assert ctx.urls == ctx.sources
+
+	ctx = Context(transport=object(), reloadable=True)
+	ctx.read_wsdl_tree(tree(), source="a")
+	ctx.read_wsdl_tree(ElementTree(fromstring(RELOAD_EXTRA_WSDL)), source="b")
+	echo = ctx.service.Echo
+	changed_ping = '<s:element name="Ping"><s:complexType><s:sequence><s:element name="Text" type="s:string" maxOccurs="2"/>'
+	changed = (RELOAD_WSDL % {"address": "", "ping": "http://localhost/ping"}).replace(
+		'<s:element name="Ping"><s:complexType><s:sequence><s:element name="Text" type="s:string"/>', changed_ping
+	)
+	changed_tree = ElementTree(fromstring(changed))
+	try:
+		ctx.reload_trees([changed_tree], ["a"])
+	except ValueError:
+		pass
+	else:
+		raise AssertionError("Reloading a without b, which refers to it, should fail")
+	assert ctx.service.Echo is echo
+	dirty = ctx.reload_trees([changed_tree, ElementTree(fromstring(RELOAD_EXTRA_WSDL))], ["a", "b"])
+	assert ("messages", "{http://example.com/reload/extra/}EchoIn") in dirty and ctx.service.Echo is not echo
+	assert ctx.reload_trees([ElementTree(fromstring(changed.replace(
+		'<s:element name="City" type="s:string"/>', '<s:element name="City" type="s:string"/><s:element name="Zip" type="s:string"/>'
+	)))], ["a"]) == set([
+		("types", q("Address")), ("types", q("GetCustomerResponse")), ("messages", q("GetCustomerOut")),
+		("port_types", q("CustomersSoap")), ("bindings", q("CustomersSoap")), ("services", q("Customers")),
+	])  # Nothing in b refers to Address
+	assert ctx.sources == ["a", "b"] and ctx.service.Echo.operation.input.message.parts[0][1] is ctx.types[q("Ping")]
+	print "Reload: only changed definitions and their dependents are parsed again"
+
+
+def test_retry_and_hedging():
+	calls = []
+
+	def handler(request):
+		calls.append(request)
+		if len(calls) < 20 and len(calls) % 2 == 1:
+			return (503, {}, "Try again")
+		if len(calls) == 25:
+			time.sleep(1)  # One straggler, to be hedged
+		return (200, {"Content-Type": "text/xml; charset=utf-8"}, CC_RESPONSE % "1.25")
+
+	with StandInServer(handler) as server:
+		ctx = open_soap(
+			"ex/currencyconvertor.wsdl",
+			retry_policy=RetryPolicy(max_attempts=3, backoff=0.001),
+			hedge_policy=HedgePolicy(min_samples=5, min_delay=0.3),
+		)
+		op = ctx.service.ConversionRate
+		op.port.location = server.url
+		op.idempotent = True
+		start = time.time()
+		for x in xrange(20):
+			assert op(FromCurrency="EUR", ToCurrency="USD")["ConversionRateResult"] == 1.25
+		stats = op.stats
+		assert stats.calls == 20 and stats.retries == 10 and stats.hedges == stats.hedge_wins == 1
+	print "Retry and hedging: %s in %.2f s" % (stats.as_dict(), time.time() - start)
+
+
+def test_deadlines():
+	def handler(request):
+		if "<ns0:FromCurrency>XAU</ns0:FromCurrency>" in request.body:
+			return (503, {}, "")
+		if "<ns0:FromCurrency>EUR</ns0:FromCurrency>" in request.body:
+			time.sleep(1)
+		return (200, {"Content-Type": "text/xml; charset=utf-8"}, CC_RESPONSE % "1.25")
+
+	def expect(exc_type, fn, max_duration):
+		start = time.time()
+		try:
+			fn()
+		except exc_type:
+			pass
+		else:
+			raise AssertionError("%s not raised" % exc_type.__name__)
+		assert time.time() - start < max_duration, time.time() - start
+
+	with StandInServer(handler) as server:
+		for stream in (False, True):
+			ctx = open_soap("ex/currencyconvertor.wsdl", transport=RequestsTransport(stream=stream), retry_policy=RetryPolicy(max_attempts=100, backoff=0.05, jitter=False), timeout=0.2)
+			op = ctx.service.ConversionRate
+			op.port.location = server.url
+			op.idempotent = True
+			expect(DeadlineExceeded, lambda: op(FromCurrency="EUR", ToCurrency="USD"), 0.5)  # Context default
+			op.timeout = 0.1
+			expect(DeadlineExceeded, lambda: op(FromCurrency="EUR", ToCurrency="USD"), 0.5)  # Per operation
+			assert op(FromCurrency="EUR", ToCurrency="USD", _timeout=2) == {"ConversionRateResult": 1.25}  # Per call
+			expect(HTTPError, lambda: op(FromCurrency="XAU", ToCurrency="USD", _timeout=0.5), 0.7)  # Retries stop in time
+			assert 3 <= op.stats.retries < 10, op.stats.retries
+			n_requests = len(server.requests)
+			expect(DeadlineExceeded, lambda: op(FromCurrency="USD", ToCurrency="EUR", _deadline=Deadline(0)), 0.1)
+			assert len(server.requests) == n_requests  # Abandoned before marshalling
+
+	def trickle_handler(request):
+		return (200, {"Content-Type": "text/xml; charset=utf-8"}, CC_RESPONSE % "1.25")
+
+	from foamy.rawhttp import RawHTTPTransport
+	with StandInServer(trickle_handler, trickle=0.02) as server:  # Some 5 s for the whole response
+		for transport in (RequestsTransport(), RequestsTransport(stream=True), RawHTTPTransport(), RawHTTPTransport(stream=True)):
+			ctx = open_soap("ex/currencyconvertor.wsdl", transport=transport)
+			op = ctx.service.ConversionRate
+			op.port.location = server.url
+			expect(DeadlineExceeded, lambda: op(FromCurrency="EUR", ToCurrency="USD", _timeout=0.5), 0.7)
+	print "Deadlines: calls, retries, expired budgets and trickling responses all stop in time"
+
+
+def test_concurrency_limit():
+	import threading
+	state = {"slow": False}
+
+	def handler(request):
+		time.sleep(0.2 if state["slow"] else 0.01)
+		return (200, {"Content-Type": "text/xml; charset=utf-8"}, CC_RESPONSE % "1.25")
+
+	with StandInServer(handler) as server:
+		ctx = open_soap("ex/currencyconvertor.wsdl", limiter_factory=lambda: AIMDLimiter(initial_limit=4, max_queue=8))
+		op = ctx.service.ConversionRate
+		op.port.location = server.url
+		limiter = ctx.get_limiter(op.port)
+		errors = []
+
+		def worker(n):
+			for x in xrange(n):
+				try:
+					op(FromCurrency="EUR", ToCurrency="USD")
+				except ConcurrencyLimitExceeded as exc:
+					errors.append(exc)
+
+		def run(n_threads, n_calls):
+			threads = [threading.Thread(target=worker, args=(n_calls,)) for x in xrange(n_threads)]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+
+		run(4, 10)
+		healthy_limit = limiter.limit
+		assert healthy_limit > 4 and not errors
+		state["slow"] = True
+		run(16, 2)
+		assert limiter.limit < healthy_limit and limiter.in_flight == limiter.queued == 0
+		assert errors  # 16 callers don't fit in the limit plus a queue of 8
+	print "Concurrency limit: %d when healthy, %d when slow, %d calls rejected" % (healthy_limit, limiter.limit, len(errors))
+
+
+ORDER_RESPONSE = """<?xml version="1.0" encoding="utf-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"><soap:Body>
+<SubmitOrderResponse xmlns="http://example.com/orders/"><ItemCount>%d</ItemCount></SubmitOrderResponse>
+</soap:Body></soap:Envelope>"""
+
+
+def test_record_replay():
+	import os
+	import tempfile
+	from foamy.recording import RecordingTransport, ReplayTransport, UnrecordedRequest, replay_requests
+
+	def handler(request):
+		if "OrderId" in request.body:
+			return (200, {"Content-Type": "text/xml; charset=utf-8"}, ORDER_RESPONSE % request.body.count("<ns0:Item>"))
+		if len(server.requests) == 1:
+			return (503, {}, "Try again")
+		time.sleep(0.05)
+		return (200, {"Content-Type": "text/xml; charset=utf-8"}, CC_RESPONSE % "1.25")
+
+	def calls(transport):
+		ctx = open_soap("ex/currencyconvertor.wsdl", transport=transport, compression=Compression("gzip", threshold=0), retry_policy=RetryPolicy(backoff=0))
+		op = ctx.service.ConversionRate
+		op.port.location = server.url
+		op.idempotent = True
+		orders = open_soap("ex/orders.wsdl", transport=transport).service.SubmitOrder
+		orders.port.location = server.url
+		items = ({"Sku": "SKU-%d" % i, "Quantity": 1} for i in xrange(3))
+		return (
+			op(FromCurrency="EUR", ToCurrency="USD"),
+			orders(OrderId="A-1", Item=items, _stream_request=True),
+			op.stats.retries,
+		)
+
+	fd, path = tempfile.mkstemp(suffix=".rec")
+	os.close(fd)
+	try:
+		with StandInServer(handler) as server:
+			recorder = RecordingTransport(RequestsTransport(), path)
+			recorded = calls(recorder)
+			recorder.close()
+			port = server.server.server_address[1]
+		assert recorded == ({"ConversionRateResult": 1.25}, {"ItemCount": 3}, 1), recorded
+
+		replay = ReplayTransport(path)
+		assert len(replay.recording) == 3
+		assert calls(replay) == recorded  # Server is gone; the failure and retry are replayed too
+		start = time.time()
+		assert calls(ReplayTransport(path, speed=0.5)) == recorded
+		assert time.time() - start >= 0.1  # The 50 ms call took twice as long
+		try:
+			open_soap("ex/currencyconvertor.wsdl", transport=replay).service.ConversionRate(FromCurrency="USD", ToCurrency="EUR")
+			raise AssertionError("Unrecorded request served")
+		except UnrecordedRequest:
+			pass
+		with StandInServer(handler, port=port) as server:  # The recorded URLs point here
+			results = replay_requests(path, RequestsTransport().dispatch, speed=None)
+			assert [resp.code for (request, resp) in results] == [503, 200, 200]  # Resent as recorded
+			assert [request.raw_body for request in server.requests] == [request.data for (request, resp) in results]
+	finally:
+		os.unlink(path)
+	print "Record/replay: %d exchanges recorded and replayed" % len(replay.recording)
+
+
+def test_raw_http_transport():
+	from foamy.rawhttp import RawHTTPTransport
+
+	def handler(request):
+		if "EUR" not in request.body:
+			return (500, {"Content-Type": "text/plain"}, "No such currency")
+		if "SEK" in request.body:
+			time.sleep(0.5)
+		return (200, {"Content-Type": "text/xml; charset=utf-8"}, CC_RESPONSE % "1.25")
+
+	def items(n):
+		for i in xrange(n):
+			yield {"Sku": "SKU-%06d" % i, "Quantity": 1}
+
+	transport = RawHTTPTransport()
+	with StandInServer(handler, response_encoding="gzip") as server:
+		for stream in (False, True):
+			transport.stream = stream
+			ctx = open_soap("ex/currencyconvertor.wsdl", transport=transport, compression=Compression("gzip", threshold=0))
+			op = ctx.service.ConversionRate
+			op.port.location = server.url
+			for x in xrange(3):
+				assert op(FromCurrency="EUR", ToCurrency="USD")["ConversionRateResult"] == 1.25
+		assert len(server.server.connections) == 1  # Kept alive and reused
+		assert server.requests[-1].headers["content-encoding"] == "gzip"
+		try:
+			op(FromCurrency="XXX", ToCurrency="USD")
+			raise AssertionError("HTTP error not raised")
+		except HTTPError as exc:
+			assert exc.code == 500 and exc.response.data == "No such currency"
+		try:
+			op(FromCurrency="EUR", ToCurrency="SEK", _timeout=0.1)
+			raise AssertionError("Deadline not enforced")
+		except DeadlineExceeded:
+			pass
+
+		orders = open_soap("ex/orders.wsdl", transport=transport).service.SubmitOrder
+		orders.port.location = server.url
+		server.handler = lambda request: (200, {"Content-Type": "text/xml; charset=utf-8"}, ORDER_RESPONSE % request.body.count("<ns0:Item>"))
+		assert orders(OrderId="A-1", Item=items(1000), _stream_request=True)["ItemCount"] == 1000
+		assert server.requests[-1].headers["transfer-encoding"] == "chunked"
+		port = server.server.server_address[1]
+	with StandInServer(handler, port=port) as server:  # The pooled connections are gone now
+		assert op(FromCurrency="EUR", ToCurrency="USD")["ConversionRateResult"] == 1.25
+	transport.close()
+	print "Raw HTTP transport: keep-alive, compression, errors, deadlines and streaming OK"
+
+
+def test_parsers():
+	import threading
+	from lxml import etree
+	from foamy.xmlutils import XMLParsers
+	parsers = XMLParsers()
+	root = parsers.fromstring('<!DOCTYPE r [<!ENTITY a "AAAA"><!ENTITY b SYSTEM "/etc/passwd">]><r><s>&a;</s><t>&b;</t></r>')
+	assert etree.tostring(root) == "<r><s>&a;</s><t>&b;</t></r>"  # Left alone, not expanded or loaded
+	root = parsers.fromstring(CC_RESPONSE % "1.25")
+	assert not any(el.tail for el in root.iter()) and root[0][0][0].text == "1.25"  # No blank text nodes
+
+	big_text = "<r>%s</r>" % ("x" * (10 * 1024 * 1024 + 1))
+	try:
+		parsers.fromstring(big_text)
+		raise AssertionError("Huge text node accepted without huge_tree")
+	except etree.XMLSyntaxError:
+		pass
+	assert len(XMLParsers(huge_tree=True).fromstring(big_text).text) == len(big_text) - 7
+
+	thread_parsers = []
+	thread = threading.Thread(target=lambda: thread_parsers.append(parsers.get_parser()))
+	thread.start()
+	thread.join()
+	assert thread_parsers[0] is not parsers.get_parser() and parsers.get_parser() is parsers.get_parser()
+	print "Parsers: no entity expansion, no blank text, huge trees opt-in, a parser per thread"
+
+
+def test_streaming_request():
+	from lxml import etree
+	import StringIO
+
+	def handler(request):
+		assert request.headers.get("transfer-encoding") == "chunked"
+		n_items = 0
+		for event, element in etree.iterparse(StringIO.StringIO(request.body), tag="{http://example.com/orders/}Item"):
+			n_items += 1
+			element.clear()
+		return (200, {"Content-Type": "text/xml; charset=utf-8"}, ORDER_RESPONSE % n_items)
+
+	def items(n):
+		for i in xrange(n):
+			yield {"Sku": "SKU-%06d" % i, "Quantity": i % 7 + 1}
+
+	with StandInServer(handler) as server:
+		ctx = open_soap("ex/orders.wsdl", compression=Compression("gzip"))
+		op = ctx.service.SubmitOrder
+		op.port.location = server.url
+		resp = op(OrderId="A-1", Item=items(20000), _stream_request=True)
+		assert resp["ItemCount"] == 20000
+		request = server.requests[-1]
+		assert len(request.raw_body) < len(request.body) / 5  # Compressed on the fly
+		try:
+			op(OrderId="A-2", Item=items(0), _stream_request=True)
+			raise AssertionError("Empty item iterator should fail min_occurs check")
+		except MarshalValueError:
+			pass
+	print "Streaming request: 20000 items in %d bytes (%d compressed)" % (len(request.body), len(request.raw_body))
+
+
+def test_bulk_envelopes():
+	import io
+	import os
+	import shutil
+	import tempfile
+	from foamy.bulk import DirectorySink, StreamSink, write_envelopes
+	ctx = open_soap("ex/orders.wsdl")
+	op = ctx.service.SubmitOrder
+	records = [{"OrderId": "A-%d" % i, "Item": [{"Sku": u"SKU-\xe4%d" % i, "Quantity": i}]} for i in xrange(50)]
+	expected = [b"".join(op.port.binding.iter_envelope(record, op.operation)) for record in records]
+
+	for processes, compiled in ((None, True), (None, False), (2, True)):
+		out = io.BytesIO()
+		stats = write_envelopes(op, iter(records), StreamSink(out, separator=b"\0"), processes=processes, chunk_size=7, compiled=compiled)
+		assert out.getvalue().split(b"\0")[:-1] == expected
+		assert stats.count == 50 and stats.bytes == sum(len(data) for data in expected)
+
+	path = tempfile.mkdtemp()
+	try:
+		with DirectorySink(path) as sink:
+			write_envelopes(op, records[:3], sink)
+		assert sorted(os.listdir(path)) == ["00000000.xml", "00000001.xml", "00000002.xml"]
+		with open(os.path.join(path, "00000002.xml"), "rb") as fp:
+			assert fp.read() == expected[2]
+	finally:
+		shutil.rmtree(path)
+	print "Bulk envelopes: %s" % stats.describe()
+
+
+def test_codegen():
+	import imp
+	from foamy.codegen import generate_module
+
+	def load(wsdl):
+		ctx = open_soap(wsdl)
+		module = imp.new_module("generated")
+		exec generate_module(ctx, wsdl) in module.__dict__
+		return ctx, module
+
+	cases = [
+		("ex/currencyconvertor.wsdl", "ConversionRate", lambda: {"FromCurrency": "EUR", "ToCurrency": "USD"}),
+		("ex/parasoft-calculator.wsdl", "multiply", lambda: (64, 32)),
+		("ex/ndfdXML.wsdl", "NDFDgen", lambda: dict(
+			latitude=39, longitude=-77, product="time-series", startTime=datetime.datetime(2012, 1, 1),
+			endTime=datetime.datetime(2016, 9, 9), Unit="m", weatherParameters={"maxt": True, "mint": False}
+		)),
+		("ex/orders.wsdl", "SubmitOrder", lambda: {"OrderId": "A-1", "Item": ({"Sku": "SKU-%d" % i, "Quantity": i} for i in xrange(3))}),
+		("ex/attachments.wsdl", "Store", lambda: {"Name": "test", "Content": "\x00\x01\x02"}),
+	]
+	for wsdl, op_name, make_message in cases:
+		ctx, module = load(wsdl)
+		op = getattr(ctx.service, op_name)
+		dynamic = op.port.envelope_message(make_message(), op.operation)
+		generated = module.Client(transport=object()).envelope_message(op_name, make_message())
+		assert dynamic.data == generated.data, (dynamic.data, generated.data)
+		assert dynamic.headers == generated.headers and dynamic.url == generated.url
+
+	def handler(request):
+		return (200, {"Content-Type": "text/xml; charset=utf-8"}, CC_RESPONSE % "1.25")
+
+	with StandInServer(handler) as server:
+		ctx, module = load("ex/currencyconvertor.wsdl")
+		client = module.Client(location=server.url)
+		result = client.ConversionRate(FromCurrency="EUR", ToCurrency="USD")
+		assert isinstance(result, module.ConversionRateResponse) and result.ConversionRateResult == 1.25
+		op = ctx.service.ConversionRate
+		op.port.location = server.url
+		assert result.to_dict() == op(FromCurrency="EUR", ToCurrency="USD")
+	print "Codegen: same requests and results as the dynamic path for %d operations" % len(cases)
+
+
+IMPORT_BUDGET = 0.25  # Seconds for `import foamy.shortcuts` in a fresh interpreter
+DEFERRED_MODULES = ("requests", "cgi", "uuid", "decimal", "foamy.transport")
+
+
+def test_import_time():
+	import subprocess
+	script = (
+		"import sys, time\n"
+		"start = time.time()\n"
+		"import foamy.shortcuts\n"
+		"print time.time() - start\n"
+		"print ' '.join(m for m in %r if sys.modules.get(m))\n" % (DEFERRED_MODULES,)
+	)
+	durations = []
+	for x in xrange(3):
+		output = subprocess.check_output([sys.executable, "-c", script]).splitlines()
+		assert not output[1:] or not output[1], "Eagerly imported: %s" % output[1]
+		durations.append(float(output[0]))
+	duration = min(durations)
+	assert duration < IMPORT_BUDGET, "import foamy.shortcuts took %.3f s" % duration
+	print "Import: foamy.shortcuts in %.1f ms" % (duration * 1000)
+
+
+STORE_RESPONSE = """<?xml version="1.0" encoding="utf-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"><soap:Body>
+<StoreResponse xmlns="http://example.com/attachments/"><Name>%s</Name>
+<Content><xop:Include xmlns:xop="http://www.w3.org/2004/08/xop/include" href="cid:content@stand-in"/></Content>
+</StoreResponse></soap:Body></soap:Envelope>"""
+
+
+def test_mtom():
+	payload = "".join(chr(i % 256) for i in xrange(300000))
+
+	def handler(request):
+		tree, attachments = parse_multipart([request.body], request.headers["content-type"])
+		include = tree.find(".//{http://www.w3.org/2004/08/xop/include}Include")
+		content = attachments.resolve(include.get("href")).read()
+		assert content == payload
+		out_attachments = Attachments()
+		out_attachments["content@stand-in"] = Attachment("content@stand-in", data=content[::-1])
+		content_type, chunks = build_multipart(STORE_RESPONSE % "reversed", out_attachments)
+		return (200, {"Content-Type": content_type}, "".join(chunks))
+
+	for stream in (False, True):
+		with StandInServer(handler) as server:
+			ctx = open_soap("ex/attachments.wsdl", transport=RequestsTransport(stream=stream, attachment_threshold=1024))
+			svc = ctx.service
+			svc.Store.port.location = server.url
+			svc.Store.port.binding.mtom = True
+			for stream_request in (False, True):
+				resp = svc.Store({"Name": "test", "Content": payload}, _stream_request=stream_request)
+				assert resp["Name"] == "reversed"
+				assert resp["Content"].read() == payload[::-1]
+				assert len(server.requests[-1].body) < len(payload) * 1.1  # No base64 inflation
+		print "MTOM (stream=%s): %d bytes out and back" % (stream, len(payload))
+
+
 if __name__ == '__main__':
+	test_import_time()
+	test_compression()
+	test_streaming_response()
+	test_http_binding()
+	test_result_modes()
+	test_record_classes()
+	test_interning()
+	test_reader_equivalence()
+	test_reload()
+	test_projection()
+	test_strict_validation()
+	test_retry_and_hedging()
+	test_deadlines()
+	test_concurrency_limit()
+	test_fleet()
+	test_raw_http_transport()
+	test_parsers()
+	test_streaming_request()
+	test_record_replay()
+	test_bulk_envelopes()
+	test_codegen()
+	test_mtom()
 	test_cc()
 	test_ndfd()
 	test_calculator()
\ No newline at end of file